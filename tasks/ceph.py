@@ -12,8 +12,6 @@ import logging
 import os
 import json
 import time
-import gevent
-import socket
 
 from ceph_manager import CephManager, write_conf
 from tasks.cephfs.filesystem import Filesystem
@@ -21,7 +19,15 @@ from teuthology import misc as teuthology
 from teuthology import contextutil
 from teuthology import exceptions
 from teuthology.orchestra import run
+from teuthology.parallel import parallel
 import ceph_client as cclient
+from util import daemon_ready
+from util import log_archive
+from util import log_rotate
+from util import log_scan
+from util import prebaked_cluster
+from util import scrub_tracker
+from util import valgrind
 from teuthology.orchestra.daemon import DaemonGroup
 
 CEPH_ROLE_TYPES = ['mon', 'mgr', 'osd', 'mds', 'rgw']
@@ -66,6 +72,17 @@ def ceph_log(ctx, config):
     Create /var/log/ceph log directory that is open to everyone.
     Add valgrind and profiling-logger directories.
 
+    With ``log-rotate`` at the top level of the job, mapping daemon types
+    to size limits (e.g. ``ceph-osd: 1G``), a watcher on each node
+    rotates the logs of a daemon type as soon as one grows past its limit;
+    the rotations and peak log growth rate of each daemon type go in the
+    job summary under ``log_rotation``.
+
+    On the way out the logs are compressed and pulled into the archive
+    from all nodes at once.  ``log-archive-bandwidth``, at the top level
+    of the job, caps the combined transfer in MB/s; the bytes and
+    seconds for each node go in the job summary under ``log_archive``.
+
     :param ctx: Context
     :param config: Configuration
     """
@@ -105,55 +122,16 @@ def ceph_log(ctx, config):
         )
     )
 
-    class Rotater(object):
-        stop_event = gevent.event.Event()
-
-        def invoke_logrotate(self):
-            # 1) install ceph-test.conf in /etc/logrotate.d
-            # 2) continuously loop over logrotate invocation with ceph-test.conf
-            while not self.stop_event.is_set():
-                self.stop_event.wait(timeout=30)
-                try:
-                    run.wait(
-                        ctx.cluster.run(
-                            args=['sudo', 'logrotate', '/etc/logrotate.d/ceph-test.conf'
-                                  ],
-                            wait=False,
-                        )
-                    )
-                except exceptions.ConnectionLostError as e:
-                    # Some tests may power off nodes during test, in which
-                    # case we will see connection errors that we should ignore.
-                    log.debug("Missed logrotate, node '{0}' is offline".format(
-                        e.node))
-                except EOFError as e:
-                    # Paramiko sometimes raises this when it fails to
-                    # connect to a node during open_session.  As with
-                    # ConnectionLostError, we ignore this because nodes
-                    # are allowed to get power cycled during tests.
-                    log.debug("Missed logrotate, EOFError")
-                except socket.error as e:
-                    if e.errno == errno.EHOSTUNREACH:
-                        log.debug("Missed logrotate, host unreachable")
-                    else:
-                        raise
-
-        def begin(self):
-            self.thread = gevent.spawn(self.invoke_logrotate)
-
-        def end(self):
-            self.stop_event.set()
-            self.thread.get()
-
     def write_rotate_conf(ctx, daemons):
         testdir = teuthology.get_testdir(ctx)
         rotate_conf_path = os.path.join(os.path.dirname(__file__), 'logrotate.conf')
         with file(rotate_conf_path, 'rb') as f:
-            conf = ""
+            template = f.read()
+            stanzas = {}
             for daemon, size in daemons.iteritems():
                 log.info('writing logrotate stanza for {daemon}'.format(daemon=daemon))
-                conf += f.read().format(daemon_type=daemon, max_size=size)
-                f.seek(0, 0)
+                stanzas[daemon] = template.format(daemon_type=daemon, max_size=size)
+            conf = "".join(stanzas.itervalues())
 
             for remote in ctx.cluster.remotes.iterkeys():
                 teuthology.write_file(remote=remote,
@@ -180,20 +158,21 @@ def ceph_log(ctx, config):
                 )
                 remote.chcon('/etc/logrotate.d/ceph-test.conf',
                              'system_u:object_r:etc_t:s0')
+        return stanzas
 
     if ctx.config.get('log-rotate'):
         daemons = ctx.config.get('log-rotate')
         log.info('Setting up log rotation with ' + str(daemons))
-        write_rotate_conf(ctx, daemons)
-        logrotater = Rotater()
-        logrotater.begin()
+        stanzas = write_rotate_conf(ctx, daemons)
+        logrotater = log_rotate.LogRotateWatcher(daemons, stanzas)
+        logrotater.begin(ctx.cluster.remotes.iterkeys())
     try:
         yield
 
     finally:
         if ctx.config.get('log-rotate'):
             log.info('Shutting down logrotate')
-            logrotater.end()
+            ctx.summary['log_rotation'] = logrotater.end()
             ctx.cluster.run(
                 args=['sudo', 'rm', '/etc/logrotate.d/ceph-test.conf'
                       ]
@@ -201,37 +180,16 @@ def ceph_log(ctx, config):
         if ctx.archive is not None and \
                 not (ctx.config.get('archive-on-error') and ctx.summary['success']):
             # and logs
-            log.info('Compressing logs...')
-            run.wait(
-                ctx.cluster.run(
-                    args=[
-                        'sudo',
-                        'find',
-                        '/var/log/ceph',
-                        '-name',
-                        '*.log',
-                        '-print0',
-                        run.Raw('|'),
-                        'sudo',
-                        'xargs',
-                        '-0',
-                        '--no-run-if-empty',
-                        '--',
-                        'gzip',
-                        '--',
-                    ],
-                    wait=False,
-                ),
-            )
-
-            log.info('Archiving logs...')
+            log.info('Compressing and archiving logs...')
             path = os.path.join(ctx.archive, 'remote')
             os.makedirs(path)
-            for remote in ctx.cluster.remotes.iterkeys():
-                sub = os.path.join(path, remote.shortname)
-                os.makedirs(sub)
-                teuthology.pull_directory(remote, '/var/log/ceph',
-                                          os.path.join(sub, 'log'))
+            bandwidth = ctx.config.get('log-archive-bandwidth')
+            if bandwidth:
+                # MB/s, for all nodes together
+                bandwidth = float(bandwidth) * 1024 * 1024
+            ctx.summary['log_archive'] = log_archive.archive_logs(
+                ctx.cluster.remotes.iterkeys(), '/var/log/ceph', path,
+                bandwidth=bandwidth)
 
 
 def assign_devs(roles, devs):
@@ -252,16 +210,37 @@ def valgrind_post(ctx, config):
     if textual errors occured in the logs, or if valgrind exceptions were detected in
     the logs.
 
+    The errors found are folded together by kind and top stack frames
+    across all daemons and written to valgrind/summary.txt (and .json)
+    in the job archive.
+
     :param ctx: Context
     :param config: Configuration
     """
     try:
         yield
     finally:
-        lookup_procs = list()
         log.info('Checking for errors in any valgrind logs...')
-        for remote in ctx.cluster.remotes.iterkeys():
-            # look at valgrind logs for each node
+        errors, failed = valgrind.collect(ctx.cluster.remotes.iterkeys())
+        if ctx.archive is not None:
+            valgrind.write_summary(errors,
+                                   os.path.join(ctx.archive, 'valgrind'))
+
+        valgrind_exception = None
+        for error in errors:
+            daemons = [daemon for daemon in error['daemons']
+                       if not (daemon.find('mds') >= 0 and
+                               error['kind'].find('Lost') > 0)]
+            if not daemons:
+                continue
+            log.error('saw valgrind issue %s (x%d) in %s: %s', error['kind'],
+                      error['count'], ', '.join(daemons),
+                      error['frames'][0] if error['frames'] else '?')
+            valgrind_exception = Exception('saw valgrind issues')
+
+        lookup_procs = list()
+        for remote in failed:
+            # fall back to grepping for the kinds of errors
             proc = remote.run(
                 args=[
                     'sudo',
@@ -280,7 +259,6 @@ def valgrind_post(ctx, config):
             )
             lookup_procs.append((proc, remote))
 
-        valgrind_exception = None
         for (proc, remote) in lookup_procs:
             proc.wait()
             out = proc.stdout.getvalue()
@@ -386,6 +364,8 @@ def cluster(ctx, config):
         Mkfs osd nodes.
         Add keyring information to monmaps
         Mkfs mon nodes.
+        With prebaked_cluster, save all of the above for later jobs, or
+        unpack it from an earlier job instead.
 
     On exit:
         If errors occured, extract a failure message and store in ctx.summary.
@@ -499,47 +479,68 @@ def cluster(ctx, config):
 
     firstmon = teuthology.get_first_mon(ctx, config, cluster_name)
 
-    log.info('Setting up %s...' % firstmon)
-    ctx.cluster.only(firstmon).run(
-        args=[
-            'sudo',
-            'adjust-ulimits',
-            'ceph-coverage',
-            coverage_dir,
-            'ceph-authtool',
-            '--create-keyring',
-            keyring_path,
-        ],
-    )
-    ctx.cluster.only(firstmon).run(
-        args=[
-            'sudo',
-            'adjust-ulimits',
-            'ceph-coverage',
-            coverage_dir,
-            'ceph-authtool',
-            '--gen-key',
-            '--name=mon.',
-            keyring_path,
-        ],
-    )
-    ctx.cluster.only(firstmon).run(
-        args=[
-            'sudo',
-            'chmod',
-            '0644',
-            keyring_path,
-        ],
-    )
+    prebaked = None
+    if config.get('prebaked_cluster'):
+        reason = prebaked_cluster.unsupported_reason(ctx, config, conf)
+        if reason is not None:
+            log.info('Not using a prebaked cluster: %s', reason)
+        else:
+            prebake_config = config['prebaked_cluster']
+            if not isinstance(prebake_config, dict):
+                prebake_config = {}
+            prebaked = prebaked_cluster.PrebakedCluster(
+                ctx, cluster_name,
+                prebake_config.get('cache_dir',
+                                   prebaked_cluster.DEFAULT_CACHE_DIR),
+                prebaked_cluster.cache_key(ctx, config, conf))
+            log.info('Prebaked cluster image %s: %s', prebaked.key,
+                     'found' if prebaked.hit else 'not found, building it')
+    restore = prebaked is not None and prebaked.hit
+
     (mon0_remote,) = ctx.cluster.only(firstmon).remotes.keys()
     monmap_path = '{tdir}/{cluster}.monmap'.format(tdir=testdir,
                                                    cluster=cluster_name)
-    fsid = teuthology.create_simple_monmap(
-        ctx,
-        remote=mon0_remote,
-        conf=conf,
-        path=monmap_path,
-    )
+    if restore:
+        fsid = prebaked.fsid
+    else:
+        log.info('Setting up %s...' % firstmon)
+        ctx.cluster.only(firstmon).run(
+            args=[
+                'sudo',
+                'adjust-ulimits',
+                'ceph-coverage',
+                coverage_dir,
+                'ceph-authtool',
+                '--create-keyring',
+                keyring_path,
+            ],
+        )
+        ctx.cluster.only(firstmon).run(
+            args=[
+                'sudo',
+                'adjust-ulimits',
+                'ceph-coverage',
+                coverage_dir,
+                'ceph-authtool',
+                '--gen-key',
+                '--name=mon.',
+                keyring_path,
+            ],
+        )
+        ctx.cluster.only(firstmon).run(
+            args=[
+                'sudo',
+                'chmod',
+                '0644',
+                keyring_path,
+            ],
+        )
+        fsid = teuthology.create_simple_monmap(
+            ctx,
+            remote=mon0_remote,
+            conf=conf,
+            path=monmap_path,
+        )
     if not 'global' in conf:
         conf['global'] = {}
     conf['global']['fsid'] = fsid
@@ -549,133 +550,135 @@ def cluster(ctx, config):
     log.info('Writing %s for FSID %s...' % (conf_path, fsid))
     write_conf(ctx, conf_path, cluster_name)
 
-    log.info('Creating admin key on %s...' % firstmon)
-    ctx.cluster.only(firstmon).run(
-        args=[
-            'sudo',
-            'adjust-ulimits',
-            'ceph-coverage',
-            coverage_dir,
-            'ceph-authtool',
-            '--gen-key',
-            '--name=client.admin',
-            '--set-uid=0',
-            '--cap', 'mon', 'allow *',
-            '--cap', 'osd', 'allow *',
-            '--cap', 'mds', 'allow *',
-            keyring_path,
-        ],
-    )
-
-    log.info('Copying monmap to all nodes...')
-    keyring = teuthology.get_file(
-        remote=mon0_remote,
-        path=keyring_path,
-    )
-    monmap = teuthology.get_file(
-        remote=mon0_remote,
-        path=monmap_path,
-    )
+    if not restore:
+        log.info('Creating admin key on %s...' % firstmon)
+        ctx.cluster.only(firstmon).run(
+            args=[
+                'sudo',
+                'adjust-ulimits',
+                'ceph-coverage',
+                coverage_dir,
+                'ceph-authtool',
+                '--gen-key',
+                '--name=client.admin',
+                '--set-uid=0',
+                '--cap', 'mon', 'allow *',
+                '--cap', 'osd', 'allow *',
+                '--cap', 'mds', 'allow *',
+                keyring_path,
+            ],
+        )
 
-    for rem in ctx.cluster.remotes.iterkeys():
-        # copy mon key and initial monmap
-        log.info('Sending monmap to node {remote}'.format(remote=rem))
-        teuthology.sudo_write_file(
-            remote=rem,
+        log.info('Copying monmap to all nodes...')
+        keyring = teuthology.get_file(
+            remote=mon0_remote,
             path=keyring_path,
-            data=keyring,
-            perms='0644'
         )
-        teuthology.write_file(
-            remote=rem,
+        monmap = teuthology.get_file(
+            remote=mon0_remote,
             path=monmap_path,
-            data=monmap,
         )
 
+        for rem in ctx.cluster.remotes.iterkeys():
+            # copy mon key and initial monmap
+            log.info('Sending monmap to node {remote}'.format(remote=rem))
+            teuthology.sudo_write_file(
+                remote=rem,
+                path=keyring_path,
+                data=keyring,
+                perms='0644'
+            )
+            teuthology.write_file(
+                remote=rem,
+                path=monmap_path,
+                data=monmap,
+            )
+
     log.info('Setting up mon nodes...')
     mons = ctx.cluster.only(teuthology.is_type('mon', cluster_name))
     osdmap_path = '{tdir}/{cluster}.osdmap'.format(tdir=testdir,
                                                    cluster=cluster_name)
-    run.wait(
-        mons.run(
-            args=[
-                'adjust-ulimits',
-                'ceph-coverage',
-                coverage_dir,
-                'osdmaptool',
-                '-c', conf_path,
-                '--clobber',
-                '--createsimple', '{num:d}'.format(
-                    num=teuthology.num_instances_of_type(ctx.cluster, 'osd',
-                                                         cluster_name),
-                ),
-                osdmap_path,
-                '--pg_bits', '2',
-                '--pgp_bits', '4',
-            ],
-            wait=False,
-        ),
-    )
-
-    log.info('Setting up mgr nodes...')
-    mgrs = ctx.cluster.only(teuthology.is_type('mgr', cluster_name))
-    for remote, roles_for_host in mgrs.remotes.iteritems():
-        for role in teuthology.cluster_roles_of_type(roles_for_host, 'mgr',
-                                                     cluster_name):
-            _, _, id_ = teuthology.split_role(role)
-            mgr_dir = '/var/lib/ceph/mgr/{cluster}-{id}'.format(
-                cluster=cluster_name,
-                id=id_,
-            )
-            remote.run(
+    if not restore:
+        run.wait(
+            mons.run(
                 args=[
-                    'sudo',
-                    'mkdir',
-                    '-p',
-                    mgr_dir,
-                    run.Raw('&&'),
-                    'sudo',
                     'adjust-ulimits',
                     'ceph-coverage',
                     coverage_dir,
-                    'ceph-authtool',
-                    '--create-keyring',
-                    '--gen-key',
-                    '--name=mgr.{id}'.format(id=id_),
-                    mgr_dir + '/keyring',
+                    'osdmaptool',
+                    '-c', conf_path,
+                    '--clobber',
+                    '--createsimple', '{num:d}'.format(
+                        num=teuthology.num_instances_of_type(ctx.cluster, 'osd',
+                                                             cluster_name),
+                    ),
+                    osdmap_path,
+                    '--pg_bits', '2',
+                    '--pgp_bits', '4',
                 ],
-            )
+                wait=False,
+            ),
+        )
 
-    log.info('Setting up mds nodes...')
-    mdss = ctx.cluster.only(teuthology.is_type('mds', cluster_name))
-    for remote, roles_for_host in mdss.remotes.iteritems():
-        for role in teuthology.cluster_roles_of_type(roles_for_host, 'mds',
-                                                     cluster_name):
-            _, _, id_ = teuthology.split_role(role)
-            mds_dir = '/var/lib/ceph/mds/{cluster}-{id}'.format(
-                cluster=cluster_name,
-                id=id_,
-            )
-            remote.run(
-                args=[
-                    'sudo',
-                    'mkdir',
-                    '-p',
-                    mds_dir,
-                    run.Raw('&&'),
-                    'sudo',
-                    'adjust-ulimits',
-                    'ceph-coverage',
-                    coverage_dir,
-                    'ceph-authtool',
-                    '--create-keyring',
-                    '--gen-key',
-                    '--name=mds.{id}'.format(id=id_),
-                    mds_dir + '/keyring',
-                ],
-            )
+        log.info('Setting up mgr nodes...')
+        mgrs = ctx.cluster.only(teuthology.is_type('mgr', cluster_name))
+        for remote, roles_for_host in mgrs.remotes.iteritems():
+            for role in teuthology.cluster_roles_of_type(roles_for_host, 'mgr',
+                                                         cluster_name):
+                _, _, id_ = teuthology.split_role(role)
+                mgr_dir = '/var/lib/ceph/mgr/{cluster}-{id}'.format(
+                    cluster=cluster_name,
+                    id=id_,
+                )
+                remote.run(
+                    args=[
+                        'sudo',
+                        'mkdir',
+                        '-p',
+                        mgr_dir,
+                        run.Raw('&&'),
+                        'sudo',
+                        'adjust-ulimits',
+                        'ceph-coverage',
+                        coverage_dir,
+                        'ceph-authtool',
+                        '--create-keyring',
+                        '--gen-key',
+                        '--name=mgr.{id}'.format(id=id_),
+                        mgr_dir + '/keyring',
+                    ],
+                )
 
-    cclient.create_keyring(ctx, cluster_name)
+        log.info('Setting up mds nodes...')
+        mdss = ctx.cluster.only(teuthology.is_type('mds', cluster_name))
+        for remote, roles_for_host in mdss.remotes.iteritems():
+            for role in teuthology.cluster_roles_of_type(roles_for_host, 'mds',
+                                                         cluster_name):
+                _, _, id_ = teuthology.split_role(role)
+                mds_dir = '/var/lib/ceph/mds/{cluster}-{id}'.format(
+                    cluster=cluster_name,
+                    id=id_,
+                )
+                remote.run(
+                    args=[
+                        'sudo',
+                        'mkdir',
+                        '-p',
+                        mds_dir,
+                        run.Raw('&&'),
+                        'sudo',
+                        'adjust-ulimits',
+                        'ceph-coverage',
+                        coverage_dir,
+                        'ceph-authtool',
+                        '--create-keyring',
+                        '--gen-key',
+                        '--name=mds.{id}'.format(id=id_),
+                        mds_dir + '/keyring',
+                    ],
+                )
+
+        cclient.create_keyring(ctx, cluster_name)
     log.info('Running mkfs on osd nodes...')
 
     if not hasattr(ctx, 'disk_config'):
@@ -693,180 +696,213 @@ def cluster(ctx, config):
     teuthology.deep_merge(ctx.disk_config.remote_to_roles_to_journals, remote_to_roles_to_journals)
 
     log.info("ctx.disk_config.remote_to_roles_to_dev: {r}".format(r=str(ctx.disk_config.remote_to_roles_to_dev)))
-    for remote, roles_for_host in osds.remotes.iteritems():
+    mkfs_timings = ctx.summary.setdefault(
+        'mkfs_timings', {}).setdefault(cluster_name, {})
+
+    def mkfs_osd(remote, role):
+        """
+        Make, mount and populate the data directory of one osd.
+        """
+        timings = mkfs_timings[role] = {}
         roles_to_devs = remote_to_roles_to_devs[remote]
         roles_to_journals = remote_to_roles_to_journals[remote]
-
-        for role in teuthology.cluster_roles_of_type(roles_for_host, 'osd', cluster_name):
-            _, _, id_ = teuthology.split_role(role)
-            mnt_point = '/var/lib/ceph/osd/{cluster}-{id}'.format(cluster=cluster_name, id=id_)
-            remote.run(
-                args=[
-                    'sudo',
-                    'mkdir',
-                    '-p',
-                    mnt_point,
-                ])
-            log.info(str(roles_to_journals))
-            log.info(role)
-            if roles_to_devs.get(role):
-                dev = roles_to_devs[role]
-                fs = config.get('fs')
-                package = None
-                mkfs_options = config.get('mkfs_options')
-                mount_options = config.get('mount_options')
-                if fs == 'btrfs':
-                    # package = 'btrfs-tools'
-                    if mount_options is None:
-                        mount_options = ['noatime', 'user_subvol_rm_allowed']
-                    if mkfs_options is None:
-                        mkfs_options = ['-m', 'single',
-                                        '-l', '32768',
-                                        '-n', '32768']
-                if fs == 'xfs':
-                    # package = 'xfsprogs'
-                    if mount_options is None:
-                        mount_options = ['noatime']
-                    if mkfs_options is None:
-                        mkfs_options = ['-f', '-i', 'size=2048']
-                if fs == 'ext4' or fs == 'ext3':
-                    if mount_options is None:
-                        mount_options = ['noatime', 'user_xattr']
-
+        _, _, id_ = teuthology.split_role(role)
+        mnt_point = '/var/lib/ceph/osd/{cluster}-{id}'.format(cluster=cluster_name, id=id_)
+        remote.run(
+            args=[
+                'sudo',
+                'mkdir',
+                '-p',
+                mnt_point,
+            ])
+        log.info(str(roles_to_journals))
+        log.info(role)
+        if roles_to_devs.get(role):
+            dev = roles_to_devs[role]
+            fs = config.get('fs')
+            package = None
+            mkfs_options = config.get('mkfs_options')
+            mount_options = config.get('mount_options')
+            if fs == 'btrfs':
+                # package = 'btrfs-tools'
                 if mount_options is None:
-                    mount_options = []
+                    mount_options = ['noatime', 'user_subvol_rm_allowed']
                 if mkfs_options is None:
-                    mkfs_options = []
-                mkfs = ['mkfs.%s' % fs] + mkfs_options
-                log.info('%s on %s on %s' % (mkfs, dev, remote))
-                if package is not None:
-                    remote.run(
-                        args=[
-                            'sudo',
-                            'apt-get', 'install', '-y', package
-                        ],
-                        stdout=StringIO(),
-                    )
-
-                try:
-                    remote.run(args=['yes', run.Raw('|')] + ['sudo'] + mkfs + [dev])
-                except run.CommandFailedError:
-                    # Newer btfs-tools doesn't prompt for overwrite, use -f
-                    if '-f' not in mount_options:
-                        mkfs_options.append('-f')
-                        mkfs = ['mkfs.%s' % fs] + mkfs_options
-                        log.info('%s on %s on %s' % (mkfs, dev, remote))
-                    remote.run(args=['yes', run.Raw('|')] + ['sudo'] + mkfs + [dev])
-
-                log.info('mount %s on %s -o %s' % (dev, remote,
-                                                   ','.join(mount_options)))
+                    mkfs_options = ['-m', 'single',
+                                    '-l', '32768',
+                                    '-n', '32768']
+            if fs == 'xfs':
+                # package = 'xfsprogs'
+                if mount_options is None:
+                    mount_options = ['noatime']
+                if mkfs_options is None:
+                    mkfs_options = ['-f', '-i', 'size=2048']
+            if fs == 'ext4' or fs == 'ext3':
+                if mount_options is None:
+                    mount_options = ['noatime', 'user_xattr']
+
+            if mount_options is None:
+                mount_options = []
+            # copied, since the osds of all hosts are set up at once and
+            # a retry below adds to it
+            mkfs_options = list(mkfs_options or [])
+            mkfs = ['mkfs.%s' % fs] + mkfs_options
+            log.info('%s on %s on %s' % (mkfs, dev, remote))
+            if package is not None:
                 remote.run(
                     args=[
                         'sudo',
-                        'mount',
-                        '-t', fs,
-                        '-o', ','.join(mount_options),
-                        dev,
-                        mnt_point,
-                    ]
-                )
-                remote.run(
-                    args=[
-                        'sudo', '/sbin/restorecon', mnt_point,
+                        'apt-get', 'install', '-y', package
                     ],
-                    check_status=False,
+                    stdout=StringIO(),
                 )
-                if not remote in ctx.disk_config.remote_to_roles_to_dev_mount_options:
-                    ctx.disk_config.remote_to_roles_to_dev_mount_options[remote] = {}
-                ctx.disk_config.remote_to_roles_to_dev_mount_options[remote][role] = mount_options
-                if not remote in ctx.disk_config.remote_to_roles_to_dev_fstype:
-                    ctx.disk_config.remote_to_roles_to_dev_fstype[remote] = {}
-                ctx.disk_config.remote_to_roles_to_dev_fstype[remote][role] = fs
-                devs_to_clean[remote].append(mnt_point)
-
-        for role in teuthology.cluster_roles_of_type(roles_for_host, 'osd', cluster_name):
-            _, _, id_ = teuthology.split_role(role)
+
+            start = time.time()
+            try:
+                remote.run(args=['yes', run.Raw('|')] + ['sudo'] + mkfs + [dev])
+            except run.CommandFailedError:
+                # Newer btfs-tools doesn't prompt for overwrite, use -f
+                if '-f' not in mount_options:
+                    mkfs_options.append('-f')
+                    mkfs = ['mkfs.%s' % fs] + mkfs_options
+                    log.info('%s on %s on %s' % (mkfs, dev, remote))
+                remote.run(args=['yes', run.Raw('|')] + ['sudo'] + mkfs + [dev])
+            timings['mkfs'] = time.time() - start
+
+            log.info('mount %s on %s -o %s' % (dev, remote,
+                                               ','.join(mount_options)))
+            start = time.time()
             remote.run(
                 args=[
                     'sudo',
-                    'MALLOC_CHECK_=3',
-                    'adjust-ulimits',
-                    'ceph-coverage',
-                    coverage_dir,
-                    'ceph-osd',
-                    '--cluster',
-                    cluster_name,
-                    '--mkfs',
-                    '--mkkey',
-                    '-i', id_,
-                    '--monmap', monmap_path,
+                    'mount',
+                    '-t', fs,
+                    '-o', ','.join(mount_options),
+                    dev,
+                    mnt_point,
+                ]
+            )
+            remote.run(
+                args=[
+                    'sudo', '/sbin/restorecon', mnt_point,
                 ],
+                check_status=False,
             )
+            timings['mount'] = time.time() - start
+            if not remote in ctx.disk_config.remote_to_roles_to_dev_mount_options:
+                ctx.disk_config.remote_to_roles_to_dev_mount_options[remote] = {}
+            ctx.disk_config.remote_to_roles_to_dev_mount_options[remote][role] = mount_options
+            if not remote in ctx.disk_config.remote_to_roles_to_dev_fstype:
+                ctx.disk_config.remote_to_roles_to_dev_fstype[remote] = {}
+            ctx.disk_config.remote_to_roles_to_dev_fstype[remote][role] = fs
+            devs_to_clean[remote].append(mnt_point)
+
+        if restore:
+            return
+        start = time.time()
+        remote.run(
+            args=[
+                'sudo',
+                'MALLOC_CHECK_=3',
+                'adjust-ulimits',
+                'ceph-coverage',
+                coverage_dir,
+                'ceph-osd',
+                '--cluster',
+                cluster_name,
+                '--mkfs',
+                '--mkkey',
+                '-i', id_,
+                '--monmap', monmap_path,
+            ],
+        )
+        timings['ceph-osd --mkfs'] = time.time() - start
 
-    log.info('Reading keys from all nodes...')
-    keys_fp = StringIO()
-    keys = []
-    for remote, roles_for_host in ctx.cluster.remotes.iteritems():
-        for type_ in ['mgr',  'mds', 'osd']:
-            for role in teuthology.cluster_roles_of_type(roles_for_host, type_, cluster_name):
+    # the osds of every host, and the devices of each host, are set up
+    # at once
+    start = time.time()
+    with parallel() as p:
+        for remote, roles_for_host in osds.remotes.iteritems():
+            for role in teuthology.cluster_roles_of_type(roles_for_host, 'osd', cluster_name):
+                p.spawn(mkfs_osd, remote, role)
+    mkfs_timings['osds'] = time.time() - start
+    log.info('mkfs on osd nodes took {t:.1f}s'.format(t=mkfs_timings['osds']))
+
+    if restore:
+        log.info('Restoring the prebaked cluster...')
+        start = time.time()
+        prebaked.restore(data_dir, keyring_path, monmap_path, conf,
+                         mon0_remote)
+        mkfs_timings['restore'] = time.time() - start
+    else:
+        log.info('Reading keys from all nodes...')
+        keys_fp = StringIO()
+        keys = []
+        for remote, roles_for_host in ctx.cluster.remotes.iteritems():
+            for type_ in ['mgr',  'mds', 'osd']:
+                for role in teuthology.cluster_roles_of_type(roles_for_host, type_, cluster_name):
+                    _, _, id_ = teuthology.split_role(role)
+                    data = teuthology.get_file(
+                        remote=remote,
+                        path='/var/lib/ceph/{type}/{cluster}-{id}/keyring'.format(
+                            type=type_,
+                            id=id_,
+                            cluster=cluster_name,
+                        ),
+                        sudo=True,
+                    )
+                    keys.append((type_, id_, data))
+                    keys_fp.write(data)
+        for remote, roles_for_host in ctx.cluster.remotes.iteritems():
+            for role in teuthology.cluster_roles_of_type(roles_for_host, 'client', cluster_name):
                 _, _, id_ = teuthology.split_role(role)
                 data = teuthology.get_file(
                     remote=remote,
-                    path='/var/lib/ceph/{type}/{cluster}-{id}/keyring'.format(
-                        type=type_,
-                        id=id_,
-                        cluster=cluster_name,
-                    ),
-                    sudo=True,
+                    path='/etc/ceph/{cluster}.client.{id}.keyring'.format(id=id_, cluster=cluster_name)
                 )
-                keys.append((type_, id_, data))
+                keys.append(('client', id_, data))
                 keys_fp.write(data)
-    for remote, roles_for_host in ctx.cluster.remotes.iteritems():
-        for role in teuthology.cluster_roles_of_type(roles_for_host, 'client', cluster_name):
-            _, _, id_ = teuthology.split_role(role)
-            data = teuthology.get_file(
-                remote=remote,
-                path='/etc/ceph/{cluster}.client.{id}.keyring'.format(id=id_, cluster=cluster_name)
-            )
-            keys.append(('client', id_, data))
-            keys_fp.write(data)
-
-    log.info('Adding keys to all mons...')
-    writes = mons.run(
-        args=[
-            'sudo', 'tee', '-a',
-            keyring_path,
-        ],
-        stdin=run.PIPE,
-        wait=False,
-        stdout=StringIO(),
-    )
-    keys_fp.seek(0)
-    teuthology.feed_many_stdins_and_close(keys_fp, writes)
-    run.wait(writes)
-    for type_, id_, data in keys:
-        run.wait(
-            mons.run(
-                args=[
-                         'sudo',
-                         'adjust-ulimits',
-                         'ceph-coverage',
-                         coverage_dir,
-                         'ceph-authtool',
-                         keyring_path,
-                         '--name={type}.{id}'.format(
-                             type=type_,
-                             id=id_,
-                         ),
-                     ] + list(generate_caps(type_)),
-                wait=False,
-            ),
+
+        log.info('Adding keys to all mons...')
+        writes = mons.run(
+            args=[
+                'sudo', 'tee', '-a',
+                keyring_path,
+            ],
+            stdin=run.PIPE,
+            wait=False,
+            stdout=StringIO(),
         )
+        keys_fp.seek(0)
+        teuthology.feed_many_stdins_and_close(keys_fp, writes)
+        run.wait(writes)
+        for type_, id_, data in keys:
+            run.wait(
+                mons.run(
+                    args=[
+                             'sudo',
+                             'adjust-ulimits',
+                             'ceph-coverage',
+                             coverage_dir,
+                             'ceph-authtool',
+                             keyring_path,
+                             '--name={type}.{id}'.format(
+                                 type=type_,
+                                 id=id_,
+                             ),
+                         ] + list(generate_caps(type_)),
+                    wait=False,
+                ),
+            )
+
+        log.info('Running mkfs on mon nodes...')
 
-    log.info('Running mkfs on mon nodes...')
-    for remote, roles_for_host in mons.remotes.iteritems():
-        for role in teuthology.cluster_roles_of_type(roles_for_host, 'mon', cluster_name):
+        def mkfs_mon(remote, role):
+            """
+            Create the data directory of one monitor.
+            """
             _, _, id_ = teuthology.split_role(role)
+            start = time.time()
             remote.run(
                 args=[
                     'sudo',
@@ -890,11 +926,24 @@ def cluster(ctx, config):
                     '--keyring', keyring_path,
                 ],
             )
+            mkfs_timings[role] = {'ceph-mon --mkfs': time.time() - start}
+
+        start = time.time()
+        with parallel() as p:
+            for remote, roles_for_host in mons.remotes.iteritems():
+                for role in teuthology.cluster_roles_of_type(roles_for_host, 'mon', cluster_name):
+                    p.spawn(mkfs_mon, remote, role)
+        mkfs_timings['mons'] = time.time() - start
+        log.info('mkfs on mon nodes took {t:.1f}s'.format(t=mkfs_timings['mons']))
+
+        if prebaked is not None:
+            prebaked.bake(fsid, mon0_remote, keyring_path)
 
     run.wait(
         mons.run(
             args=[
                 'rm',
+                '-f',
                 '--',
                 monmap_path,
                 osdmap_path,
@@ -942,8 +991,28 @@ def cluster(ctx, config):
                 return stdout
             return None
 
-        if first_in_ceph_log('\[ERR\]|\[WRN\]|\[SEC\]',
-                             config['log_whitelist']) is not None:
+        scan = log_scan.scan_log(
+            mon0_remote,
+            '/var/log/ceph/{cluster}.log'.format(cluster=cluster_name),
+            config['log_whitelist'])
+        if scan is not None:
+            ctx.summary.setdefault('cluster_log_scan', {})[cluster_name] = \
+                dict((key, scan[key])
+                     for key in ['bytes', 'seconds', 'bytes_per_sec'])
+            if scan['first']:
+                log.warning('Found errors (ERR|WRN|SEC) in cluster log')
+                ctx.summary['success'] = False
+                # use the most severe problem as the failure reason
+                if 'failure_reason' not in ctx.summary:
+                    for severity in log_scan.SEVERITIES:
+                        if severity in scan['first']:
+                            ctx.summary['failure_reason'] = \
+                                '"{match}" in cluster log'.format(
+                                    match=scan['first'][severity],
+                                )
+                            break
+        elif first_in_ceph_log('\[ERR\]|\[WRN\]|\[SEC\]',
+                               config['log_whitelist']) is not None:
             log.warning('Found errors (ERR|WRN|SEC) in cluster log')
             ctx.summary['success'] = False
             # use the most severe problem as the failure reason
@@ -1039,10 +1108,12 @@ def osd_scrub_pgs(ctx, config):
     Scrub pgs when we exit.
 
     First make sure all pgs are active and clean.
-    Next scrub all osds.
-    Then periodically check until all pgs have scrub time stamps that
-    indicate the last scrub completed.  Time out if no progess is made
-    here after two minutes.
+    Next deep scrub every pg, scrub_max_in_flight (default 4) at a time
+    on each primary osd, until all pgs have a new deep scrub stamp.
+    Request a scrub again if it has not finished after
+    scrub_retry_timeout (default 60) seconds, and give up once no pg has
+    finished its scrub for scrub_stall_timeout (default 120) seconds.  The scrub time of each pg and the throughput
+    of the round go in the job summary under osd_scrub.
     """
     retries = 12
     delays = 10
@@ -1060,38 +1131,29 @@ def osd_scrub_pgs(ctx, config):
     if not all_clean:
         log.info("Scrubbing terminated -- not all pgs were active and clean.")
         return
-    check_time_now = time.localtime()
-    time.sleep(1)
-    all_roles = teuthology.all_roles(ctx.cluster)
-    for role in teuthology.cluster_roles_of_type(all_roles, 'osd', cluster_name):
-        log.info("Scrubbing {osd}".format(osd=role))
-        _, _, id_ = teuthology.split_role(role)
-        manager.raw_cluster_cmd('osd', 'deep-scrub', id_)
-    prev_good = 0
-    gap_cnt = 0
-    loop = True
-    while loop:
-        stats = manager.get_pg_stats()
-        timez = [stat['last_scrub_stamp'] for stat in stats]
-        loop = False
-        thiscnt = 0
-        for tmval in timez:
-            pgtm = time.strptime(tmval[0:tmval.find('.')], '%Y-%m-%d %H:%M:%S')
-            if pgtm > check_time_now:
-                thiscnt += 1
-            else:
-                loop = True
-        if thiscnt > prev_good:
-            prev_good = thiscnt
-            gap_cnt = 0
-        else:
-            gap_cnt += 1
-            if gap_cnt > retries:
-                log.info('Exiting scrub checking -- not all pgs scrubbed.')
-                return
-        if loop:
-            log.info('Still waiting for all pgs to be scrubbed.')
-            time.sleep(delays)
+    tracker = scrub_tracker.ScrubTracker(
+        stats, config.get('scrub_max_in_flight', 4),
+        config.get('scrub_retry_timeout', 60))
+    stall_timeout = config.get('scrub_stall_timeout', 120)
+    waiter = manager.map_change_waiter()
+    start = last_progress = time.time()
+    while not tracker.done:
+        for pgid in tracker.dispatch(time.time()):
+            manager.raw_cluster_cmd('pg', 'deep-scrub', pgid)
+        waiter.wait()
+        now = time.time()
+        if tracker.update(manager.get_pg_stats(), now):
+            last_progress = now
+        elif now - last_progress > stall_timeout:
+            log.info('Exiting scrub checking -- not all pgs scrubbed.')
+            break
+        if not tracker.done:
+            log.info('Still waiting for {n} pgs to be scrubbed.'.format(
+                n=len(tracker.unscrubbed)))
+    report = tracker.report(time.time() - start)
+    ctx.summary.setdefault('osd_scrub', {})[cluster_name] = report
+    log.info('Scrubbed {pgs} pgs in {seconds:.1f}s ({pgs_per_sec:.2f} pgs/s, '
+             '{bytes_per_sec:.0f} B/s)'.format(**report))
 
 
 @contextlib.contextmanager
@@ -1102,6 +1164,11 @@ def run_daemon(ctx, config, type_):
     and a max_mds value for one mds.
     On cleanup -- Stop all existing daemons of this type.
 
+    The daemons of each remote are started concurrently with those of
+    the other remotes, and their admin sockets probed until they report
+    ready (or for daemon_ready_timeout seconds, 0 to not wait).  The
+    time each took goes in the job summary under daemon_startup.
+
     :param ctx: Context
     :param config: Configuration
     :paran type_: Role type
@@ -1120,7 +1187,12 @@ def run_daemon(ctx, config, type_):
     if config.get('coverage') or config.get('valgrind') is not None:
         daemon_signal = 'term'
 
-    for remote, roles_for_host in daemons.remotes.iteritems():
+    ready_timeout = config.get('daemon_ready_timeout', 300)
+    startup = ctx.summary.setdefault('daemon_startup', {}).setdefault(
+        cluster_name, {})
+
+    def start_daemons(remote, roles_for_host):
+        started = []
         is_type_ = teuthology.is_type(type_, cluster_name)
         for role in roles_for_host:
             if not is_type_(role):
@@ -1164,6 +1236,15 @@ def run_daemon(ctx, config, type_):
                                    stdin=run.PIPE,
                                    wait=False,
                                    )
+            started.append((role, type_, id_))
+
+        if ready_timeout and started:
+            startup.update(daemon_ready.wait_ready(
+                remote, cluster_name, started, timeout=ready_timeout))
+
+    with parallel() as p:
+        for remote, roles_for_host in daemons.remotes.iteritems():
+            p.spawn(start_daemons, remote, roles_for_host)
 
     try:
         yield
@@ -1496,6 +1577,77 @@ def task(ctx, config):
         - ceph:
             log-whitelist: ['foo.*bar', 'bad message']
 
+    To send the cluster commands issued through the CephManager over a
+    single long-lived monitor session instead of running the ceph CLI
+    for each of them, use::
+
+        tasks:
+        - ceph:
+            mon_command_channel: true
+
+    The CephManager waits (wait_for_clean, wait_for_recovery, ...) follow
+    ``ceph -w`` and poll the cluster again as soon as a new osdmap or
+    pgmap is announced, falling back to polling every few seconds when
+    ``ceph -w`` does not announce map changes.  To always poll, use::
+
+        tasks:
+        - ceph:
+            map_event_waits: false
+
+    wait_for_clean and wait_for_recovery record the recovery rates and
+    degraded/misplaced object counts they see, and write them to
+    recovery/ in the job archive.  Once recovery has been seen to make
+    progress, a wait fails after stalling for recovery_eta_factor times
+    the estimated remaining recovery time (but no less than
+    recovery_eta_floor seconds) rather than for its whole timeout::
+
+        tasks:
+        - ceph:
+            recovery_eta_factor: 4
+            recovery_eta_floor: 120
+
+    ``ceph pg dump`` output is streamed and only the pg fields the tasks
+    use are kept.  To get the full pg stats dicts instead, use::
+
+        tasks:
+        - ceph:
+            compact_pg_dump: false
+
+    Unless wait-for-scrub is false, every pg is deep scrubbed when the
+    task ends.  To change how many scrubs are handed to each osd at a
+    time, how long a scrub may take before it is requested again, or
+    how long to wait for a scrub to finish before giving up, use::
+
+        tasks:
+        - ceph:
+            scrub_max_in_flight: 8
+            scrub_retry_timeout: 300
+            scrub_stall_timeout: 600
+
+    The daemons of each type are started on all nodes at once, and the
+    task waits for each of them to report over its admin socket that it
+    is ready (an osd active, a mon in quorum...) before moving on, for
+    up to daemon_ready_timeout seconds (0 to not wait)::
+
+        tasks:
+        - ceph:
+            daemon_ready_timeout: 600
+
+    To save the keyrings, mon stores and freshly made osd data
+    directories of a cluster the first time it is built, and unpack
+    them instead of building them again in later jobs with the same
+    ceph sha1, roles, objectstore, fs and conf, use::
+
+        tasks:
+        - ceph:
+            prebaked_cluster:
+              cache_dir: /path/on/the/teuthology/host
+
+    (``prebaked_cluster: true`` uses ~/.cache/teuthology/prebaked).  The
+    cluster is built as usual when the image is missing, when the sha1
+    is unknown, with block_journal or tmpfs_journal, or with bluestore
+    osds.
+
     To run multiple ceph clusters, use multiple ceph tasks, and roles
     with a cluster name prefix, e.g. cluster1.client.0. Roles with no
     cluster use the default cluster name, 'ceph'. OSDs from separate
@@ -1569,6 +1721,8 @@ def task(ctx, config):
             log_whitelist=config.get('log-whitelist', []),
             cpu_profile=set(config.get('cpu_profile', []),),
             cluster=config['cluster'],
+            prebaked_cluster=config.get('prebaked_cluster', False),
+            sha1=config.get('sha1'),
         )),
         lambda: run_daemon(ctx=ctx, config=config, type_='mon'),
         lambda: run_daemon(ctx=ctx, config=config, type_='mgr'),
@@ -1586,6 +1740,13 @@ def task(ctx, config):
         ctx.managers[config['cluster']] = CephManager(
             mon,
             ctx=ctx,
+            config=dict(
+                mon_command_channel=config.get('mon_command_channel', False),
+                map_event_waits=config.get('map_event_waits', True),
+                recovery_eta_factor=config.get('recovery_eta_factor', 4),
+                recovery_eta_floor=config.get('recovery_eta_floor', 120),
+                compact_pg_dump=config.get('compact_pg_dump', True),
+            ),
             logger=log.getChild('ceph_manager.' + config['cluster']),
             cluster=config['cluster'],
         )
@@ -1596,5 +1757,9 @@ def task(ctx, config):
 
             yield
         finally:
-            if config.get('wait-for-scrub', True):
-                osd_scrub_pgs(ctx, config)
+            try:
+                if config.get('wait-for-scrub', True):
+                    osd_scrub_pgs(ctx, config)
+            finally:
+                ctx.managers[config['cluster']].stop_map_watcher()
+                ctx.managers[config['cluster']].close_mon_channel()
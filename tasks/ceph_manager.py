@@ -2,25 +2,39 @@
 ceph manager -- Thrasher and CephManager objects
 """
 from cStringIO import StringIO
-from functools import wraps
+from functools import partial, wraps
 import contextlib
+import inspect
 import random
 import signal
 import time
 import gevent
+import gevent.event
+import gevent.lock
 import base64
 import json
 import logging
+import re
 import threading
 import traceback
 import os
+import pipes
 from teuthology import misc as teuthology
 from tasks.scrub import Scrubber
 from util.rados import cmd_erasure_code_profile
+from util.mon_channel import MonCommandChannel, parse_ceph_args, read_only
+from util.recovery_series import RecoverySeries
+from util import rados_batch
+from util import thrash_trace
+from util import pg_move
+from util.thrash_pacing import ThrashPacer
+from util.osdmap_cache import OSDMapCache
+from util.pg_dump import PGStateIndex, parse_pg_dump
+from util.pg_dump import state_bits, substring_bits
 from util import get_remote
 from teuthology.contextutil import safe_while
-from teuthology.orchestra.remote import Remote
 from teuthology.orchestra import run
+from teuthology.parallel import parallel
 from teuthology.exceptions import CommandFailedError
 
 try:
@@ -95,6 +109,10 @@ def mount_osd_data(ctx, remote, cluster, osd):
             )
 
 
+# what Thrasher.pick_victim can rank osds by
+VICTIM_METRICS = ('pgs', 'primaries', 'bytes', 'degraded')
+
+
 class Thrasher:
     """
     Object used to thrash Ceph
@@ -117,6 +135,9 @@ class Thrasher:
         self.clean_wait = self.config.get('clean_wait', 0)
         self.minin = self.config.get("min_in", 3)
         self.chance_move_pg = self.config.get('chance_move_pg', 1.0)
+        self.pg_moves = self.config.get('pg_moves', 1)
+        self.pg_move_compression = self.config.get('pg_move_compression')
+        self.pg_move_stats = []
         self.sighup_delay = self.config.get('sighup_delay')
         self.optrack_toggle_delay = self.config.get('optrack_toggle_delay')
         self.dump_ops_enable = self.config.get('dump_ops_enable')
@@ -135,6 +156,44 @@ class Thrasher:
             self.log = tmp
         if self.config is None:
             self.config = dict()
+        self.replay_trace = None
+        self.seed = self.config.get('seed')
+        if self.config.get('replay'):
+            header, self.replay_trace = thrash_trace.load(
+                self.config['replay'])
+            self.seed = header['seed']
+            self.log('replaying {n} thrasher actions from {path}'.format(
+                n=len(self.replay_trace), path=self.config['replay']))
+        if self.seed is None:
+            self.seed = random.randint(0, 2 ** 32 - 1)
+        self.log('thrasher seed is {seed}'.format(seed=self.seed))
+        self.rng = random.Random(self.seed)
+        self.action_seq = 0
+        self.action_osd = None
+        self.action_pool = None
+        self.trace = None
+        archive = getattr(manager.ctx, 'archive', None)
+        if archive is not None and self.config.get('trace', True):
+            self.trace = thrash_trace.ThrashTrace(
+                os.path.join(archive, 'thrash',
+                             '{cluster}.trace.jsonl'.format(
+                                 cluster=self.cluster)),
+                self.seed, replay=self.config.get('replay'))
+        self.victim_strategy = self.config.get('victim_strategy', 'random')
+        assert self.victim_strategy in ('random', 'max', 'min'), \
+            'victim_strategy must be random, max or min'
+        self.victim_metric = self.config.get('victim_metric', 'pgs')
+        assert self.victim_metric in VICTIM_METRICS, \
+            'victim_metric must be one of {0}'.format(VICTIM_METRICS)
+        self.osd_loads = {}
+        self.pacer = None
+        if self.config.get('adaptive_pacing'):
+            self.pacer = ThrashPacer(
+                self.config.get("op_delay", 5),
+                self.config.get("clean_interval", 60),
+                target=self.config.get('target_degraded_fraction', 0.1),
+                min_delay=self.config.get('min_op_delay', 1),
+                max_delay=self.config.get('max_op_delay', 60))
         # prevent monitor from auto-marking things out while thrasher runs
         # try both old and new tell syntax, in case we are testing old code
         try:
@@ -188,7 +247,8 @@ class Thrasher:
         :mark_out: Mark out if true.
         """
         if osd is None:
-            osd = random.choice(self.live_osds)
+            osd = self.pick_victim(self.live_osds)
+        self.note_target(osd)
         self.log("Killing osd %s, live_osds are %s" % (str(osd),
                                                        str(self.live_osds)))
         self.live_osds.remove(osd)
@@ -204,14 +264,17 @@ class Thrasher:
             FSPATH = self.ceph_manager.get_filepath()
             JPATH = os.path.join(FSPATH, "journal")
             exp_osd = imp_osd = osd
-            exp_remote = imp_remote = remote
+            exp_remote = remote
             # If an older osd is available we'll move a pg from there
             if (len(self.dead_osds) > 1 and
-                    random.random() < self.chance_move_pg):
-                exp_osd = random.choice(self.dead_osds[:-1])
+                    self.rng.random() < self.chance_move_pg):
+                exp_osd = self.rng.choice(self.dead_osds[:-1])
                 exp_remote = self.ceph_manager.find_remote('osd', exp_osd)
+            tool_options = ("--log-file="
+                            "/var/log/ceph/objectstore_tool.\\$pid.log")
             if ('keyvaluestore_backend' in
                     self.ceph_manager.ctx.ceph[self.cluster].conf['osd']):
+                tool_options = "--type keyvaluestore " + tool_options
                 prefix = ("sudo adjust-ulimits ceph-objectstore-tool "
                           "--data-path {fpath} --journal-path {jpath} "
                           "--type keyvaluestore "
@@ -224,7 +287,6 @@ class Thrasher:
                           "--log-file="
                           "/var/log/ceph/objectstore_tool.\\$pid.log ".
                           format(fpath=FSPATH, jpath=JPATH))
-            cmd = (prefix + "--op list-pgs").format(id=exp_osd)
 
             # ceph-objectstore-tool might be temporarily absent during an 
             # upgrade - see http://tracker.ceph.com/issues/18014
@@ -237,82 +299,54 @@ class Thrasher:
                         break
                     log.debug("ceph-objectstore-tool binary not present, trying again")
 
-            proc = exp_remote.run(args=cmd, wait=True,
-                                  check_status=False, stdout=StringIO())
-            if proc.exitstatus:
-                raise Exception("ceph-objectstore-tool: "
-                                "exp list-pgs failure with status {ret}".
-                                format(ret=proc.exitstatus))
-            pgs = proc.stdout.getvalue().split('\n')[:-1]
+            pgs = self.list_pgs(prefix, exp_osd)
             if len(pgs) == 0:
                 self.log("No PGs found for osd.{osd}".format(osd=exp_osd))
                 return
-            pg = random.choice(pgs)
-            exp_path = teuthology.get_testdir(self.ceph_manager.ctx)
-            exp_path = os.path.join(exp_path, '{0}.data'.format(self.cluster))
-            exp_path = os.path.join(exp_path,
-                                    "exp.{pg}.{id}".format(
-                                        pg=pg,
-                                        id=exp_osd))
-            # export
-            cmd = prefix + "--op export --pgid {pg} --file {file}"
-            cmd = cmd.format(id=exp_osd, pg=pg, file=exp_path)
-            proc = exp_remote.run(args=cmd)
-            if proc.exitstatus:
-                raise Exception("ceph-objectstore-tool: "
-                                "export failure with status {ret}".
-                                format(ret=proc.exitstatus))
-            # remove
-            cmd = prefix + "--op remove --pgid {pg}"
-            cmd = cmd.format(id=exp_osd, pg=pg)
-            proc = exp_remote.run(args=cmd)
-            if proc.exitstatus:
-                raise Exception("ceph-objectstore-tool: "
-                                "remove failure with status {ret}".
-                                format(ret=proc.exitstatus))
+            pg = self.rng.choice(pgs)
             # If there are at least 2 dead osds we might move the pg
             if exp_osd != imp_osd:
                 # If pg isn't already on this osd, then we will move it there
-                cmd = (prefix + "--op list-pgs").format(id=imp_osd)
-                proc = imp_remote.run(args=cmd, wait=True,
-                                      check_status=False, stdout=StringIO())
-                if proc.exitstatus:
-                    raise Exception("ceph-objectstore-tool: "
-                                    "imp list-pgs failure with status {ret}".
-                                    format(ret=proc.exitstatus))
-                pgs = proc.stdout.getvalue().split('\n')[:-1]
-                if pg not in pgs:
-                    self.log("Moving pg {pg} from osd.{fosd} to osd.{tosd}".
-                             format(pg=pg, fosd=exp_osd, tosd=imp_osd))
-                    if imp_remote != exp_remote:
-                        # Copy export file to the other machine
-                        self.log("Transfer export file from {srem} to {trem}".
-                                 format(srem=exp_remote, trem=imp_remote))
-                        tmpexport = Remote.get_file(exp_remote, exp_path)
-                        Remote.put_file(imp_remote, tmpexport, exp_path)
-                        os.remove(tmpexport)
+                if pg not in self.list_pgs(prefix, imp_osd):
+                    moves = [(pg, exp_osd, imp_osd)]
+                    moves += self.pair_pg_moves(prefix, [exp_osd, imp_osd])
+                    self.move_pgs(prefix, moves)
+                    exp_osd = imp_osd = None
                 else:
                     # Can't move the pg after all
                     imp_osd = exp_osd
-                    imp_remote = exp_remote
-            # import
-            cmd = (prefix + "--op import --file {file}")
-            cmd = cmd.format(id=imp_osd, file=exp_path)
-            proc = imp_remote.run(args=cmd, wait=True, check_status=False)
-            if proc.exitstatus == 10:
-                self.log("Pool went away before processing an import"
-                         "...ignored")
-            elif proc.exitstatus == 11:
-                self.log("Attempt to import an incompatible export"
-                         "...ignored")
-            elif proc.exitstatus:
-                raise Exception("ceph-objectstore-tool: "
-                                "import failure with status {ret}".
-                                format(ret=proc.exitstatus))
-            cmd = "rm -f {file}".format(file=exp_path)
-            exp_remote.run(args=cmd)
-            if imp_remote != exp_remote:
-                imp_remote.run(args=cmd)
+            if exp_osd is not None:
+                exp_path = teuthology.get_testdir(self.ceph_manager.ctx)
+                exp_path = os.path.join(exp_path,
+                                        '{0}.data'.format(self.cluster))
+                exp_path = os.path.join(exp_path,
+                                        "exp.{pg}.{id}".format(
+                                            pg=pg,
+                                            id=exp_osd))
+                # export and remove in one go, then import, on the osd
+                # which is down already
+                tool = ObjectStoreTool(self.ceph_manager, None, osd=exp_osd,
+                                       do_revive=False,
+                                       tool_options=tool_options)
+                with tool.session(stop=False):
+                    tool.queue("--op export --pgid {pg} --file {file}".
+                               format(pg=pg, file=exp_path), "")
+                    tool.queue("--op remove --pgid {pg}".format(pg=pg), "")
+                    status = tool.run("--op import --file {file}".
+                                      format(file=exp_path), "",
+                                      check_status=False)
+                if status == 10:
+                    self.log("Pool went away before processing an import"
+                             "...ignored")
+                elif status == 11:
+                    self.log("Attempt to import an incompatible export"
+                             "...ignored")
+                elif status:
+                    raise Exception("ceph-objectstore-tool: "
+                                    "import failure with status {ret}".
+                                    format(ret=status))
+                cmd = "rm -f {file}".format(file=exp_path)
+                exp_remote.run(args=cmd)
 
             # apply low split settings to each pool
             for pool in self.ceph_manager.list_pools():
@@ -328,13 +362,109 @@ class Thrasher:
                     raise Exception("ceph-objectstore-tool apply-layout-settings"
                                     " failed with {status}".format(status=proc.exitstatus))
 
+    def list_pgs(self, prefix, osd):
+        """
+        Return the pgs held by a down osd.
+
+        :param prefix: ceph-objectstore-tool command line, with {id}
+        """
+        remote = self.ceph_manager.find_remote('osd', osd)
+        cmd = (prefix + "--op list-pgs").format(id=osd)
+        proc = remote.run(args=cmd, wait=True,
+                          check_status=False, stdout=StringIO())
+        if proc.exitstatus:
+            raise Exception("ceph-objectstore-tool: "
+                            "list-pgs failure on osd.{osd} with status {ret}".
+                            format(osd=osd, ret=proc.exitstatus))
+        return proc.stdout.getvalue().split('\n')[:-1]
+
+    def pair_pg_moves(self, prefix, busy):
+        """
+        Pick up to pg_moves - 1 more pg moves between pairs of dead
+        osds, each osd in at most one move and none of them in busy.
+        """
+        others = [o for o in self.dead_osds if o not in busy]
+        self.rng.shuffle(others)
+        moves = []
+        while len(moves) < self.pg_moves - 1 and len(others) >= 2:
+            src, dst = others.pop(), others.pop()
+            pgs = sorted(set(self.list_pgs(prefix, src)) -
+                         set(self.list_pgs(prefix, dst)))
+            if pgs:
+                moves.append((self.rng.choice(pgs), src, dst))
+        return moves
+
+    def move_pgs(self, prefix, moves):
+        """
+        Stream pgs between dead osds, several at once.
+
+        :param prefix: ceph-objectstore-tool command line, with {id}
+        :param moves: list of (pgid, from osd, to osd)
+        """
+        for pg, src, dst in moves:
+            self.log("Moving pg {pg} from osd.{fosd} to osd.{tosd}".
+                     format(pg=pg, fosd=src, tosd=dst))
+        mover = pg_move.PGMover(
+            lambda osd: prefix.format(id=osd),
+            lambda osd: self.ceph_manager.find_remote('osd', osd),
+            compression=self.pg_move_compression)
+        for result in mover.move_all(moves):
+            self.pg_move_stats.append(result)
+            if result['import_status'] == pg_move.IMPORT_POOL_GONE:
+                self.log("Pool went away before processing an import"
+                         "...ignored")
+            elif result['import_status'] == pg_move.IMPORT_INCOMPATIBLE:
+                self.log("Attempt to import an incompatible export"
+                         "...ignored")
+            elif not result['ok']:
+                raise Exception("ceph-objectstore-tool: moving pg {pgid} "
+                                "failed with export status {export_status}, "
+                                "import status {import_status}".
+                                format(**result))
+
+    def refresh_osd_loads(self):
+        """
+        Update the per-osd load figures used by pick_victim from the
+        current pg dump.  Called once per thrasher cycle.
+        """
+        if self.victim_strategy == 'random':
+            return
+        snapshot = self.ceph_manager.get_pg_snapshot()
+        self.osd_loads = snapshot.index.osd_loads()
+
+    def pick_victim(self, osds):
+        """
+        Choose an osd to kill or mark out.
+
+        With victim_strategy random every osd is equally likely.  With
+        max (or min), osds are favored in proportion to (the inverse
+        of) their victim_metric in the last refresh_osd_loads(): the
+        number of pgs, primaries, bytes or degraded pgs they hold.
+        """
+        if self.victim_strategy == 'random' or not self.osd_loads:
+            return self.rng.choice(osds)
+        weights = []
+        for osd in osds:
+            load = self.osd_loads.get(osd, {}).get(self.victim_metric, 0)
+            if self.victim_strategy == 'max':
+                weights.append(load + 1.0)
+            else:
+                weights.append(1.0 / (load + 1.0))
+        val = self.rng.uniform(0, sum(weights))
+        for osd, weight in zip(osds, weights):
+            if val < weight:
+                return osd
+            val -= weight
+        return osds[-1]
+
     def rm_past_intervals(self, osd=None):
         """
         :param osd: Osd to find pg to remove past intervals
         """
         if self.test_rm_past_intervals:
             if osd is None:
-                osd = random.choice(self.dead_osds)
+                osd = self.rng.choice(self.dead_osds)
+            self.note_target(osd)
             self.log("Use ceph_objectstore_tool to remove past intervals")
             remote = self.ceph_manager.find_remote('osd', osd)
             FSPATH = self.ceph_manager.get_filepath()
@@ -364,7 +494,7 @@ class Thrasher:
             if len(pgs) == 0:
                 self.log("No PGs found for osd.{osd}".format(osd=osd))
                 return
-            pg = random.choice(pgs)
+            pg = self.rng.choice(pgs)
             cmd = (prefix + "--op rm-past-intervals --pgid {pg}").\
                 format(id=osd, pg=pg)
             proc = remote.run(args=cmd)
@@ -379,7 +509,7 @@ class Thrasher:
         :param osd: Osd to be killed.
         """
         if osd is None:
-            osd = random.choice(self.live_osds)
+            osd = self.rng.choice(self.live_osds)
         self.log("Blackholing and then killing osd %s, live_osds are %s" %
                  (str(osd), str(self.live_osds)))
         self.live_osds.remove(osd)
@@ -392,7 +522,8 @@ class Thrasher:
         :param osd: Osd to be revived.
         """
         if osd is None:
-            osd = random.choice(self.dead_osds)
+            osd = self.rng.choice(self.dead_osds)
+        self.note_target(osd)
         self.log("Reviving osd %s" % (str(osd),))
         self.ceph_manager.revive_osd(
             osd,
@@ -407,7 +538,8 @@ class Thrasher:
         :param osd: Osd to be marked.
         """
         if osd is None:
-            osd = random.choice(self.in_osds)
+            osd = self.pick_victim(self.in_osds)
+        self.note_target(osd)
         self.log("Removing osd %s, in_osds are: %s" %
                  (str(osd), str(self.in_osds)))
         self.ceph_manager.mark_out_osd(osd)
@@ -420,7 +552,8 @@ class Thrasher:
         :param osd: Osd to be marked.
         """
         if osd is None:
-            osd = random.choice(self.out_osds)
+            osd = self.rng.choice(self.out_osds)
+        self.note_target(osd)
         if osd in self.dead_osds:
             return self.revive_osd(osd)
         self.log("Adding osd %s" % (str(osd),))
@@ -434,10 +567,11 @@ class Thrasher:
         Reweight an osd that is in
         :param osd: Osd to be marked.
         """
-        if osd is not None or random.choice([True, False]):
+        if osd is not None or self.rng.choice([True, False]):
             if osd is None:
-                osd = random.choice(self.in_osds)
-            val = random.uniform(.1, 1.0)
+                osd = self.rng.choice(self.in_osds)
+            self.note_target(osd)
+            val = self.rng.uniform(.1, 1.0)
             self.log("Reweighting osd %s to %s" % (str(osd), str(val)))
             self.ceph_manager.raw_cluster_cmd('osd', 'reweight',
                                               str(osd), str(val))
@@ -445,9 +579,9 @@ class Thrasher:
             # do it several times, the option space is large
             for i in range(5):
                 options = {
-                    'max_change': random.choice(['0.05', '1.0', '3.0']),
-                    'overage': random.choice(['110', '1000']),
-                    'type': random.choice([
+                    'max_change': self.rng.choice(['0.05', '1.0', '3.0']),
+                    'overage': self.rng.choice(['110', '1000']),
+                    'type': self.rng.choice([
                         'reweight-by-utilization',
                         'test-reweight-by-utilization']),
                 }
@@ -460,10 +594,11 @@ class Thrasher:
 
     def primary_affinity(self, osd=None):
         if osd is None:
-            osd = random.choice(self.in_osds)
-        if random.random() >= .5:
-            pa = random.random()
-        elif random.random() >= .5:
+            osd = self.rng.choice(self.in_osds)
+        self.note_target(osd)
+        if self.rng.random() >= .5:
+            pa = self.rng.random()
+        elif self.rng.random() >= .5:
             pa = 1
         else:
             pa = 0
@@ -471,6 +606,79 @@ class Thrasher:
         self.ceph_manager.raw_cluster_cmd('osd', 'primary-affinity',
                                           str(osd), str(pa))
 
+    def thrash_group(self, osd=None):
+        """
+        Kill, revive, mark out or mark in several osds of one failure
+        domain at once, to exercise correlated failures.  The failure
+        domain is a crush bucket type, by default host.
+
+        :param osd: list of the osds to act on, instead of the osds of
+                    a random failure domain (for replay)
+        """
+        if osd is None:
+            domains = self.ceph_manager.get_osd_failure_domains(
+                self.config.get('failure_domain', 'host'))
+            if not domains:
+                self.log('thrash_group: no failure domains found')
+                return
+            osd = sorted(domains[self.rng.choice(sorted(domains))])
+            group_size = self.config.get('group_size', 0)
+            if group_size and group_size < len(osd):
+                osd = sorted(self.rng.sample(osd, group_size))
+        self.note_target(osd)
+        minlive = self.config.get("min_live", 2)
+        live = [o for o in osd if o in self.live_osds]
+        dead = [o for o in osd if o in self.dead_osds]
+        in_ = [o for o in osd if o in self.in_osds]
+        out = [o for o in osd if o in self.out_osds and o in self.live_osds]
+        choices = []
+        if live and len(self.live_osds) - len(live) >= minlive:
+            choices.append('kill')
+        if dead:
+            choices.append('revive')
+        if in_ and len(self.in_osds) - len(in_) >= self.minin:
+            choices.append('out')
+        if out:
+            choices.append('in')
+        if not choices:
+            self.log('thrash_group: nothing to do to osds %s' % (osd,))
+            return
+        op = self.rng.choice(choices)
+        start = time.time()
+        if op == 'kill':
+            self.log('Killing osds %s together' % (live,))
+            for o in live:
+                self.live_osds.remove(o)
+                self.dead_osds.append(o)
+            self.ceph_manager.kill_osds(live)
+        elif op == 'revive':
+            self.log('Reviving osds %s together' % (dead,))
+            self.ceph_manager.revive_osds(dead, self.revive_timeout)
+            for o in dead:
+                self.dead_osds.remove(o)
+                self.live_osds.append(o)
+        elif op == 'out':
+            self.log('Removing osds %s together' % (in_,))
+            self.ceph_manager.raw_cluster_cmd('osd', 'out', *map(str, in_))
+            for o in in_:
+                self.in_osds.remove(o)
+                self.out_osds.append(o)
+        else:
+            self.log('Adding osds %s together' % (out,))
+            self.ceph_manager.raw_cluster_cmd('osd', 'in', *map(str, out))
+            for o in out:
+                self.out_osds.remove(o)
+                self.in_osds.append(o)
+        self.log('thrash_group: {op} took {t:.1f}s'.format(
+            op=op, t=time.time() - start))
+        if op in ('kill', 'out') and self.config.get('group_wait_recovery'):
+            start = time.time()
+            self.ceph_manager.wait_for_recovery(
+                timeout=self.config.get('timeout'))
+            self.log('thrash_group: recovered from {op} of {n} osds in '
+                     '{t:.1f}s'.format(op=op, n=len(osd),
+                                       t=time.time() - start))
+
     def all_up(self):
         """
         Make sure all osds are up and not out.
@@ -501,21 +709,25 @@ class Thrasher:
             self.log("joining the do_noscrub_toggle greenlet")
             self.noscrub_toggle_thread.join()
 
-    def grow_pool(self):
+    def grow_pool(self, pool=None):
         """
         Increase the size of the pool
         """
-        pool = self.ceph_manager.get_pool()
+        if pool is None:
+            pool = self.ceph_manager.get_pool(self.rng)
+        self.note_pool(pool)
         self.log("Growing pool %s" % (pool,))
         self.ceph_manager.expand_pool(pool,
                                       self.config.get('pool_grow_by', 10),
                                       self.max_pgs)
 
-    def fix_pgp_num(self):
+    def fix_pgp_num(self, pool=None):
         """
         Fix number of pgs in pool.
         """
-        pool = self.ceph_manager.get_pool()
+        if pool is None:
+            pool = self.ceph_manager.get_pool(self.rng)
+        self.note_pool(pool)
         self.log("fixing pg num pool %s" % (pool,))
         self.ceph_manager.set_pool_pgpnum(pool)
 
@@ -528,7 +740,7 @@ class Thrasher:
         self.ceph_manager.wait_for_recovery(
             timeout=self.config.get('timeout')
             )
-        the_one = random.choice(self.in_osds)
+        the_one = self.rng.choice(self.in_osds)
         self.log("Killing everyone but %s", the_one)
         to_kill = filter(lambda x: x != the_one, self.in_osds)
         [self.kill_osd(i) for i in to_kill]
@@ -546,11 +758,15 @@ class Thrasher:
             timeout=self.config.get('timeout')
             )
 
-    def inject_pause(self, conf_key, duration, check_after, should_be_down):
+    def inject_pause(self, conf_key, duration, check_after, should_be_down,
+                     osd=None):
         """
         Pause injection testing. Check for osd being down when finished.
         """
-        the_one = random.choice(self.live_osds)
+        the_one = osd
+        if the_one is None:
+            the_one = self.rng.choice(self.live_osds)
+        self.note_target(the_one)
         self.log("inject_pause on {osd}".format(osd=the_one))
         self.log(
             "Testing {key} pause injection for duration {duration}".format(
@@ -590,7 +806,7 @@ class Thrasher:
             self.ceph_manager.set_config(
                 i,
                 osd_debug_skip_full_check_in_backfill_reservation=
-                random.choice(['false', 'true']),
+                self.rng.choice(['false', 'true']),
                 osd_backfill_full_ratio=0)
         for i in range(30):
             status = self.ceph_manager.compile_pg_status()
@@ -673,6 +889,10 @@ class Thrasher:
             actions.append((self.revive_osd, 1.0,))
         if self.config.get('thrash_primary_affinity', True):
             actions.append((self.primary_affinity, 1.0,))
+        if not self.config.get('powercycle'):
+            # powercycling takes down whole hosts already
+            actions.append((self.thrash_group,
+                            self.config.get('chance_thrash_group', 0),))
         actions.append((self.reweight_osd_or_by_util,
                         self.config.get('reweight_osd', .5),))
         actions.append((self.grow_pool,
@@ -685,22 +905,22 @@ class Thrasher:
                         chance_test_backfill_full,))
         for key in ['heartbeat_inject_failure', 'filestore_inject_stall']:
             for scenario in [
-                (lambda:
-                 self.inject_pause(key,
-                                   self.config.get('pause_short', 3),
-                                   0,
-                                   False),
+                (partial(self.inject_pause,
+                         key,
+                         self.config.get('pause_short', 3),
+                         0,
+                         False),
                  self.config.get('chance_inject_pause_short', 1),),
-                (lambda:
-                 self.inject_pause(key,
-                                   self.config.get('pause_long', 80),
-                                   self.config.get('pause_check_after', 70),
-                                   True),
+                (partial(self.inject_pause,
+                         key,
+                         self.config.get('pause_long', 80),
+                         self.config.get('pause_check_after', 70),
+                         True),
                  self.config.get('chance_inject_pause_long', 0),)]:
                 actions.append(scenario)
 
         total = sum([y for (x, y) in actions])
-        val = random.uniform(0, total)
+        val = self.rng.uniform(0, total)
         for (action, prob) in actions:
             if val < prob:
                 return action
@@ -726,8 +946,11 @@ class Thrasher:
         """
         delay = float(self.sighup_delay)
         self.log("starting do_sighup with a delay of {0}".format(delay))
+        # seeded like the actions, but with a generator of its own: this
+        # loop runs beside do_thrash, whose draws must not depend on it
+        rng = random.Random(self.seed + 1)
         while not self.stopping:
-            osd = random.choice(self.live_osds)
+            osd = rng.choice(self.live_osds)
             self.ceph_manager.signal_osd(osd, signal.SIGHUP, silent=True)
             time.sleep(delay)
 
@@ -757,14 +980,14 @@ class Thrasher:
         """
         self.log("starting do_dump_ops")
         while not self.stopping:
-            for osd in self.live_osds:
-                # Ignore errors because live_osds is in flux
-                self.ceph_manager.osd_admin_socket(osd, command=['dump_ops_in_flight'],
-                                     check_status=False, timeout=30, stdout=DEVNULL)
-                self.ceph_manager.osd_admin_socket(osd, command=['dump_blocked_ops'],
-                                     check_status=False, timeout=30, stdout=DEVNULL)
-                self.ceph_manager.osd_admin_socket(osd, command=['dump_historic_ops'],
-                                     check_status=False, timeout=30, stdout=DEVNULL)
+            # Ignore errors because live_osds is in flux
+            self.ceph_manager.admin_socket_batch(
+                [('osd', osd, [command])
+                 for osd in self.live_osds
+                 for command in ['dump_ops_in_flight',
+                                 'dump_blocked_ops',
+                                 'dump_historic_ops']],
+                timeout=30)
             gevent.sleep(0)
 
     @log_exc
@@ -794,6 +1017,90 @@ class Thrasher:
         self.ceph_manager.raw_cluster_cmd('osd', 'unset', 'noscrub')
         self.ceph_manager.raw_cluster_cmd('osd', 'unset', 'nodeep-scrub')
 
+    def reseed(self, target_picked=False):
+        """
+        Reseed the random number generator from the thrasher seed and
+        the sequence number of the running action, so that the action
+        makes the same random choices when it is replayed.
+        """
+        self.rng.seed((self.seed << 21) + (self.action_seq << 1) +
+                      int(target_picked))
+
+    def note_target(self, osd):
+        """
+        Remember the osd the running action picked, for the trace.
+        Nested actions (kill_osd marking its osd out...) keep the
+        outermost target.
+        """
+        if self.action_osd is None:
+            self.action_osd = osd
+            # a replayed action is handed its target instead of drawing
+            # it; the draws which follow must not depend on that
+            self.reseed(target_picked=True)
+
+    def note_pool(self, pool):
+        """
+        Remember the pool the running action picked, for the trace.
+        """
+        if self.action_pool is None:
+            self.action_pool = pool
+            self.reseed(target_picked=True)
+
+    def run_action(self, action, *args, **kwargs):
+        """
+        Run one thrasher action and append it to the trace.
+        """
+        if isinstance(action, partial):
+            args = action.args + args
+            action = action.func
+        self.action_seq += 1
+        self.reseed()
+        self.action_osd = None
+        self.action_pool = None
+        epoch_before = epoch_after = None
+        if self.trace is not None:
+            epoch_before = self.ceph_manager.get_osd_epoch()
+        start = time.time()
+        try:
+            action(*args, **kwargs)
+        finally:
+            duration = time.time() - start
+            if self.trace is not None:
+                try:
+                    epoch_after = self.ceph_manager.get_osd_epoch()
+                except Exception:
+                    self.log('could not get the osdmap epoch for the trace')
+                self.trace.record(self.action_seq, start, action.__name__,
+                                  args, self.action_osd, duration,
+                                  epoch_before, epoch_after,
+                                  pool=self.action_pool)
+
+    def clean_up(self, map_discontinuity=False, scrub=False):
+        """
+        Revive dead osds down to max_dead, reset the osd weights and let
+        the cluster recover.
+
+        :param map_discontinuity: run test_map_discontinuity instead of
+                                  just waiting for recovery
+        :param scrub: scrub once recovered
+        """
+        maxdead = self.config.get("max_dead", 0)
+        while len(self.dead_osds) > maxdead:
+            self.revive_osd()
+        for osd in self.in_osds:
+            self.ceph_manager.raw_cluster_cmd('osd', 'reweight',
+                                              str(osd), str(1))
+        if map_discontinuity:
+            self.test_map_discontinuity()
+        else:
+            self.ceph_manager.wait_for_recovery(
+                timeout=self.config.get('timeout')
+                )
+        time.sleep(self.clean_wait)
+        if scrub:
+            self.log('Scrubbing while thrashing being performed')
+            Scrubber(self.ceph_manager, self.config)
+
     @log_exc
     def do_thrash(self):
         """
@@ -801,36 +1108,66 @@ class Thrasher:
         """
         cleanint = self.config.get("clean_interval", 60)
         scrubint = self.config.get("scrub_interval", -1)
-        maxdead = self.config.get("max_dead", 0)
         delay = self.config.get("op_delay", 5)
         self.log("starting do_thrash")
-        while not self.stopping:
-            to_log = [str(x) for x in ["in_osds: ", self.in_osds,
-                                       "out_osds: ", self.out_osds,
-                                       "dead_osds: ", self.dead_osds,
-                                       "live_osds: ", self.live_osds]]
-            self.log(" ".join(to_log))
-            if random.uniform(0, 1) < (float(delay) / cleanint):
-                while len(self.dead_osds) > maxdead:
-                    self.revive_osd()
-                for osd in self.in_osds:
-                    self.ceph_manager.raw_cluster_cmd('osd', 'reweight',
-                                                      str(osd), str(1))
-                if random.uniform(0, 1) < float(
-                        self.config.get('chance_test_map_discontinuity', 0)):
-                    self.test_map_discontinuity()
-                else:
-                    self.ceph_manager.wait_for_recovery(
-                        timeout=self.config.get('timeout')
-                        )
-                time.sleep(self.clean_wait)
-                if scrubint > 0:
-                    if random.uniform(0, 1) < (float(delay) / scrubint):
-                        self.log('Scrubbing while thrashing being performed')
-                        Scrubber(self.ceph_manager, self.config)
-            self.choose_action()()
-            time.sleep(delay)
-        self.all_up()
+        try:
+            if self.replay_trace is not None:
+                self.replay()
+            while not self.stopping and self.replay_trace is None:
+                to_log = [str(x) for x in ["in_osds: ", self.in_osds,
+                                           "out_osds: ", self.out_osds,
+                                           "dead_osds: ", self.dead_osds,
+                                           "live_osds: ", self.live_osds]]
+                self.log(" ".join(to_log))
+                self.refresh_osd_loads()
+                clean_chance = float(delay) / cleanint
+                if self.pacer is not None:
+                    delay = self.pacer.update(
+                        self.ceph_manager.get_pgmap_summary())
+                    clean_chance = self.pacer.clean_chance
+                    self.log('pacing: degraded fraction {f:.3f}, delay '
+                             '{d:.1f}s, clean chance {c:.2f}'.format(
+                                 f=self.pacer.fraction, d=delay,
+                                 c=clean_chance))
+                if self.rng.uniform(0, 1) < clean_chance:
+                    map_discontinuity = self.rng.uniform(0, 1) < float(
+                        self.config.get('chance_test_map_discontinuity', 0))
+                    scrub = (scrubint > 0 and
+                             self.rng.uniform(0, 1) < (float(delay) / scrubint))
+                    self.run_action(self.clean_up, map_discontinuity, scrub)
+                self.run_action(self.choose_action())
+                time.sleep(delay)
+            self.all_up()
+        finally:
+            if self.trace is not None:
+                self.trace.close()
+
+    def replay(self):
+        """
+        Run the actions of a recorded trace, each at the same offset
+        from the start of thrashing as when it was recorded.
+        """
+        start = time.time()
+        for record in self.replay_trace:
+            if self.stopping:
+                break
+            time.sleep(max(0, start + record['time'] - time.time()))
+            action = getattr(self, record['action'])
+            kwargs = {}
+            # the target of an action which does not take one (clean_up
+            # reviving osds...) was picked by a nested action, which
+            # picks it again the same way from the reseeded generator
+            argnames = inspect.getargspec(action).args
+            if record['osd'] is not None and 'osd' in argnames:
+                kwargs['osd'] = record['osd']
+            if record.get('pool') is not None and 'pool' in argnames:
+                kwargs['pool'] = record['pool']
+            self.action_seq = record['seq'] - 1
+            self.log('replaying {action} {args} {kwargs}'.format(
+                action=record['action'], args=record['args'],
+                kwargs=kwargs))
+            self.run_action(action, *record['args'], **kwargs)
+        self.log('thrasher trace replayed')
 
 
 class ObjectStoreTool:
@@ -845,7 +1182,7 @@ class ObjectStoreTool:
             if self.osd == "primary":
                 self.osd = self.manager.get_object_primary(self.pool,
                                                            self.object_name)
-        assert self.osd
+        assert self.osd is not None
         if self.object_name:
             self.pgid = self.manager.get_object_pg_with_shard(self.pool,
                                                               self.object_name,
@@ -855,22 +1192,96 @@ class ObjectStoreTool:
         path = self.manager.get_filepath().format(id=self.osd)
         self.paths = ("--data-path {path} --journal-path {path}/journal".
                       format(path=path))
+        if kwargs.get('tool_options'):
+            self.paths += ' ' + kwargs['tool_options']
+        self.in_session = False
+        self.listings = {}
+        self.queued = []
+
+    @contextlib.contextmanager
+    def session(self, stop=True):
+        """
+        Keep the osd down across several operations.
+
+        The osd is stopped on entry (unless stop is false, for an osd
+        which is down already) and, if do_revive, revived once on exit.
+        Within the session run() and list_objects() do not touch the
+        osd, the object listing of each pg is taken at most once, and
+        commands added with queue() run together in a single remote
+        shell when flush() is called or the session ends.
+        """
+        assert not self.in_session
+        if stop:
+            self.manager.kill_osd(self.osd)
+        self.in_session = True
+        try:
+            yield self
+            self.flush()
+        finally:
+            self.in_session = False
+            self.listings = {}
+            self.queued = []
+            if self.do_revive:
+                self.manager.revive_osd(self.osd)
+
+    def list_objects(self, pgid):
+        """
+        Return the ``--op list`` output lines for pgid, each the JSON
+        spec of one object.  Within a session the listing is cached
+        until an operation which could change it.
+        """
+        if self.queued:
+            self.flush()
+        if pgid in self.listings:
+            return self.listings[pgid]
+        stdout = StringIO()
+        self._run_cmd(self.tool_cmd("--pgid {pgid} --op list".
+                                    format(pgid=pgid), ""),
+                      stdout)
+        listing = [line for line in stdout.getvalue().splitlines()
+                   if line.strip()]
+        if self.in_session:
+            self.listings[pgid] = listing
+        return listing
+
+    def object_spec(self, pgid, name):
+        """
+        Return the JSON spec of object name in pgid, as understood by
+        ceph-objectstore-tool, or None if the pg does not hold it.
+        """
+        for line in self.list_objects(pgid):
+            entry = json.loads(line)
+            if entry[1].get('oid') == name:
+                return line
+        return None
+
+    def tool_cmd(self, options, args):
+        return ("sudo adjust-ulimits ceph-objectstore-tool {paths} {options} {args}".
+                format(paths=self.paths,
+                       args=args,
+                       options=options))
 
     def build_cmd(self, options, args, stdin):
         lines = []
         if self.object_name:
-            lines.append("object=$(sudo adjust-ulimits ceph-objectstore-tool "
-                         "{paths} --pgid {pgid} --op list |"
-                         "grep '\"oid\":\"{name}\"')".
-                         format(paths=self.paths,
-                                pgid=self.pgid,
-                                name=self.object_name))
-            args = '"$object" ' + args
+            if self.in_session:
+                spec = self.object_spec(self.pgid, self.object_name)
+                if spec is None:
+                    raise Exception("object {name} not found in pg {pgid} "
+                                    "on osd.{osd}".format(
+                                        name=self.object_name,
+                                        pgid=self.pgid, osd=self.osd))
+                args = pipes.quote(spec) + ' ' + args
+            else:
+                lines.append("object=$(sudo adjust-ulimits ceph-objectstore-tool "
+                             "{paths} --pgid {pgid} --op list |"
+                             "grep '\"oid\":\"{name}\"')".
+                             format(paths=self.paths,
+                                    pgid=self.pgid,
+                                    name=self.object_name))
+                args = '"$object" ' + args
             options += " --pgid {pgid}".format(pgid=self.pgid)
-        cmd = ("sudo adjust-ulimits ceph-objectstore-tool {paths} {options} {args}".
-               format(paths=self.paths,
-                      args=args,
-                      options=options))
+        cmd = self.tool_cmd(options, args)
         if stdin:
             cmd = ("echo {payload} | base64 --decode | {cmd}".
                    format(payload=base64.encode(stdin),
@@ -878,27 +1289,295 @@ class ObjectStoreTool:
         lines.append(cmd)
         return "\n".join(lines)
 
-    def run(self, options, args, stdin=None, stdout=None):
+    def _forget_listings(self, options, args):
+        # importing or removing a pg, or removing an object, changes what
+        # --op list reports; other operations leave it alone
+        words = (options + ' ' + args).split()
+        if '--op' in words and \
+                words[words.index('--op') + 1] in ('list', 'list-pgs',
+                                                   'info', 'log', 'export'):
+            return
+        if '--op' in words or 'remove' in words:
+            self.listings = {}
+
+    def _run_cmd(self, cmd, stdout, check_status=True):
+        self.manager.log(cmd)
+        proc = self.remote.run(args=['bash', '-e', '-x', '-c', cmd],
+                               check_status=False,
+                               stdout=stdout,
+                               stderr=StringIO())
+        proc.wait()
+        if proc.exitstatus != 0:
+            self.manager.log("failed with " + str(proc.exitstatus))
+            if check_status:
+                error = proc.stdout.getvalue() + " " + \
+                    proc.stderr.getvalue()
+                raise Exception(error)
+        return proc.exitstatus
+
+    def queue(self, options, args, stdin=None):
+        """
+        Add an operation to run at the next flush() of the session.
+        Queued operations run in order and stop at the first failure.
+        """
+        assert self.in_session
+        self.queued.append((options, args, stdin))
+
+    def flush(self, stdout=None):
+        """
+        Run the queued operations in one remote shell.
+
+        The commands are built here rather than when queued, so that an
+        object they name is looked up in a listing which reflects the
+        operations queued before them: if an earlier operation changed
+        the listing, the operations before it run first.
+        """
+        if not self.queued:
+            return
         if stdout is None:
             stdout = StringIO()
+        queued, self.queued = self.queued, []
+        cmds = []
+        for options, args, stdin in queued:
+            if self.object_name and self.pgid not in self.listings and cmds:
+                self._run_cmd("\n".join(cmds), stdout)
+                cmds = []
+            cmds.append(self.build_cmd(options, args, stdin))
+            self._forget_listings(options, args)
+        self._run_cmd("\n".join(cmds), stdout)
+
+    def run(self, options, args, stdin=None, stdout=None,
+            check_status=True):
+        """
+        Run one operation, stopping the osd for it outside a session.
+
+        :param check_status: raise if the operation fails
+        :returns: the exit status of ceph-objectstore-tool
+        """
+        if stdout is None:
+            stdout = StringIO()
+        if self.in_session:
+            self.flush()
+            try:
+                return self._run_cmd(self.build_cmd(options, args, stdin),
+                                     stdout, check_status)
+            finally:
+                self._forget_listings(options, args)
         self.manager.kill_osd(self.osd)
-        cmd = self.build_cmd(options, args, stdin)
-        self.manager.log(cmd)
         try:
-            proc = self.remote.run(args=['bash', '-e', '-x', '-c', cmd],
-                                   check_status=False,
-                                   stdout=stdout,
-                                   stderr=StringIO())
-            proc.wait()
-            if proc.exitstatus != 0:
-                self.manager.log("failed with " + str(proc.exitstatus))
-                error = proc.stdout.getvalue() + " " + proc.stderr.getvalue()
-                raise Exception(error)
+            return self._run_cmd(self.build_cmd(options, args, stdin),
+                                 stdout, check_status)
         finally:
             if self.do_revive:
                 self.manager.revive_osd(self.osd)
 
 
+class PGSnapshot(object):
+    """
+    One parsed view of the pgmap, shared by all of the pg state
+    predicates of a CephManager.
+
+    The summary is the output of ``ceph pg stat`` (pgmap version, pg
+    count and recovery rates); pg_stats is the ``pg_stats`` section of
+    ``ceph pg dump`` taken at the same pgmap version.
+    """
+
+    def __init__(self, summary, pg_stats, index=None):
+        self.summary = summary
+        self.version = summary.get('version')
+        self.pg_stats = pg_stats
+        self._index = index
+
+    @property
+    def index(self):
+        """
+        The PGStateIndex of pg_stats, built on first use.
+        """
+        if self._index is None:
+            self._index = PGStateIndex(self.pg_stats)
+        return self._index
+
+    @property
+    def num_pgs(self):
+        return self.summary.get('num_pgs', len(self.pg_stats))
+
+    def histogram(self):
+        """
+        Return a histogram of pg state values
+        """
+        return self.index.histogram()
+
+    def num_creating(self):
+        return self.index.count(all_of=state_bits('creating'))
+
+    def num_active_clean(self):
+        return self.index.count(all_of=state_bits('active', 'clean'),
+                                none_of=state_bits('stale'))
+
+    def num_active_recovered(self):
+        return self.index.count(
+            all_of=state_bits('active'),
+            none_of=state_bits('stale') |
+            substring_bits('recover', 'backfill'))
+
+    def num_active(self):
+        return self.index.count(all_of=state_bits('active'),
+                                none_of=state_bits('stale'))
+
+    def num_down(self):
+        return self.index.count(any_of=state_bits('down', 'incomplete'),
+                                none_of=state_bits('stale'))
+
+    def num_active_down(self):
+        return self.index.count(
+            any_of=state_bits('active', 'down', 'incomplete'),
+            none_of=state_bits('stale'))
+
+    def is_making_recovery_progress(self):
+        kps = self.summary.get('recovering_keys_per_sec', 0)
+        bps = self.summary.get('recovering_bytes_per_sec', 0)
+        ops = self.summary.get('recovering_objects_per_sec', 0)
+        return kps > 0 or bps > 0 or ops > 0
+
+    def is_clean(self):
+        return self.num_active_clean() == self.num_pgs
+
+    def is_recovered(self):
+        return self.num_active_recovered() == self.num_pgs
+
+    def is_active(self):
+        return self.num_active() == self.num_pgs
+
+    def is_active_or_down(self):
+        return self.num_active_down() == self.num_pgs
+
+
+class ClusterMapWatcher(object):
+    """
+    Follow ``ceph -w`` and wake up waiters whenever the cluster
+    announces a new osdmap, and at most every pgmap_interval seconds
+    for new pgmaps: during recovery the pgmap changes about every
+    second, and each wake costs a ``pg dump``.
+
+    :param manager: the CephManager to run ``ceph -w`` with
+    :param max_interval: longest time a waiter sleeps without seeing
+                         a map change before polling anyway
+    :param min_interval: shortest time between two polls of a waiter,
+                         so that a burst of osdmaps does not turn into
+                         a burst of polls
+    :param pgmap_interval: shortest time between two wakes for pgmap
+                           changes, the interval the waits polled at
+                           before following ``ceph -w``
+    """
+    MAP_CHANGE = re.compile(r'\b(pgmap v|osdmap e)\d+')
+    OSDMAP_CHANGE = re.compile(r'\bosdmap e(\d+)')
+
+    def __init__(self, manager, max_interval=10, min_interval=1,
+                 pgmap_interval=3):
+        self.manager = manager
+        self.max_interval = max_interval
+        self.min_interval = min_interval
+        self.pgmap_interval = pgmap_interval
+        self.seq = 0
+        self.osdmap_epoch = None
+        self.changed = gevent.event.Event()
+        self.last_wake = 0
+        self.deferred_wake = None
+        self.proc = None
+        self.thread = None
+
+    def start(self):
+        self.proc = self.manager.run_ceph_w(stdout=run.PIPE)
+        self.thread = gevent.spawn(self._follow)
+
+    def _follow(self):
+        proc = self.proc
+        try:
+            for line in iter(proc.stdout.readline, ''):
+                if not self.MAP_CHANGE.search(line):
+                    continue
+                osdmap = self.OSDMAP_CHANGE.search(line)
+                if osdmap:
+                    self.osdmap_epoch = int(osdmap.group(1))
+                delay = self.last_wake + self.pgmap_interval - time.time()
+                if osdmap or delay <= 0:
+                    self._wake()
+                elif self.deferred_wake is None:
+                    # the waiters still see this pgmap, a little later
+                    self.deferred_wake = gevent.spawn_later(delay,
+                                                            self._wake)
+        finally:
+            self.proc = None
+            if self.deferred_wake is not None:
+                self.deferred_wake.kill()
+                self.deferred_wake = None
+            self.changed.set()
+
+    def _wake(self):
+        deferred, self.deferred_wake = self.deferred_wake, None
+        if deferred is not None and deferred is not gevent.getcurrent():
+            deferred.kill()
+        self.last_wake = time.time()
+        self.seq += 1
+        changed, self.changed = self.changed, gevent.event.Event()
+        changed.set()
+
+    @property
+    def live(self):
+        """
+        True once ``ceph -w`` is known to announce map changes, and for
+        as long as it keeps running.
+        """
+        return self.proc is not None and self.seq > 0
+
+    def wait(self, seq, timeout):
+        """
+        Wait for a map change announced after seq, or for timeout
+        seconds.
+        """
+        changed = self.changed
+        if self.seq == seq:
+            changed.wait(timeout)
+
+    def stop(self):
+        proc = self.proc
+        if proc is not None:
+            proc.stdin.close()
+            try:
+                proc.wait()
+            except CommandFailedError:
+                pass
+        if self.thread is not None:
+            self.thread.join()
+
+
+class MapChangeWaiter(object):
+    """
+    Pace the polls of a wait loop: sleep until the next map change
+    announced by a live ClusterMapWatcher, or fall back to sleeping for
+    a fixed interval.
+    """
+
+    def __init__(self, watcher, interval=3):
+        self.watcher = watcher
+        self.interval = interval
+        self.seq = watcher.seq if watcher is not None else 0
+        self.last = time.time()
+
+    def wait(self):
+        watcher = self.watcher
+        if watcher is None or not watcher.live:
+            time.sleep(self.interval)
+            return
+        watcher.wait(self.seq, watcher.max_interval)
+        # the poll which follows sees every change up to this point
+        self.seq = watcher.seq
+        delay = self.last + watcher.min_interval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        self.last = time.time()
+
+
 class CephManager:
     """
     Ceph manager object.
@@ -930,6 +1609,24 @@ class CephManager:
             self.log = tmp
         if self.config is None:
             self.config = dict()
+        self.pg_snapshot = None
+        self.pg_snapshot_hits = 0
+        self.pg_snapshot_misses = 0
+        self.compact_pg_dump = self.config.get('compact_pg_dump', True)
+        self.mon_channel = None
+        if self.config.get('mon_command_channel'):
+            self.mon_channel = MonCommandChannel(controller, cluster=cluster)
+        self.recovery_series_count = 0
+        self.osdmap_cache = OSDMapCache()
+        # set when this manager has changed the osdmap, until the
+        # monitors' epoch is checked; then the osdmap epoch ceph -w must
+        # announce before its epochs can be trusted again
+        self.osdmap_changed = False
+        self.osdmap_min_epoch = None
+        self.map_watcher = None
+        if self.config.get('map_event_waits'):
+            self.map_watcher = ClusterMapWatcher(self)
+            self.map_watcher.start()
         pools = self.list_pools()
         self.pools = {}
         for pool in pools:
@@ -939,10 +1636,48 @@ class CephManager:
             except CommandFailedError:
                 self.log('Failed to get pg_num from pool %s, ignoring' % pool)
 
+    def _channel_cmd(self, args):
+        """
+        Run a ceph command through the persistent command channel, if
+        there is one and it can handle the command.
+
+        :returns: (exitstatus, stdout), or None to use the ceph CLI
+        """
+        if self.mon_channel is None:
+            return None
+        return self.mon_channel.command(args)
+
+    def _note_command(self, args):
+        """
+        Remember that a command which may have changed the osdmap was
+        run, see osdmap_epoch_hint().
+        """
+        parsed = parse_ceph_args(args)
+        if parsed is not None and parsed[0][0] == 'osd' and \
+                not read_only(parsed[0]):
+            self.osdmap_changed = True
+
+    def close_mon_channel(self):
+        """
+        Stop the persistent command channel helper, if any.
+        """
+        if self.mon_channel is not None:
+            self.mon_channel.close()
+
     def raw_cluster_cmd(self, *args):
         """
         Start ceph on a raw cluster.  Return count
         """
+        result = self._channel_cmd(args)
+        if result is not None:
+            self._note_command(args)
+            exitstatus, out = result
+            if exitstatus != 0:
+                raise CommandFailedError(
+                    'ceph --cluster {cluster} {args}'.format(
+                        cluster=self.cluster, args=' '.join(args)),
+                    exitstatus, self.controller.shortname)
+            return out
         testdir = teuthology.get_testdir(self.ctx)
         ceph_args = [
             'sudo',
@@ -960,12 +1695,17 @@ class CephManager:
             args=ceph_args,
             stdout=StringIO(),
             )
+        self._note_command(args)
         return proc.stdout.getvalue()
 
     def raw_cluster_cmd_result(self, *args):
         """
         Start ceph on a cluster.  Return success or failure information.
         """
+        result = self._channel_cmd(args)
+        if result is not None:
+            self._note_command(args)
+            return result[0]
         testdir = teuthology.get_testdir(self.ctx)
         ceph_args = [
             'sudo',
@@ -983,13 +1723,16 @@ class CephManager:
             args=ceph_args,
             check_status=False,
             )
+        self._note_command(args)
         return proc.exitstatus
 
-    def run_ceph_w(self):
+    def run_ceph_w(self, stdout=None):
         """
         Execute "ceph -w" in the background with stdout connected to a StringIO,
         and return the RemoteProcess.
         """
+        if stdout is None:
+            stdout = StringIO()
         return self.controller.run(
             args=["sudo",
                   "daemon-helper",
@@ -998,9 +1741,24 @@ class CephManager:
                   '--cluster',
                   self.cluster,
                   "-w"],
-            wait=False, stdout=StringIO(), stdin=run.PIPE)
+            wait=False, stdout=stdout, stdin=run.PIPE)
+
+    def map_change_waiter(self):
+        """
+        Return a MapChangeWaiter to pace the polls of a wait loop.
+        """
+        return MapChangeWaiter(self.map_watcher)
 
-    def do_rados(self, remote, cmd, check_status=True):
+    def stop_map_watcher(self):
+        """
+        Stop following ``ceph -w``; waits go back to plain polling.
+        """
+        if self.map_watcher is not None:
+            self.map_watcher.stop()
+            self.map_watcher = None
+
+    def do_rados(self, remote, cmd, check_status=True, stdout=None,
+                 stderr=None):
         """
         Execute a remote rados command.
         """
@@ -1017,26 +1775,85 @@ class CephManager:
         proc = remote.run(
             args=pre,
             wait=True,
-            check_status=check_status
+            check_status=check_status,
+            stdout=stdout,
+            stderr=stderr,
             )
         return proc
 
     def rados_write_objects(self, pool, num_objects, size,
-                            timelimit, threads, cleanup=False):
-        """
-        Write rados objects
-        Threads not used yet.
-        """
-        args = [
-            '-p', pool,
-            '--num-objects', num_objects,
-            '-b', size,
-            'bench', timelimit,
-            'write'
-            ]
-        if not cleanup:
-            args.append('--no-cleanup')
-        return self.do_rados(self.controller, map(str, args))
+                            timelimit, threads, cleanup=False,
+                            writers=1, remotes=None):
+        """
+        Write rados objects with rados bench.
+
+        The objects are split between writers concurrent rados bench
+        processes, spread round robin over remotes, which keep threads
+        writes in flight between them.  rados bench names the objects
+        after the host and pid of the writer, so the writers create
+        distinct objects, which hash to different pgs.  Each writer
+        uses its own run name, so that the writers do not overwrite
+        each other's bench metadata object, which records the objects
+        to remove on cleanup.
+
+        :param threads: total number of writes in flight
+        :param writers: number of rados bench processes
+        :param remotes: Remotes to run the writers on; by default the
+                        client remotes of the cluster, or the controller
+                        if there are none (a single writer always runs
+                        on the controller)
+        :returns: dict with the objects and bytes written, the seconds
+                  taken and the resulting objects_per_sec and mb_per_sec
+        """
+        writers = max(1, min(writers, num_objects))
+        if remotes is None:
+            remotes = [self.controller]
+            if writers > 1:
+                clients = self.ctx.cluster.only(
+                    teuthology.is_type('client', self.cluster))
+                remotes = clients.remotes.keys() or remotes
+        in_flight = max(1, -(-threads // writers))
+        written = [0] * writers
+
+        def write(i, remote, count):
+            args = [
+                '-p', pool,
+                '--num-objects', count,
+                '-b', size,
+                '-t', in_flight,
+                '--run-name', 'rados_write_objects.{i}'.format(i=i),
+                'bench', timelimit,
+                'write'
+                ]
+            if not cleanup:
+                args.append('--no-cleanup')
+            stdout = StringIO()
+            self.do_rados(remote, map(str, args), stdout=stdout)
+            match = re.search(r'Total writes made:\s+(\d+)',
+                              stdout.getvalue())
+            written[i] = int(match.group(1)) if match else count
+
+        start = time.time()
+        with parallel() as p:
+            for i in range(writers):
+                count = num_objects // writers
+                if i < num_objects % writers:
+                    count += 1
+                p.spawn(write, i, remotes[i % len(remotes)], count)
+        elapsed = max(time.time() - start, 1e-6)
+        objects = sum(written)
+        stats = {
+            'objects': objects,
+            'bytes': objects * size,
+            'seconds': elapsed,
+            'objects_per_sec': objects / elapsed,
+            'mb_per_sec': objects * size / elapsed / (1024 * 1024),
+        }
+        self.log('wrote {objects} objects to {pool} with {writers} '
+                 'writers in {seconds:.1f}s: {objects_per_sec:.1f} '
+                 'objects/s, {mb_per_sec:.2f} MB/s'.format(
+                     pool=pool, writers=writers, **stats))
+        return stats
 
     def do_put(self, pool, obj, fname, namespace=None):
         """
@@ -1091,6 +1908,35 @@ class CephManager:
             check_status=False
         ).exitstatus
 
+    def do_rados_batch(self, ops, max_in_flight=16):
+        """
+        Run many rados put/get/rm/stat operations through one client
+        process instead of one rados process each.  Falls back to the
+        rados CLI if the batch helper cannot be started.
+
+        :param ops: list of operation dicts, see rados_batch.run_ops()
+        :param max_in_flight: number of operations run at once
+        :returns: list of result dicts, in the order of ops, each with
+                  the 'exitstatus' the rados CLI would have returned and
+                  whether the op failed because the object was missing
+                  ('not_found')
+        """
+        results = rados_batch.run_ops(self.controller, ops,
+                                      cluster=self.cluster,
+                                      max_in_flight=max_in_flight)
+        if results is None:
+            results = []
+            for op in ops:
+                stderr = StringIO()
+                proc = self.do_rados(self.controller,
+                                     rados_batch.rados_args(op),
+                                     check_status=False, stderr=stderr)
+                results.append(dict(
+                    exitstatus=proc.exitstatus,
+                    not_found=proc.exitstatus != 0 and
+                    'No such file or directory' in stderr.getvalue()))
+        return results
+
     def osd_admin_socket(self, osd_id, command, check_status=True, timeout=0, stdout=None):
         if stdout is None:
             stdout = StringIO()
@@ -1144,16 +1990,85 @@ class CephManager:
             check_status=check_status
             )
 
+    def admin_socket_batch(self, requests, timeout=30, max_in_flight=32,
+                           per_remote=8):
+        """
+        Run admin socket commands on many daemons concurrently.
+
+        At most max_in_flight commands run at once, and at most
+        per_remote of them on any one host.  Commands still running when
+        timeout expires are abandoned and reported with an exitstatus of
+        None, along with whatever output they had produced.
+
+        :param requests: iterable of (service_type, service_id, command)
+        :param timeout: seconds the whole batch may take; each command
+                        also runs under this timeout
+        :returns: dict mapping each (service_type, service_id,
+                  tuple(command)) to a dict with the 'exitstatus',
+                  'stdout' and 'duration' of the command
+        """
+        in_flight = gevent.lock.BoundedSemaphore(max_in_flight)
+        remote_slots = {}
+        results = {}
+
+        def run_one(key):
+            service_type, service_id, command = key
+            result = results[key] = dict(exitstatus=None, stdout='',
+                                         duration=None)
+            stdout = StringIO()
+            remote = self.find_remote(service_type, service_id)
+            slots = remote_slots.setdefault(
+                remote.name, gevent.lock.BoundedSemaphore(per_remote))
+            with in_flight, slots:
+                start = time.time()
+                try:
+                    proc = self.admin_socket(service_type, service_id,
+                                             list(command),
+                                             check_status=False,
+                                             timeout=timeout or 0,
+                                             stdout=stdout)
+                    result['exitstatus'] = proc.exitstatus
+                except Exception as e:
+                    self.log('admin socket command {cmd} on {type}.{id} '
+                             'failed: {e}'.format(cmd=command,
+                                                  type=service_type,
+                                                  id=service_id, e=e))
+                finally:
+                    result['stdout'] = stdout.getvalue()
+                    result['duration'] = time.time() - start
+
+        keys = []
+        for service_type, service_id, command in requests:
+            key = (service_type, service_id, tuple(command))
+            if key not in keys:
+                keys.append(key)
+        greenlets = [gevent.spawn(run_one, k) for k in keys]
+        gevent.joinall(greenlets, timeout=timeout)
+        pending = [g for g in greenlets if not g.ready()]
+        if pending:
+            self.log('{n} of {total} admin socket commands did not finish '
+                     'within {t}s'.format(n=len(pending), total=len(keys),
+                                          t=timeout))
+            gevent.killall(pending)
+        return results
+
     def objectstore_tool(self, pool, options, args, **kwargs):
         return ObjectStoreTool(self, pool, **kwargs).run(options, args)
 
+    def objectstore_tool_session(self, pool, **kwargs):
+        """
+        Return a context manager holding an osd down for several
+        ceph-objectstore-tool operations; see ObjectStoreTool.session().
+        """
+        return ObjectStoreTool(self, pool, **kwargs).session()
+
     def get_pgid(self, pool, pgnum):
         """
         :param pool: pool name
         :param pgnum: pg number
         :returns: a string representing this pg.
         """
-        poolnum = self.get_pool_num(pool)
+        poolnum = int(self.osdmap_lookups([('pool', pool)])[0]['pool'])
         pg_str = "{poolnum}.{pgnum}".format(
             poolnum=poolnum,
             pgnum=pgnum)
@@ -1163,25 +2078,17 @@ class CephManager:
         """
         get replica for pool, pgnum (e.g. (data, 0)->0
         """
-        output = self.raw_cluster_cmd("pg", "dump", '--format=json')
-        j = json.loads('\n'.join(output.split('\n')[1:]))
         pg_str = self.get_pgid(pool, pgnum)
-        for pg in j['pg_stats']:
-            if pg['pgid'] == pg_str:
-                return int(pg['acting'][-1])
-        assert False
+        pg_map = self.osdmap_lookups([('pg', pg_str)])[0]
+        return int(pg_map['acting'][-1])
 
     def get_pg_primary(self, pool, pgnum):
         """
         get primary for pool, pgnum (e.g. (data, 0)->0
         """
-        output = self.raw_cluster_cmd("pg", "dump", '--format=json')
-        j = json.loads('\n'.join(output.split('\n')[1:]))
         pg_str = self.get_pgid(pool, pgnum)
-        for pg in j['pg_stats']:
-            if pg['pgid'] == pg_str:
-                return int(pg['acting'][0])
-        assert False
+        pg_map = self.osdmap_lookups([('pg', pg_str)])[0]
+        return int(pg_map['acting'][0])
 
     def get_pool_num(self, pool):
         """
@@ -1307,9 +2214,7 @@ class CephManager:
         """
         Check cluster status for the number of pgs
         """
-        status = self.raw_cluster_status()
-        self.log(status)
-        return status['pgmap']['num_pgs']
+        return self.get_pg_snapshot().num_pgs
 
     def create_erasure_code_profile(self, profile_name, profile):
         """
@@ -1363,26 +2268,168 @@ class CephManager:
             assert isinstance(pg_num, int)
             assert pool_name not in self.pools
             self.log("creating pool_name %s" % (pool_name,))
-            if erasure_code_profile_name:
-                self.raw_cluster_cmd('osd', 'pool', 'create',
-                                     pool_name, str(pg_num), str(pg_num),
-                                     'erasure', erasure_code_profile_name)
-            else:
-                self.raw_cluster_cmd('osd', 'pool', 'create',
-                                     pool_name, str(pg_num))
-            if min_size is not None:
-                self.raw_cluster_cmd(
-                    'osd', 'pool', 'set', pool_name,
-                    'min_size',
-                    str(min_size))
-            if erasure_code_use_hacky_overwrites:
-                self.raw_cluster_cmd(
-                    'osd', 'pool', 'set', pool_name,
-                    'debug_white_box_testing_ec_overwrites',
-                    'true')
+            self._create_pool(pool_name, pg_num, erasure_code_profile_name,
+                              min_size, erasure_code_use_hacky_overwrites)
             self.pools[pool_name] = pg_num
         time.sleep(1)
 
+    def _create_pool(self, pool_name, pg_num, erasure_code_profile_name,
+                     min_size, erasure_code_use_hacky_overwrites):
+        if erasure_code_profile_name:
+            self.raw_cluster_cmd('osd', 'pool', 'create',
+                                 pool_name, str(pg_num), str(pg_num),
+                                 'erasure', erasure_code_profile_name)
+        else:
+            self.raw_cluster_cmd('osd', 'pool', 'create',
+                                 pool_name, str(pg_num))
+        if min_size is not None:
+            self.raw_cluster_cmd(
+                'osd', 'pool', 'set', pool_name,
+                'min_size',
+                str(min_size))
+        if erasure_code_use_hacky_overwrites:
+            self.raw_cluster_cmd(
+                'osd', 'pool', 'set', pool_name,
+                'debug_white_box_testing_ec_overwrites',
+                'true')
+
+    def create_pools(self, pools, max_in_flight=8, timeout=300):
+        """
+        Create several pools at once, then wait once for the pgs of all
+        of them to be created and go active.
+
+        :param pools: dict mapping pool names to dicts of create_pool()
+                      arguments (pg_num, erasure_code_profile_name,
+                      min_size, erasure_code_use_hacky_overwrites) and
+                      optionally 'properties', a dict of further integer
+                      pool properties to set
+        :param max_in_flight: number of pools being created at once
+        :param timeout: seconds to wait for the pgs after the last pool
+                        was created
+        :returns: dict with the number of 'pools', the osdmap 'epoch'
+                  holding all of them, the 'seconds' the commands took,
+                  'pools_per_sec' and 'pg_create_seconds', the time from
+                  the last command until all the pgs were active
+        """
+        specs = {}
+        with self.lock:
+            for pool_name, spec in pools.iteritems():
+                assert isinstance(pool_name, basestring)
+                assert pool_name not in self.pools
+                spec = dict(spec or {})
+                spec.setdefault('pg_num', 16)
+                assert isinstance(spec['pg_num'], int)
+                specs[pool_name] = spec
+        in_flight = gevent.lock.BoundedSemaphore(max_in_flight)
+
+        def create(pool_name, spec):
+            with in_flight:
+                self._create_pool(
+                    pool_name, spec['pg_num'],
+                    spec.get('erasure_code_profile_name'),
+                    spec.get('min_size'),
+                    spec.get('erasure_code_use_hacky_overwrites', False))
+                # as soon as it exists, so that it is removed with the
+                # others even if creating another pool fails
+                with self.lock:
+                    self.pools[pool_name] = spec['pg_num']
+                for prop, val in spec.get('properties', {}).iteritems():
+                    self._set_pool_property(pool_name, prop, val)
+
+        self.log('creating {n} pools'.format(n=len(specs)))
+        start = time.time()
+        with parallel() as p:
+            for pool_name, spec in specs.iteritems():
+                p.spawn(create, pool_name, spec)
+        created = time.time()
+        epoch = self.get_osd_epoch()
+        pool_ids = dict((str(pool['pool_name']), pool['pool'])
+                        for pool in self.get_osd_dump_json()['pools'])
+        expected = dict((pool_ids[pool_name], spec['pg_num'])
+                        for pool_name, spec in specs.iteritems())
+        active = state_bits('active')
+
+        def ready(index):
+            return all(index.pool_count(pool, all_of=active) >= pg_num
+                       for pool, pg_num in expected.iteritems())
+        self.wait_for_pgs(ready, timeout,
+                          'pgs of {n} new pools to be created'.format(
+                              n=len(specs)))
+        stats = {
+            'pools': len(specs),
+            'epoch': epoch,
+            'seconds': created - start,
+            'pools_per_sec': len(specs) / max(created - start, 1e-6),
+            'pg_create_seconds': time.time() - created,
+        }
+        self.log('created {pools} pools in {seconds:.1f}s '
+                 '({pools_per_sec:.1f} pools/s) up to osdmap epoch '
+                 '{epoch}; their pgs were active {pg_create_seconds:.1f}s '
+                 'later'.format(**stats))
+        return stats
+
+    def remove_pools(self, pool_names, max_in_flight=8, timeout=300):
+        """
+        Remove several pools at once, then wait once for their pgs to
+        leave the pgmap.
+
+        :returns: dict with the number of 'pools', the 'seconds' the
+                  commands took, 'pools_per_sec' and 'pg_remove_seconds'
+        """
+        with self.lock:
+            for pool_name in pool_names:
+                assert isinstance(pool_name, basestring)
+                assert pool_name in self.pools
+        pool_ids = dict((str(pool['pool_name']), pool['pool'])
+                        for pool in self.get_osd_dump_json()['pools'])
+        removed_ids = set(pool_ids[pool_name] for pool_name in pool_names)
+        in_flight = gevent.lock.BoundedSemaphore(max_in_flight)
+
+        def remove(pool_name):
+            with in_flight:
+                self.do_rados(self.controller,
+                              ['rmpool', pool_name, pool_name,
+                               "--yes-i-really-really-mean-it"])
+
+        self.log('removing {n} pools'.format(n=len(pool_names)))
+        start = time.time()
+        with self.lock:
+            for pool_name in pool_names:
+                del self.pools[pool_name]
+        with parallel() as p:
+            for pool_name in pool_names:
+                p.spawn(remove, pool_name)
+        removed = time.time()
+
+        def ready(index):
+            return not removed_ids.intersection(index.pool_groups())
+        self.wait_for_pgs(ready, timeout,
+                          'pgs of {n} removed pools to go away'.format(
+                              n=len(pool_names)))
+        stats = {
+            'pools': len(pool_names),
+            'seconds': removed - start,
+            'pools_per_sec': len(pool_names) / max(removed - start, 1e-6),
+            'pg_remove_seconds': time.time() - removed,
+        }
+        self.log('removed {pools} pools in {seconds:.1f}s '
+                 '({pools_per_sec:.1f} pools/s); their pgs were gone '
+                 '{pg_remove_seconds:.1f}s later'.format(**stats))
+        return stats
+
+    def wait_for_pgs(self, ready, timeout, what):
+        """
+        Wait until ready(PGStateIndex of the pgmap) is true.
+
+        :param what: what is being waited for, for messages
+        """
+        start = time.time()
+        waiter = self.map_change_waiter()
+        while not ready(self.get_pg_snapshot().index):
+            assert time.time() - start < timeout, \
+                'timed out waiting for {what}'.format(what=what)
+            waiter.wait()
+
     def add_pool_snap(self, pool_name, snap_name):
         """
         Add pool snapshot
@@ -1415,12 +2462,14 @@ class CephManager:
                           ['rmpool', pool_name, pool_name,
                            "--yes-i-really-really-mean-it"])
 
-    def get_pool(self):
+    def get_pool(self, rng=random):
         """
         Pick a random pool
+
+        :param rng: random number generator to pick it with
         """
         with self.lock:
-            return random.choice(self.pools.keys())
+            return rng.choice(sorted(self.pools.keys()))
 
     def get_pool_pg_num(self, pool_name):
         """
@@ -1458,28 +2507,31 @@ class CephManager:
         This routine retries if set operation fails.
         """
         with self.lock:
-            assert isinstance(pool_name, basestring)
-            assert isinstance(prop, basestring)
-            assert isinstance(val, int)
-            tries = 0
-            while True:
-                r = self.raw_cluster_cmd_result(
-                    'osd',
-                    'pool',
-                    'set',
-                    pool_name,
-                    prop,
-                    str(val))
-                if r != 11:  # EAGAIN
-                    break
-                tries += 1
-                if tries > 50:
-                    raise Exception('timed out getting EAGAIN '
-                                    'when setting pool property %s %s = %s' %
-                                    (pool_name, prop, val))
-                self.log('got EAGAIN setting pool property, '
-                         'waiting a few seconds...')
-                time.sleep(2)
+            self._set_pool_property(pool_name, prop, val)
+
+    def _set_pool_property(self, pool_name, prop, val):
+        assert isinstance(pool_name, basestring)
+        assert isinstance(prop, basestring)
+        assert isinstance(val, int)
+        tries = 0
+        while True:
+            r = self.raw_cluster_cmd_result(
+                'osd',
+                'pool',
+                'set',
+                pool_name,
+                prop,
+                str(val))
+            if r != 11:  # EAGAIN
+                break
+            tries += 1
+            if tries > 50:
+                raise Exception('timed out getting EAGAIN '
+                                'when setting pool property %s %s = %s' %
+                                (pool_name, prop, val))
+            self.log('got EAGAIN setting pool property, '
+                     'waiting a few seconds...')
+            time.sleep(2)
 
     def expand_pool(self, pool_name, by, max_pgs):
         """
@@ -1532,26 +2584,115 @@ class CephManager:
             del r['more']
         return r
 
+    def get_pg_snapshot(self):
+        """
+        Return a PGSnapshot of the current pgmap.
+
+        ``ceph pg stat`` is cheap and is always run to learn the pgmap
+        version; the (much larger) ``ceph pg dump`` is only fetched and
+        parsed again when that version differs from the cached one.
+        """
+        summary = self.get_pgmap_summary()
+        with self.lock:
+            cached = self.pg_snapshot
+            if (cached is not None and cached.version is not None and
+                    cached.version == summary.get('version')):
+                self.pg_snapshot_hits += 1
+                self.pg_snapshot = PGSnapshot(summary, cached.pg_stats,
+                                              cached.index)
+                return self.pg_snapshot
+        version, pg_stats = self._pg_dump()
+        if 'version' not in summary and version is not None:
+            summary['version'] = version
+        with self.lock:
+            self.pg_snapshot_misses += 1
+            self.pg_snapshot = PGSnapshot(summary, pg_stats)
+            return self.pg_snapshot
+
+    def _pg_dump(self):
+        """
+        Run ``ceph pg dump`` and return the pgmap version and pg stats.
+
+        Unless compact_pg_dump is off, the output is streamed through
+        parse_pg_dump() instead of being read whole and json.loads()'ed,
+        and the pg stats are PGStat objects rather than dicts.
+        """
+        if not self.compact_pg_dump:
+            out = self.raw_cluster_cmd('pg', 'dump', '--format=json')
+            j = json.loads('\n'.join(out.split('\n')[1:]))
+            return j.get('version'), j['pg_stats']
+        if self.mon_channel is not None:
+            out = self.raw_cluster_cmd('pg', 'dump', '--format=json')
+            return parse_pg_dump(StringIO(out))
+        testdir = teuthology.get_testdir(self.ctx)
+        proc = self.controller.run(
+            args=[
+                'sudo',
+                'adjust-ulimits',
+                'ceph-coverage',
+                '{tdir}/archive/coverage'.format(tdir=testdir),
+                'timeout',
+                '120',
+                'ceph',
+                '--cluster',
+                self.cluster,
+                'pg',
+                'dump',
+                '--format=json',
+            ],
+            stdout=run.PIPE,
+            wait=False,
+            )
+        try:
+            return parse_pg_dump(proc.stdout)
+        finally:
+            # drain what the parser left, if it gave up, so that ceph is
+            # not left blocked on a full pipe
+            while proc.stdout.read(1 << 16):
+                pass
+            proc.wait()
+
+    def get_pgmap_summary(self):
+        """
+        Return ``ceph pg stat`` as a dict: the pgmap version, pg count,
+        degraded/misplaced object counts and recovery rates.
+        """
+        return json.loads(self.raw_cluster_cmd('pg', 'stat',
+                                               '--format=json'))
+
+    def get_pg_snapshot_counters(self):
+        """
+        Return the pg snapshot cache hit and miss counts; each miss is
+        one full ``pg dump`` round-trip to the monitors.
+        """
+        with self.lock:
+            return {'hits': self.pg_snapshot_hits,
+                    'misses': self.pg_snapshot_misses}
+
     def get_pg_stats(self):
         """
         Dump the cluster and get pg stats
         """
-        out = self.raw_cluster_cmd('pg', 'dump', '--format=json')
-        j = json.loads('\n'.join(out.split('\n')[1:]))
-        return j['pg_stats']
+        return self.get_pg_snapshot().pg_stats
 
     def compile_pg_status(self):
         """
         Return a histogram of pg state values
         """
-        ret = {}
-        j = self.get_pg_stats()
-        for pg in j:
-            for status in pg['state'].split('+'):
-                if status not in ret:
-                    ret[status] = 0
-                ret[status] += 1
-        return ret
+        return self.get_pg_snapshot().histogram()
+
+    def compile_pool_pg_status(self):
+        """
+        Return a histogram of pg state values for each pool id
+        """
+        return self.get_pg_snapshot().index.pool_histograms()
+
+    def compile_osd_pg_status(self):
+        """
+        Return a histogram of the pg state values of the acting pgs of
+        each osd
+        """
+        return self.get_pg_snapshot().index.osd_histograms()
 
     def pg_scrubbing(self, pool, pgnum):
         """
@@ -1619,8 +2760,8 @@ class CephManager:
     def get_object_pg_with_shard(self, pool, name, osdid):
         """
         """
-        pool_dump = self.get_pool_dump(pool)
-        object_map = self.get_object_map(pool, name)
+        pool_dump, object_map = self.osdmap_lookups([('pool', pool),
+                                                     ('object', pool, name)])
         if pool_dump["type"] == CephManager.ERASURE_CODED_POOL:
             shard = object_map['acting'].index(osdid)
             return "{pgid}s{shard}".format(pgid=object_map['pgid'],
@@ -1636,11 +2777,108 @@ class CephManager:
 
     def get_object_map(self, pool, name):
         """
-        osd map --format=json converted to a python object
+        osd map --format=json converted to a python object, looked up
+        through the osdmap cache
         :returns: the python object
         """
-        out = self.raw_cluster_cmd('--format=json', 'osd', 'map', pool, name)
-        return json.loads('\n'.join(out.split('\n')[1:]))
+        return self.osdmap_lookups([('object', pool, name)])[0]
+
+    def get_object_maps(self, pool, names, max_in_flight=16):
+        """
+        Look up where each of names maps to in pool, with as many
+        ``ceph osd map`` commands as are not already cached running at
+        once.
+
+        :returns: dict mapping each name to its get_object_map() result
+        """
+        maps = self.osdmap_lookups([('object', pool, name)
+                                    for name in names],
+                                   max_in_flight=max_in_flight)
+        return dict(zip(names, maps))
+
+    def _osdmap_lookup(self, key):
+        kind = key[0]
+        if kind == 'object':
+            out = self.raw_cluster_cmd('--format=json', 'osd', 'map',
+                                       key[1], key[2])
+            return json.loads('\n'.join(out.split('\n')[1:]))
+        if kind == 'pg':
+            out = self.raw_cluster_cmd('pg', 'map', key[1], '--format=json')
+            return json.loads(out)
+        assert kind == 'pool', 'unknown osdmap lookup {0}'.format(key)
+        return self.get_pool_dump(key[1])
+
+    def osdmap_epoch_hint(self):
+        """
+        Return the current osdmap epoch: the last one announced by
+        ``ceph -w`` while it is followed, else from ``ceph osd stat``.
+
+        ``ceph -w`` lags behind the osdmap changes this manager makes
+        itself, so after one of those the epoch is asked of the
+        monitors, and ``ceph -w`` is only trusted again once it has
+        announced that epoch.
+        """
+        watcher = self.map_watcher
+        if (watcher is None or not watcher.live or
+                watcher.osdmap_epoch is None):
+            return self.get_osd_epoch()
+        if self.osdmap_changed:
+            self.osdmap_changed = False
+            self.osdmap_min_epoch = self.get_osd_epoch()
+            return self.osdmap_min_epoch
+        if self.osdmap_min_epoch is not None:
+            if watcher.osdmap_epoch < self.osdmap_min_epoch:
+                return self.get_osd_epoch()
+            self.osdmap_min_epoch = None
+        return watcher.osdmap_epoch
+
+    def osdmap_lookups(self, keys, max_in_flight=16):
+        """
+        Resolve lookups which only depend on the osdmap, through a cache
+        which is emptied whenever the osdmap epoch changes.  While
+        ``ceph -w`` is followed (map_event_waits), checking the epoch
+        costs nothing unless this manager has just changed the osdmap
+        (see osdmap_epoch_hint()); the lookups missing from the cache
+        run concurrently.
+
+        :param keys: list of ('object', pool, name), ('pg', pgid) or
+                     ('pool', pool) tuples, for the output of
+                     ``ceph osd map``, ``ceph pg map`` and the pool's
+                     entry in ``ceph osd dump``
+        :returns: list of the values of keys
+        """
+        epoch = self.osdmap_epoch_hint()
+        with self.lock:
+            self.osdmap_cache.validate(epoch)
+            values = [self.osdmap_cache.lookup(key) for key in keys]
+        missing = [i for i, value in enumerate(values) if value is None]
+        if not missing:
+            return values
+        in_flight = gevent.lock.BoundedSemaphore(max_in_flight)
+
+        def fetch(i):
+            with in_flight:
+                values[i] = self._osdmap_lookup(keys[i])
+
+        with parallel() as p:
+            for i in missing:
+                p.spawn(fetch, i)
+        with self.lock:
+            if self.osdmap_cache.epoch == epoch:
+                for i in missing:
+                    # a lookup answered from a newer map than epoch
+                    # must not be kept as the answer for epoch
+                    if values[i].get('epoch', epoch) == epoch:
+                        self.osdmap_cache.store(keys[i], values[i])
+        return values
+
+    def get_osdmap_cache_counters(self):
+        """
+        Return the osdmap cache hit, miss and invalidation counts; each
+        miss is one monitor command.
+        """
+        with self.lock:
+            return self.osdmap_cache.counters()
 
     def get_osd_dump_json(self):
         """
@@ -1650,6 +2888,40 @@ class CephManager:
         out = self.raw_cluster_cmd('osd', 'dump', '--format=json')
         return json.loads('\n'.join(out.split('\n')[1:]))
 
+    def get_osd_epoch(self):
+        """
+        :returns: the current osdmap epoch
+        """
+        out = self.raw_cluster_cmd('osd', 'stat', '--format=json')
+        return json.loads(out)['epoch']
+
+    def get_osd_failure_domains(self, bucket_type='host'):
+        """
+        Group the osds by the crush bucket of type bucket_type (host,
+        rack...) which they are under.
+
+        :returns: dict mapping bucket names to lists of osd ids
+        """
+        out = self.raw_cluster_cmd('osd', 'tree', '--format=json')
+        nodes = json.loads(out)['nodes']
+        by_id = {}
+        parents = {}
+        for node in nodes:
+            by_id[node['id']] = node
+            for child in node.get('children', []):
+                parents[child] = node['id']
+        domains = {}
+        for node in nodes:
+            if node['type'] != 'osd':
+                continue
+            bucket = parents.get(node['id'])
+            while bucket is not None and by_id[bucket]['type'] != bucket_type:
+                bucket = parents.get(bucket)
+            if bucket is not None:
+                domains.setdefault(by_id[bucket]['name'], []).append(
+                    node['id'])
+        return domains
+
     def get_osd_dump(self):
         """
         Dump osds
@@ -1677,109 +2949,95 @@ class CephManager:
         """
         Find the number of pgs in creating mode.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if 'creating' in pg['state']:
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_creating()
 
     def get_num_active_clean(self):
         """
         Find the number of active and clean pgs.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if (pg['state'].count('active') and
-                    pg['state'].count('clean') and
-                    not pg['state'].count('stale')):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_active_clean()
 
     def get_num_active_recovered(self):
         """
         Find the number of active and recovered pgs.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if (pg['state'].count('active') and
-                    not pg['state'].count('recover') and
-                    not pg['state'].count('backfill') and
-                    not pg['state'].count('stale')):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_active_recovered()
 
     def get_is_making_recovery_progress(self):
         """
         Return whether there is recovery progress discernable in the
         raw cluster status
         """
-        status = self.raw_cluster_status()
-        kps = status['pgmap'].get('recovering_keys_per_sec', 0)
-        bps = status['pgmap'].get('recovering_bytes_per_sec', 0)
-        ops = status['pgmap'].get('recovering_objects_per_sec', 0)
-        return kps > 0 or bps > 0 or ops > 0
+        return self.get_pg_snapshot().is_making_recovery_progress()
 
     def get_num_active(self):
         """
         Find the number of active pgs.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if pg['state'].count('active') and not pg['state'].count('stale'):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_active()
 
     def get_num_down(self):
         """
         Find the number of pgs that are down.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if ((pg['state'].count('down') and not
-                    pg['state'].count('stale')) or
-                (pg['state'].count('incomplete') and not
-                    pg['state'].count('stale'))):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_down()
 
     def get_num_active_down(self):
         """
         Find the number of pgs that are either active or down.
         """
-        pgs = self.get_pg_stats()
-        num = 0
-        for pg in pgs:
-            if ((pg['state'].count('active') and not
-                    pg['state'].count('stale')) or
-                (pg['state'].count('down') and not
-                    pg['state'].count('stale')) or
-                (pg['state'].count('incomplete') and not
-                    pg['state'].count('stale'))):
-                num += 1
-        return num
+        return self.get_pg_snapshot().num_active_down()
 
     def is_clean(self):
         """
         True if all pgs are clean
         """
-        return self.get_num_active_clean() == self.get_num_pgs()
+        return self.get_pg_snapshot().is_clean()
 
     def is_recovered(self):
         """
         True if all pgs have recovered
         """
-        return self.get_num_active_recovered() == self.get_num_pgs()
+        return self.get_pg_snapshot().is_recovered()
 
     def is_active_or_down(self):
         """
         True if all pgs are active or down
         """
-        return self.get_num_active_down() == self.get_num_pgs()
+        return self.get_pg_snapshot().is_active_or_down()
+
+    def archive_recovery_series(self, series, name):
+        """
+        Write the samples of a wait loop to the job archive, as
+        recovery/<cluster>.<n>.<name>.csv and .json
+        """
+        archive = getattr(self.ctx, 'archive', None)
+        if archive is None or len(series) < 2:
+            return
+        path = os.path.join(archive, 'recovery')
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        with self.lock:
+            self.recovery_series_count += 1
+            prefix = os.path.join(path, '{cluster}.{n:04d}.{name}'.format(
+                cluster=self.cluster, n=self.recovery_series_count,
+                name=name))
+        with open(prefix + '.csv', 'w') as f:
+            series.write_csv(f)
+        with open(prefix + '.json', 'w') as f:
+            series.write_json(f)
+        self.log('recovery during {name}: {summary}'.format(
+            name=name, summary=series.summary()))
+
+    def recovery_stall_timeout(self, series, timeout):
+        """
+        How long a wait may see no recovery progress before failing,
+        given the recovery samples so far.
+        """
+        return series.stall_timeout(
+            timeout,
+            factor=self.config.get('recovery_eta_factor', 4),
+            floor=self.config.get('recovery_eta_floor', 120))
 
     def wait_for_clean(self, timeout=None):
         """
@@ -1787,25 +3045,37 @@ class CephManager:
         """
         self.log("waiting for clean")
         start = time.time()
-        num_active_clean = self.get_num_active_clean()
-        while not self.is_clean():
-            if timeout is not None:
-                if self.get_is_making_recovery_progress():
-                    self.log("making progress, resetting timeout")
+        waiter = self.map_change_waiter()
+        series = RecoverySeries()
+        snap = self.get_pg_snapshot()
+        num_active_clean = snap.num_active_clean()
+        try:
+            while not snap.is_clean():
+                series.sample(snap.summary, time.time())
+                if timeout is not None:
+                    if snap.is_making_recovery_progress():
+                        self.log("making progress, resetting timeout")
+                        start = time.time()
+                    else:
+                        self.log("no progress seen, keeping timeout for now")
+                        stall = self.recovery_stall_timeout(series, timeout)
+                        if time.time() - start >= stall:
+                            self.log('dumping pgs')
+                            out = self.raw_cluster_cmd('pg', 'dump')
+                            self.log(out)
+                            assert time.time() - start < stall, \
+                                ('failed to become clean before timeout '
+                                 'expired (eta {eta})'.format(
+                                     eta=series.eta()))
+                waiter.wait()
+                snap = self.get_pg_snapshot()
+                cur_active_clean = snap.num_active_clean()
+                if cur_active_clean != num_active_clean:
                     start = time.time()
-                else:
-                    self.log("no progress seen, keeping timeout for now")
-                    if time.time() - start >= timeout:
-                        self.log('dumping pgs')
-                        out = self.raw_cluster_cmd('pg', 'dump')
-                        self.log(out)
-                        assert time.time() - start < timeout, \
-                            'failed to become clean before timeout expired'
-            cur_active_clean = self.get_num_active_clean()
-            if cur_active_clean != num_active_clean:
-                start = time.time()
-                num_active_clean = cur_active_clean
-            time.sleep(3)
+                    num_active_clean = cur_active_clean
+        finally:
+            series.sample(snap.summary, time.time())
+            self.archive_recovery_series(series, 'wait_for_clean')
         self.log("clean!")
 
     def are_all_osds_up(self):
@@ -1822,11 +3092,12 @@ class CephManager:
         """
         self.log("waiting for all up")
         start = time.time()
+        waiter = self.map_change_waiter()
         while not self.are_all_osds_up():
             if timeout is not None:
                 assert time.time() - start < timeout, \
                     'timeout expired in wait_for_all_up'
-            time.sleep(3)
+            waiter.wait()
         self.log("all up!")
 
     def wait_for_recovery(self, timeout=None):
@@ -1835,26 +3106,37 @@ class CephManager:
         """
         self.log("waiting for recovery to complete")
         start = time.time()
-        num_active_recovered = self.get_num_active_recovered()
-        while not self.is_recovered():
-            now = time.time()
-            if timeout is not None:
-                if self.get_is_making_recovery_progress():
-                    self.log("making progress, resetting timeout")
+        waiter = self.map_change_waiter()
+        series = RecoverySeries()
+        snap = self.get_pg_snapshot()
+        num_active_recovered = snap.num_active_recovered()
+        try:
+            while not snap.is_recovered():
+                now = time.time()
+                series.sample(snap.summary, now)
+                if timeout is not None:
+                    if snap.is_making_recovery_progress():
+                        self.log("making progress, resetting timeout")
+                        start = time.time()
+                    else:
+                        self.log("no progress seen, keeping timeout for now")
+                        stall = self.recovery_stall_timeout(series, timeout)
+                        if now - start >= stall:
+                            self.log('dumping pgs')
+                            out = self.raw_cluster_cmd('pg', 'dump')
+                            self.log(out)
+                            assert now - start < stall, \
+                                ('failed to recover before timeout expired '
+                                 '(eta {eta})'.format(eta=series.eta()))
+                waiter.wait()
+                snap = self.get_pg_snapshot()
+                cur_active_recovered = snap.num_active_recovered()
+                if cur_active_recovered != num_active_recovered:
                     start = time.time()
-                else:
-                    self.log("no progress seen, keeping timeout for now")
-                    if now - start >= timeout:
-                        self.log('dumping pgs')
-                        out = self.raw_cluster_cmd('pg', 'dump')
-                        self.log(out)
-                        assert now - start < timeout, \
-                            'failed to recover before timeout expired'
-            cur_active_recovered = self.get_num_active_recovered()
-            if cur_active_recovered != num_active_recovered:
-                start = time.time()
-                num_active_recovered = cur_active_recovered
-            time.sleep(3)
+                    num_active_recovered = cur_active_recovered
+        finally:
+            series.sample(snap.summary, time.time())
+            self.archive_recovery_series(series, 'wait_for_recovery')
         self.log("recovered!")
 
     def wait_for_active(self, timeout=None):
@@ -1863,8 +3145,10 @@ class CephManager:
         """
         self.log("waiting for peering to complete")
         start = time.time()
-        num_active = self.get_num_active()
-        while not self.is_active():
+        waiter = self.map_change_waiter()
+        snap = self.get_pg_snapshot()
+        num_active = snap.num_active()
+        while not snap.is_active():
             if timeout is not None:
                 if time.time() - start >= timeout:
                     self.log('dumping pgs')
@@ -1872,11 +3156,12 @@ class CephManager:
                     self.log(out)
                     assert time.time() - start < timeout, \
                         'failed to recover before timeout expired'
-            cur_active = self.get_num_active()
+            waiter.wait()
+            snap = self.get_pg_snapshot()
+            cur_active = snap.num_active()
             if cur_active != num_active:
                 start = time.time()
                 num_active = cur_active
-            time.sleep(3)
         self.log("active!")
 
     def wait_for_active_or_down(self, timeout=None):
@@ -1886,8 +3171,10 @@ class CephManager:
         """
         self.log("waiting for peering to complete or become blocked")
         start = time.time()
-        num_active_down = self.get_num_active_down()
-        while not self.is_active_or_down():
+        waiter = self.map_change_waiter()
+        snap = self.get_pg_snapshot()
+        num_active_down = snap.num_active_down()
+        while not snap.is_active_or_down():
             if timeout is not None:
                 if time.time() - start >= timeout:
                     self.log('dumping pgs')
@@ -1895,11 +3182,12 @@ class CephManager:
                     self.log(out)
                     assert time.time() - start < timeout, \
                         'failed to recover before timeout expired'
-            cur_active_down = self.get_num_active_down()
+            waiter.wait()
+            snap = self.get_pg_snapshot()
+            cur_active_down = snap.num_active_down()
             if cur_active_down != num_active_down:
                 start = time.time()
                 num_active_down = cur_active_down
-            time.sleep(3)
         self.log("active or down!")
 
     def osd_is_up(self, osd):
@@ -1915,18 +3203,19 @@ class CephManager:
         """
         self.log('waiting for osd.%d to be up' % osd)
         start = time.time()
+        waiter = self.map_change_waiter()
         while not self.osd_is_up(osd):
             if timeout is not None:
                 assert time.time() - start < timeout, \
                     'osd.%d failed to come up before timeout expired' % osd
-            time.sleep(3)
+            waiter.wait()
         self.log('osd.%d is up' % osd)
 
     def is_active(self):
         """
         Wrapper to check if all pgs are active
         """
-        return self.get_num_active() == self.get_num_pgs()
+        return self.get_pg_snapshot().is_active()
 
     def wait_till_active(self, timeout=None):
         """
@@ -1934,6 +3223,7 @@ class CephManager:
         """
         self.log("waiting till active")
         start = time.time()
+        waiter = self.map_change_waiter()
         while not self.is_active():
             if timeout is not None:
                 if time.time() - start >= timeout:
@@ -1942,7 +3232,7 @@ class CephManager:
                     self.log(out)
                     assert time.time() - start < timeout, \
                         'failed to become active before timeout expired'
-            time.sleep(3)
+            waiter.wait()
         self.log("active!")
 
     def mark_out_osd(self, osd):
@@ -1996,6 +3286,23 @@ class CephManager:
         time.sleep(2)
         self.ctx.daemons.get_daemon('osd', osd, self.cluster).stop()
 
+    def kill_osds(self, osds):
+        """
+        Kill several osds at once.
+        """
+        with parallel() as p:
+            for osd in osds:
+                p.spawn(self.kill_osd, osd)
+
+    def revive_osds(self, osds, timeout=150, skip_admin_check=False):
+        """
+        Revive several osds at once, waiting for their admin sockets in
+        parallel.
+        """
+        with parallel() as p:
+            for osd in osds:
+                p.spawn(self.revive_osd, osd, timeout, skip_admin_check)
+
     def revive_osd(self, osd, timeout=150, skip_admin_check=False):
         """
         Revive osds by either power cycling (if indicated by the config)
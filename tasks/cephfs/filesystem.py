@@ -590,21 +590,22 @@ class Filesystem(MDSCluster):
 
         if active_count >= mds_map['max_mds']:
             # The MDSMap says these guys are active, but let's check they really are
-            for mds_id, mds_status in mds_map['info'].items():
-                if mds_status['state'] == 'up:active':
-                    try:
-                        daemon_status = self.mds_asok(["status"], mds_id=mds_status['name'])
-                    except CommandFailedError as cfe:
-                        if cfe.exitstatus == errno.EINVAL:
-                            # Old version, can't do this check
-                            continue
-                        else:
-                            # MDS not even running
-                            return False
-
-                    if daemon_status['state'] != 'up:active':
-                        # MDS hasn't taken the latest map yet
-                        return False
+            results = self.mon_manager.admin_socket_batch(
+                [('mds', mds_status['name'], ['status'])
+                 for mds_status in mds_map['info'].values()
+                 if mds_status['state'] == 'up:active'])
+            for result in results.values():
+                if result['exitstatus'] == errno.EINVAL:
+                    # Old version, can't do this check
+                    continue
+                elif result['exitstatus'] != 0:
+                    # MDS not even running
+                    return False
+
+                daemon_status = json.loads(result['stdout'])
+                if daemon_status['state'] != 'up:active':
+                    # MDS hasn't taken the latest map yet
+                    return False
 
             return True
         else:
@@ -22,12 +22,14 @@ def task(ctx, config):
          namespace: [<namespace>] default: ['']
          num_objects: [<num_objects>] default: 10
          name_length: [<name_length>] default: [400]
+         ops_in_flight: <ops_in_flight> default: 16
     """
     pool = config.get('pool', 'data')
     num_objects = config.get('num_objects', 10)
     name_length = config.get('name_length', [400])
     namespace = config.get('namespace', [None])
     prefix = config.get('prefix', None)
+    ops_in_flight = config.get('ops_in_flight', 16)
     manager = ctx.managers['ceph']
 
     objects = []
@@ -43,41 +45,28 @@ def task(ctx, config):
                 return prefix + ('a'*fillerlen) + numstr
             objects += [(ns, object_name(i)) for i in  range(num_objects)]
 
-    for ns, name in objects:
-        err = manager.do_put(
-            pool,
-            name,
-            '/etc/resolv.conf',
-            namespace=ns)
-        log.info("err is " + str(err))
-        assert err == 0
+    def run_ops(op, **kwargs):
+        ops = [dict(kwargs, op=op, pool=pool, obj=name, namespace=ns)
+               for ns, name in objects]
+        results = manager.do_rados_batch(ops, max_in_flight=ops_in_flight)
+        log.info("errs are " + str([r['exitstatus'] for r in results]))
+        return results
+
+    results = run_ops('put', fname='/etc/resolv.conf')
+    assert all(r['exitstatus'] == 0 for r in results)
 
     try:
         yield
     finally:
         log.info('ceph_verify_lfn_objects verifying...')
-        for ns, name in objects:
-            err = manager.do_get(
-                pool,
-                name,
-                namespace=ns)
-            log.info("err is " + str(err))
-            assert err == 0
+        results = run_ops('get')
+        assert all(r['exitstatus'] == 0 for r in results)
 
         log.info('ceph_verify_lfn_objects deleting...')
-        for ns, name in objects:
-            err = manager.do_rm(
-                pool,
-                name,
-                namespace=ns)
-            log.info("err is " + str(err))
-            assert err == 0
+        results = run_ops('rm')
+        assert all(r['exitstatus'] == 0 for r in results)
 
         log.info('ceph_verify_lfn_objects verifying absent...')
-        for ns, name in objects:
-            err = manager.do_get(
-                pool,
-                name,
-                namespace=ns)
-            log.info("err is " + str(err))
-            assert err != 0
+        results = run_ops('get')
+        # failing for any other reason (e.g. a lost helper) proves nothing
+        assert all(r.get('not_found') for r in results)
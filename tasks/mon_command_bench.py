@@ -0,0 +1,103 @@
+"""
+Compare ceph command throughput of the ceph CLI and of the persistent
+mon command channel.
+"""
+from cStringIO import StringIO
+import logging
+import time
+
+from teuthology import misc as teuthology
+from util.mon_channel import MonCommandChannel
+
+log = logging.getLogger(__name__)
+
+# answers like the stand-in helper, but pays for a process per command
+STAND_IN = ('import json, sys; '
+            'sys.stdout.write(json.dumps(sys.argv[1:]))')
+
+
+def measure(count, fn):
+    """
+    Call fn count times and return the number of calls per second.
+    """
+    start = time.time()
+    for _ in range(count):
+        fn()
+    return count / (time.time() - start)
+
+
+def task(ctx, config):
+    """
+    Measure commands per second through the ceph CLI and through a
+    MonCommandChannel.
+
+    By default both paths are run against a local stand-in that
+    answers every command without contacting the monitors, so that
+    only the per-command overhead is compared::
+
+        tasks:
+        - ceph:
+        - mon_command_bench:
+            commands: 500
+
+    With ``stand_in: false`` the monitors of the cluster answer
+    ``ceph osd stat`` instead.  The results are recorded in the job
+    summary under ``mon_command_bench``.
+    """
+    if config is None:
+        config = {}
+    assert isinstance(config, dict), \
+        'mon_command_bench task only accepts a dict for configuration'
+    count = config.get('commands', 500)
+    stand_in = config.get('stand_in', True)
+    cluster_name = config.get('cluster', 'ceph')
+    testdir = teuthology.get_testdir(ctx)
+    first_mon = teuthology.get_first_mon(ctx, config, cluster_name)
+    (remote,) = ctx.cluster.only(first_mon).remotes.iterkeys()
+    command = ['osd', 'stat']
+
+    if stand_in:
+        exec_args = ['python', '-c', STAND_IN] + command
+    else:
+        exec_args = [
+            'sudo',
+            'adjust-ulimits',
+            'ceph-coverage',
+            '{tdir}/archive/coverage'.format(tdir=testdir),
+            'timeout',
+            '120',
+            'ceph',
+            '--cluster',
+            cluster_name,
+        ] + command
+
+    def exec_cmd():
+        remote.run(args=exec_args, stdout=StringIO())
+
+    channel = MonCommandChannel(remote, cluster=cluster_name,
+                                stand_in=stand_in)
+
+    def channel_cmd():
+        result = channel.command(command)
+        assert result is not None and result[0] == 0, \
+            'ceph command helper could not run {0}'.format(command)
+
+    try:
+        # the first command starts the helper; keep that out of the rate
+        channel_cmd()
+        log.info('Running %d commands through the ceph CLI...', count)
+        exec_rate = measure(count, exec_cmd)
+        log.info('Running %d commands through the command channel...',
+                 count)
+        channel_rate = measure(count, channel_cmd)
+    finally:
+        channel.close()
+
+    log.info('ceph CLI: %.1f commands/s, command channel: %.1f commands/s',
+             exec_rate, channel_rate)
+    ctx.summary['mon_command_bench'] = {
+        'stand_in': stand_in,
+        'commands': count,
+        'exec_per_sec': exec_rate,
+        'channel_per_sec': channel_rate,
+    }
@@ -16,7 +16,8 @@ ARGS = [
     ('num_objects', 'objects to create', 256 * 1024, int),
     ('object_size', 'size in bytes for objects', 64, int),
     ('creation_time_limit', 'time limit for pool population', 60*60, int),
-    ('create_threads', 'concurrent writes for create', 256, int)
+    ('create_threads', 'concurrent writes for create', 256, int),
+    ('create_writers', 'rados bench processes for create', 4, int)
     ]
 
 def setup(ctx, config):
@@ -27,13 +28,15 @@ def setup(ctx, config):
     manager.clear_pools()
     manager.create_pool(POOLNAME, config.num_pgs)
     log.info("populating pool")
-    manager.rados_write_objects(
+    stats = manager.rados_write_objects(
         POOLNAME,
         config.num_objects,
         config.object_size,
         config.creation_time_limit,
-        config.create_threads)
+        config.create_threads,
+        writers=config.create_writers)
     log.info("done populating pool")
+    return stats
 
 def do_run(ctx, config):
     """
@@ -72,7 +75,7 @@ def task(ctx, config):
     """
     Peering speed test
     """
-    setup(ctx, config)
+    populate = setup(ctx, config)
     manager = ctx.managers['ceph']
     manager.mark_out_osd(0)
     manager.wait_for_clean()
@@ -83,5 +86,6 @@ def task(ctx, config):
 
     manager.mark_in_osd(0)
     ctx.summary['recovery_times'] = {
+        'populate': populate,
         'runs': ret
         }
@@ -36,10 +36,11 @@ def task(ctx, config):
 
     (remote,) = ctx.cluster.only(client).remotes.iterkeys()
 
-    for poolid in range(num_pools):
-        poolname = "%s-%s" % (pool_prefix, str(poolid))
-        log.info("Creating pool %s" % (poolname,))
-        ctx.managers['ceph'].create_pool(poolname)
+    poolnames = ["%s-%s" % (pool_prefix, str(poolid))
+                 for poolid in range(num_pools)]
+    log.info("Creating pools %s" % (poolnames,))
+    ctx.managers['ceph'].create_pools(dict.fromkeys(poolnames))
+    for poolname in poolnames:
         for imageid in range(num_images):
             imagename = "rbd-%s" % (str(imageid),)
             log.info("Creating imagename %s" % (imagename,))
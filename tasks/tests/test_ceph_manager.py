@@ -0,0 +1,558 @@
+import json
+from cStringIO import StringIO
+
+import gevent
+import gevent.queue
+from mock import Mock, patch
+
+from .. import ceph_manager
+
+
+def make_pg_stats(states):
+    return [{'pgid': '1.%x' % i, 'state': state}
+            for i, state in enumerate(states)]
+
+
+def make_manager():
+    with patch.object(ceph_manager.CephManager, 'list_pools',
+                      return_value=[]):
+        return ceph_manager.CephManager(Mock(), ctx=Mock(),
+                                        logger=Mock())
+
+
+class TestPGSnapshot(object):
+
+    def test_counts(self):
+        snap = ceph_manager.PGSnapshot(
+            {'version': 3, 'num_pgs': 5},
+            make_pg_stats(['active+clean',
+                           'active+recovering+degraded',
+                           'stale+active+clean',
+                           'down+peering',
+                           'active+clean']))
+        assert snap.num_active_clean() == 2
+        assert snap.num_active_recovered() == 2
+        assert snap.num_active() == 3
+        assert snap.num_down() == 1
+        assert snap.num_active_down() == 4
+        assert not snap.is_clean()
+        assert snap.histogram()['active'] == 4
+
+    def test_waiting_for_backfill(self):
+        snap = ceph_manager.PGSnapshot(
+            {'version': 3, 'num_pgs': 2},
+            make_pg_stats(['active+clean',
+                           'active+remapped+wait_backfill']))
+        assert snap.num_active_recovered() == 1
+        assert not snap.is_recovered()
+
+    def test_recovery_progress(self):
+        snap = ceph_manager.PGSnapshot({'version': 1}, [])
+        assert not snap.is_making_recovery_progress()
+        snap = ceph_manager.PGSnapshot(
+            {'version': 1, 'recovering_objects_per_sec': 12}, [])
+        assert snap.is_making_recovery_progress()
+
+
+class TestGetPGSnapshot(object):
+
+    def setup(self):
+        self.manager = make_manager()
+        self.version = 1
+        self.dumps = 0
+
+        def raw_cluster_cmd(*args):
+            assert args[:2] == ('pg', 'stat')
+            return json.dumps({'version': self.version, 'num_pgs': 1})
+        self.manager.raw_cluster_cmd = raw_cluster_cmd
+
+        def run(args, **kwargs):
+            assert args[-3:] == ['pg', 'dump', '--format=json']
+            self.dumps += 1
+            return Mock(stdout=StringIO(json.dumps(
+                {'version': self.version,
+                 'pg_stats': make_pg_stats(['active+clean'])})))
+        self.manager.controller.run = run
+
+    def test_reuses_dump_for_same_version(self):
+        assert self.manager.is_clean()
+        assert self.manager.get_num_active_clean() == 1
+        assert self.manager.get_num_pgs() == 1
+        assert self.dumps == 1
+        assert self.manager.get_pg_snapshot_counters() == \
+            {'hits': 2, 'misses': 1}
+
+    def test_refetches_on_new_version(self):
+        self.manager.get_pg_stats()
+        self.version = 2
+        assert self.manager.get_pg_stats()[0]['state'] == 'active+clean'
+        assert self.dumps == 2
+
+    def test_drains_unparsable_dump(self):
+        # the first pg has no state
+        stdout = StringIO(json.dumps(
+            {'version': 1,
+             'pg_stats': [{'pgid': '1.0'}] +
+             make_pg_stats(['active+clean'] * 10000)}))
+        proc = Mock(stdout=stdout)
+        self.manager.controller.run = Mock(return_value=proc)
+        try:
+            self.manager.get_pg_stats()
+        except KeyError:
+            pass
+        else:
+            assert False, 'garbled dump was accepted'
+        assert not stdout.read()
+        proc.wait.assert_called_once_with()
+
+
+class TestClusterMapWatcher(object):
+
+    def test_counts_map_changes(self):
+        manager = Mock()
+        manager.run_ceph_w.return_value.stdout = StringIO(
+            '    osdmap e12: 3 osds: 3 up, 3 in\n'
+            '2017-01-01 mon.0 [INF] pgmap v40: 8 pgs: 8 active+clean\n'
+            '2017-01-01 osd.0 [INF] 1.0 scrub ok\n')
+        watcher = ceph_manager.ClusterMapWatcher(manager, pgmap_interval=0)
+        watcher.start()
+        watcher.thread.join()
+        assert watcher.seq == 2
+        # ceph -w has exited, waiters must poll again
+        assert not watcher.live
+        waiter = ceph_manager.MapChangeWaiter(watcher, interval=0)
+        waiter.wait()
+
+    def test_pgmap_wakes_rate_limited(self):
+        lines = gevent.queue.Queue()
+        manager = Mock()
+        manager.run_ceph_w.return_value.stdout.readline = lines.get
+        watcher = ceph_manager.ClusterMapWatcher(manager,
+                                                 pgmap_interval=0.2)
+        watcher.start()
+        for v in range(10):
+            lines.put('mon.0 [INF] pgmap v%d: 8 pgs: 8 active+clean\n' % v)
+        gevent.sleep(0.05)
+        # the first pgmap wakes, the others wait for pgmap_interval
+        assert watcher.seq == 1
+        lines.put('    osdmap e12: 3 osds: 2 up, 3 in\n')
+        gevent.sleep(0.05)
+        assert watcher.seq == 2
+        lines.put('mon.0 [INF] pgmap v10: 8 pgs: 8 active+clean\n')
+        gevent.sleep(0.3)
+        assert watcher.seq == 3
+        lines.put('')
+        watcher.thread.join()
+
+
+class TestAdminSocketBatch(object):
+
+    def test_partial_results(self):
+        manager = make_manager()
+
+        def find_remote(service_type, service_id):
+            remote = Mock()
+            remote.name = 'host%d' % (service_id % 2)
+            return remote
+        manager.find_remote = find_remote
+        running = []
+
+        def admin_socket(service_type, service_id, command, check_status,
+                         timeout, stdout):
+            running.append(service_id)
+            assert len(running) <= 2
+            stdout.write('{0}.{1} {2}'.format(service_type, service_id,
+                                              ' '.join(command)))
+            gevent.sleep(5 if service_id == 3 else 0.01)
+            running.remove(service_id)
+            return Mock(exitstatus=0)
+        manager.admin_socket = admin_socket
+
+        results = manager.admin_socket_batch(
+            [('osd', i, ['dump_ops_in_flight']) for i in range(4)],
+            timeout=0.5, per_remote=1)
+        assert len(results) == 4
+        done = results[('osd', 0, ('dump_ops_in_flight',))]
+        assert done['exitstatus'] == 0
+        assert done['stdout'] == 'osd.0 dump_ops_in_flight'
+        assert done['duration'] < 0.5
+        slow = results[('osd', 3, ('dump_ops_in_flight',))]
+        assert slow['exitstatus'] is None
+        assert slow['stdout'] == 'osd.3 dump_ops_in_flight'
+
+
+class TestRadosWriteObjects(object):
+
+    def test_writers(self):
+        manager = make_manager()
+        calls = []
+
+        def do_rados(remote, args, stdout):
+            calls.append((remote, args))
+            count = args[args.index('--num-objects') + 1]
+            stdout.write('Total writes made:      {0}\n'.format(count))
+        manager.do_rados = do_rados
+
+        stats = manager.rados_write_objects('data', 10, 4096, 60, 8,
+                                            writers=3, remotes=['a', 'b'])
+        assert [remote for remote, _ in calls] == ['a', 'b', 'a']
+        assert [args[args.index('--num-objects') + 1]
+                for _, args in calls] == ['4', '3', '3']
+        assert all(args[args.index('-t') + 1] == '3' for _, args in calls)
+        assert len(set(args[args.index('--run-name') + 1]
+                       for _, args in calls)) == 3
+        assert stats['objects'] == 10
+        assert stats['bytes'] == 40960
+        assert stats['objects_per_sec'] > 0
+
+
+class TestThrasherTrace(object):
+
+    def make_thrasher(self, trace=None, seed=42):
+        with patch.object(ceph_manager.Thrasher, '__init__',
+                          lambda self: None):
+            thrasher = ceph_manager.Thrasher()
+        thrasher.seed = seed
+        thrasher.rng = ceph_manager.random.Random(seed)
+        thrasher.action_seq = 0
+        thrasher.action_osd = None
+        thrasher.action_pool = None
+        thrasher.trace = trace
+        thrasher.stopping = False
+        thrasher.log = Mock()
+        thrasher.ceph_manager = Mock()
+        thrasher.ceph_manager.get_osd_epoch.side_effect = [5, 6, 7, 8]
+        thrasher.in_osds = [0, 1, 2, 3]
+        thrasher.out_osds = []
+        thrasher.victim_strategy = 'random'
+        thrasher.victim_metric = 'pgs'
+        thrasher.osd_loads = {}
+        return thrasher
+
+    def test_pick_victim(self):
+        thrasher = self.make_thrasher()
+        thrasher.victim_strategy = 'max'
+        thrasher.ceph_manager.get_pg_snapshot.return_value.index.\
+            osd_loads.return_value = {0: {'pgs': 1000}, 1: {'pgs': 0}}
+        thrasher.refresh_osd_loads()
+        picks = [thrasher.pick_victim([0, 1]) for _ in range(100)]
+        assert picks.count(0) > 90
+        thrasher.victim_strategy = 'min'
+        picks = [thrasher.pick_victim([0, 1]) for _ in range(100)]
+        assert picks.count(1) > 90
+
+    def test_record_and_replay(self):
+        trace = Mock()
+        thrasher = self.make_thrasher(trace)
+        thrasher.run_action(thrasher.primary_affinity)
+        thrasher.run_action(thrasher.primary_affinity)
+        calls = thrasher.ceph_manager.raw_cluster_cmd.call_args_list
+        seq, _, action, args, osd, _, before, after = \
+            trace.record.call_args_list[1][0]
+        assert (seq, action, before, after) == (2, 'primary_affinity', 7, 8)
+        assert calls[1][0][2] == str(osd)
+
+        records = [dict(seq=c[0][0], time=0, action=c[0][2], args=c[0][3],
+                        osd=c[0][4]) for c in trace.record.call_args_list]
+        replayer = self.make_thrasher(seed=42)
+        replayer.replay_trace = records
+        replayer.replay()
+        assert replayer.ceph_manager.raw_cluster_cmd.call_args_list == calls
+
+    def test_replay_pool(self):
+        trace = Mock()
+        thrasher = self.make_thrasher(trace)
+        thrasher.max_pgs = 100
+        thrasher.config = {}
+        thrasher.ceph_manager = make_manager()
+        thrasher.ceph_manager.pools = dict.fromkeys('abcdefgh', 8)
+        thrasher.ceph_manager.expand_pool = Mock()
+        thrasher.ceph_manager.get_osd_epoch = Mock(return_value=5)
+        thrasher.run_action(thrasher.grow_pool)
+        pool = trace.record.call_args[1]['pool']
+        thrasher.ceph_manager.expand_pool.assert_called_with(pool, 10, 100)
+
+        replayer = self.make_thrasher(seed=7)
+        replayer.max_pgs = 100
+        replayer.config = {}
+        replayer.ceph_manager.get_pool.side_effect = AssertionError
+        replayer.replay_trace = [dict(seq=1, time=0, action='grow_pool',
+                                      args=[], osd=None, pool=pool)]
+        replayer.replay()
+        replayer.ceph_manager.expand_pool.assert_called_with(pool, 10, 100)
+
+    def test_replay_clean_up(self):
+        trace = Mock()
+        thrasher = self.make_thrasher(trace)
+        thrasher.config = {}
+        thrasher.clean_wait = 0
+        thrasher.revive_timeout = 75
+        thrasher.dead_osds = [1, 2]
+        thrasher.live_osds = [0, 3]
+        thrasher.run_action(thrasher.clean_up, False, False)
+        calls = thrasher.ceph_manager.revive_osd.call_args_list
+        _, _, action, args, osd, _, _, _ = trace.record.call_args[0]
+        # the target is the first osd revived by clean_up
+        assert (action, osd) == ('clean_up', calls[0][0][0])
+
+        replayer = self.make_thrasher(seed=42)
+        replayer.config = {}
+        replayer.clean_wait = 0
+        replayer.revive_timeout = 75
+        replayer.dead_osds = [1, 2]
+        replayer.live_osds = [0, 3]
+        replayer.replay_trace = [dict(seq=1, time=0, action=action,
+                                      args=args, osd=osd)]
+        replayer.replay()
+        assert replayer.ceph_manager.revive_osd.call_args_list == calls
+
+    def test_thrash_group(self):
+        thrasher = self.make_thrasher()
+        thrasher.config = {'failure_domain': 'rack'}
+        thrasher.minin = 1
+        thrasher.live_osds = [0, 1, 2, 3]
+        thrasher.dead_osds = []
+        thrasher.ceph_manager.get_osd_failure_domains.return_value = {
+            'rack1': [0, 1], 'rack2': [2, 3]}
+        thrasher.rng.choice = lambda seq: seq[0]
+        thrasher.thrash_group()
+        thrasher.ceph_manager.get_osd_failure_domains.assert_called_with(
+            'rack')
+        thrasher.ceph_manager.kill_osds.assert_called_with([0, 1])
+        assert thrasher.dead_osds == [0, 1]
+        assert thrasher.action_osd == [0, 1]
+        # with min_live 2, the other rack can not go down too
+        thrasher.action_osd = None
+        thrasher.thrash_group(osd=[2, 3])
+        thrasher.ceph_manager.raw_cluster_cmd.assert_called_with(
+            'osd', 'out', '2', '3')
+
+
+class TestFailureDomains(object):
+
+    def test_osd_tree(self):
+        manager = make_manager()
+        manager.raw_cluster_cmd = lambda *args: json.dumps({'nodes': [
+            {'id': -1, 'name': 'default', 'type': 'root',
+             'children': [-4]},
+            {'id': -4, 'name': 'rack1', 'type': 'rack',
+             'children': [-2, -3]},
+            {'id': -2, 'name': 'host1', 'type': 'host', 'children': [0, 1]},
+            {'id': -3, 'name': 'host2', 'type': 'host', 'children': [2]},
+            {'id': 0, 'name': 'osd.0', 'type': 'osd'},
+            {'id': 1, 'name': 'osd.1', 'type': 'osd'},
+            {'id': 2, 'name': 'osd.2', 'type': 'osd'},
+        ], 'stray': []})
+        assert manager.get_osd_failure_domains() == \
+            {'host1': [0, 1], 'host2': [2]}
+        assert manager.get_osd_failure_domains('rack') == \
+            {'rack1': [0, 1, 2]}
+
+
+class TestObjectStoreToolSession(object):
+
+    def test_session(self):
+        manager = Mock()
+        manager.get_object_pg_with_shard.return_value = '1.7'
+        manager.get_filepath.return_value = '/var/lib/ceph/osd/ceph-{id}'
+        remote = Mock()
+        manager.ctx.cluster.only.return_value.remotes.keys.return_value = \
+            [remote]
+        scripts = []
+        spec = '["1.7",{"oid":"foo","key":"","snapid":-2}]'
+
+        def run(args, stdout, **kwargs):
+            scripts.append(args[-1])
+            if '--op list' in args[-1]:
+                stdout.write('["1.7",{"oid":"bar"}]\n' + spec + '\n')
+            return Mock(exitstatus=0)
+        remote.run = run
+
+        tool = ceph_manager.ObjectStoreTool(manager, 'data', osd=1,
+                                            object_name='foo')
+        with tool.session():
+            tool.run('', 'get-bytes')
+            tool.queue('', 'set-bytes /tmp/x')
+            tool.queue('', 'list-attrs')
+            tool.run('', 'remove')
+            assert not tool.listings
+        manager.kill_osd.assert_called_once_with(1)
+        manager.revive_osd.assert_called_once_with(1)
+        # one listing, then get-bytes, then both queued operations
+        # together, then remove
+        assert len(scripts) == 4
+        assert '--op list' in scripts[0]
+        assert scripts[2].count('ceph-objectstore-tool') == 2
+        assert "'{0}' remove".format(spec) in scripts[3]
+        assert 'grep' not in ''.join(scripts)
+
+    def test_queue_after_listing_change(self):
+        manager = Mock()
+        manager.get_object_pg_with_shard.return_value = '1.7'
+        manager.get_filepath.return_value = '/var/lib/ceph/osd/ceph-{id}'
+        remote = Mock()
+        manager.ctx.cluster.only.return_value.remotes.keys.return_value = \
+            [remote]
+        scripts = []
+        listing = ['["1.7",{"oid":"foo","snapid":-2}]']
+
+        def run(args, stdout, **kwargs):
+            scripts.append(args[-1])
+            if '--op list' in args[-1]:
+                stdout.write('\n'.join(listing) + '\n')
+            if '--op import' in args[-1]:
+                listing[0] = '["1.7",{"oid":"foo","snapid":4}]'
+            return Mock(exitstatus=0)
+        remote.run = run
+
+        tool = ceph_manager.ObjectStoreTool(manager, 'data', osd=0,
+                                            object_name='foo')
+        with tool.session(stop=False):
+            tool.queue('--op import --file /tmp/exp', '')
+            tool.queue('', 'get-bytes')
+        assert not manager.kill_osd.called
+        # the import runs before foo is looked up again in a fresh
+        # listing
+        assert len(scripts) == 4
+        assert '--op list' in scripts[0]
+        assert '--op import' in scripts[1]
+        assert '--op list' in scripts[2]
+        assert '"snapid":4' in scripts[3]
+
+
+class TestBulkPools(object):
+
+    def test_create_and_remove(self):
+        manager = make_manager()
+        cmds = []
+        manager.raw_cluster_cmd = lambda *args: cmds.append(args)
+        manager.raw_cluster_cmd_result = lambda *args: cmds.append(args)
+        manager.do_rados = lambda remote, args: cmds.append(tuple(args))
+        manager.get_osd_epoch = Mock(return_value=12)
+        manager.get_osd_dump_json = Mock(return_value={'pools': [
+            {'pool_name': 'a', 'pool': 1}, {'pool_name': 'b', 'pool': 2}]})
+        snaps = [
+            ceph_manager.PGSnapshot({}, [
+                {'pgid': '1.0', 'state': 'creating'},
+                {'pgid': '2.0', 'state': 'active+clean'}]),
+            ceph_manager.PGSnapshot({}, [
+                {'pgid': '1.0', 'state': 'active+clean'},
+                {'pgid': '2.0', 'state': 'active+clean'}]),
+            ceph_manager.PGSnapshot({}, []),
+        ]
+        manager.get_pg_snapshot = lambda: snaps.pop(0)
+
+        with patch.object(ceph_manager.time, 'sleep') as sleep:
+            stats = manager.create_pools({
+                'a': {'pg_num': 1, 'properties': {'size': 2}},
+                'b': {'pg_num': 1, 'min_size': 1}})
+        assert sleep.call_count == 1
+        assert stats['pools'] == 2
+        assert stats['epoch'] == 12
+        assert manager.pools == {'a': 1, 'b': 1}
+        assert ('osd', 'pool', 'set', 'a', 'size', '2') in cmds
+        assert ('osd', 'pool', 'set', 'b', 'min_size', '1') in cmds
+
+        stats = manager.remove_pools(['a', 'b'])
+        assert stats['pools'] == 2
+        assert manager.pools == {}
+        assert ('rmpool', 'a', 'a', '--yes-i-really-really-mean-it') in cmds
+        assert not snaps
+
+    def test_create_failure_keeps_created(self):
+        manager = make_manager()
+
+        def raw_cluster_cmd(*args):
+            if args[:4] == ('osd', 'pool', 'create', 'b'):
+                raise ceph_manager.CommandFailedError(args, 22)
+        manager.raw_cluster_cmd = raw_cluster_cmd
+        try:
+            manager.create_pools({'a': {'pg_num': 1}, 'b': {'pg_num': 1}})
+        except ceph_manager.CommandFailedError:
+            pass
+        else:
+            assert False, 'failed create was ignored'
+        assert manager.pools == {'a': 1}
+
+
+class TestOSDMapLookups(object):
+
+    def test_cached_per_epoch(self):
+        manager = make_manager()
+        self.epoch = 5
+        cmds = []
+
+        def raw_cluster_cmd(*args):
+            cmds.append(args)
+            if args[:2] == ('osd', 'stat'):
+                return json.dumps({'epoch': self.epoch})
+            if args[:2] == ('pg', 'map'):
+                return json.dumps({'pgid': args[2], 'acting': [3, 1]})
+            if args[:2] == ('osd', 'dump'):
+                return '\n' + json.dumps({'pools': [
+                    {'pool_name': 'data', 'pool': 1, 'type': 1}]})
+            name = args[-1]
+            return '\n' + json.dumps({'pgid': '1.%d' % len(name),
+                                      'acting': [0, 2],
+                                      'acting_primary': 0})
+        manager.raw_cluster_cmd = raw_cluster_cmd
+
+        maps = manager.get_object_maps('data', ['a', 'bb', 'ccc'])
+        assert maps['bb']['pgid'] == '1.2'
+        assert manager.get_object_pg_with_shard('data', 'ccc', 2) == '1.3'
+        assert manager.get_object_primary('data', 'a') == 0
+        assert manager.get_pg_primary('data', 0) == 3
+        assert manager.get_pg_replica('data', 0) == 1
+        lookups = [cmd for cmd in cmds if cmd[:2] != ('osd', 'stat')]
+        assert len(lookups) == 5
+        counters = manager.get_osdmap_cache_counters()
+        assert counters['misses'] == 5
+        assert counters['epoch'] == 5
+
+        self.epoch = 6
+        manager.get_object_primary('data', 'a')
+        assert len([cmd for cmd in cmds if cmd[:2] != ('osd', 'stat')]) == 6
+        assert manager.get_osdmap_cache_counters()['invalidations'] == 1
+
+    def test_lagging_watcher(self):
+        manager = make_manager()
+        manager.map_watcher = Mock(live=True, seq=1, osdmap_epoch=5)
+        epochs = {'mon': 5}
+        cmds = []
+
+        def run(args, stdout=None, **kwargs):
+            args = tuple(args[args.index('ceph') + 3:])
+            cmds.append(args)
+            if args[:2] == ('osd', 'out'):
+                epochs['mon'] += 1
+            elif args[:2] == ('osd', 'stat'):
+                stdout.write(json.dumps({'epoch': epochs['mon']}))
+            else:
+                stdout.write('\n' + json.dumps(
+                    {'epoch': epochs['mon'], 'acting_primary': epochs['mon']}))
+            return Mock(stdout=stdout, exitstatus=0)
+        manager.controller.run = run
+
+        def osd_stats():
+            return len([cmd for cmd in cmds if cmd[:2] == ('osd', 'stat')])
+
+        # within one epoch announced by ceph -w, lookups cost nothing
+        assert manager.get_object_primary('data', 'a') == 5
+        assert manager.get_object_primary('data', 'a') == 5
+        assert osd_stats() == 0
+        assert len(cmds) == 1
+        # ceph -w has not announced the map the manager just made
+        manager.raw_cluster_cmd('osd', 'out', '3')
+        assert manager.get_object_primary('data', 'a') == 6
+        assert manager.get_object_primary('data', 'a') == 6
+        assert osd_stats() == 2
+        manager.map_watcher.osdmap_epoch = 6
+        assert manager.get_object_primary('data', 'a') == 6
+        assert osd_stats() == 2
+        assert len(cmds) == 5
+        # another client moves the map on before ceph -w announces it:
+        # the answer from the newer map is not kept for epoch 6
+        epochs['mon'] = 7
+        assert manager.get_object_primary('data', 'b') == 7
+        assert manager.get_object_primary('data', 'b') == 7
+        assert len(cmds) == 7
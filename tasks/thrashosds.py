@@ -109,6 +109,11 @@ def task(ctx, config):
 
     ceph_objectstore_tool: (true) whether to export/import a pg while an osd is down
     chance_move_pg: (1.0) chance of moving a pg if more than 1 osd is down (default 100%)
+    pg_moves: (1) when moving a pg, also move a pg between each of up to
+        pg_moves - 1 further pairs of down osds, all at once; moves stream
+        the export straight into the import
+    pg_move_compression: (none) gzip, lz4 or zstd to compress pg moves
+        between hosts
 
     optrack_toggle_delay: (2.0) duration to delay between toggling op tracker
                   enablement to all osds
@@ -120,6 +125,40 @@ def task(ctx, config):
     disable_objectstore_tool_tests: (false) disable ceph_objectstore_tool based
                                     tests
 
+    chance_thrash_group: (0) chance to kill, revive, mark out or mark in
+        several osds of one failure domain at once; killed osds are
+        stopped, and revived osds waited for, in parallel
+    failure_domain: (host) crush bucket type grouping the osds for
+        chance_thrash_group
+    group_size: (0) act on at most this many osds of the failure domain
+        (0 for all of them)
+    group_wait_recovery: (false) after a group kill or out, wait for
+        recovery and log how long it took
+
+    adaptive_pacing: (false) instead of the fixed op_delay and
+        clean_interval, adjust the delay between actions and the chance
+        of waiting for recovery every cycle, to keep the fraction of
+        degraded and misplaced objects near target_degraded_fraction
+    target_degraded_fraction: (0.1) see adaptive_pacing
+    min_op_delay: (1) shortest delay between actions with adaptive_pacing
+    max_op_delay: (60) longest delay between actions with adaptive_pacing
+
+    victim_strategy: (random) how kill and out actions choose their osd:
+        random, max to favor the osds whose loss causes the most recovery
+        and peering work, or min to favor the least (for soak runs)
+    victim_metric: (pgs) what max and min rank osds by, from the pg dump
+        taken each cycle: pgs, primaries, bytes or degraded (pgs)
+
+    seed: (random) seed for the thrasher's random choices; the seed used
+          is logged and written to the trace
+
+    trace: (true) record every thrasher action (start time, action, target
+           osd, duration, osdmap epochs before and after) in
+           thrash/<cluster>.trace.jsonl in the archive, as it happens
+
+    replay: (none) path to a trace from an earlier run; instead of choosing
+            actions, repeat the traced ones at their original times
+
     example:
 
     tasks:
@@ -192,4 +231,8 @@ def task(ctx, config):
     finally:
         log.info('joining thrashosds')
         thrash_proc.do_join()
+        if thrash_proc.pacer is not None:
+            ctx.summary['thrash_pacing'] = thrash_proc.pacer.summary()
+        if thrash_proc.pg_move_stats:
+            ctx.summary['thrash_pg_moves'] = thrash_proc.pg_move_stats
         cluster_manager.wait_for_recovery(config.get('timeout', 360))
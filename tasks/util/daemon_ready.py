@@ -0,0 +1,94 @@
+"""
+Readiness barrier for freshly started daemons.
+
+wait_ready() asks each daemon of a node over its admin socket for its
+state until it reports that it is ready: an osd in the active state, a
+mon in quorum, an mds in an up: state, or, for other types, any answer
+at all.  It reports how long each daemon took.
+"""
+import json
+import logging
+from cStringIO import StringIO
+
+log = logging.getLogger(__name__)
+
+ASOK = '/var/run/ceph/{cluster}-{type}.{id}.asok'
+
+PROBER = """
+import json
+import os
+import subprocess
+import sys
+import time
+
+READY = {
+    'osd': ('status', lambda j: j.get('state') == 'active'),
+    'mon': ('mon_status', lambda j: j.get('state') in ('leader', 'peon')),
+    'mds': ('status', lambda j: j.get('state', '').startswith('up:')),
+}
+
+request = json.loads(sys.argv[1])
+start = time.time()
+pending = dict((daemon['role'], daemon) for daemon in request['daemons'])
+latency = dict((role, None) for role in pending)
+devnull = open(os.devnull, 'w')
+while pending and time.time() - start < request['timeout']:
+    for role, daemon in list(pending.items()):
+        if not os.path.exists(daemon['asok']):
+            continue
+        command, ready = READY.get(daemon['type'],
+                                   ('version', lambda j: True))
+        proc = subprocess.Popen(
+            ['ceph', '--admin-daemon', daemon['asok'], command],
+            stdout=subprocess.PIPE, stderr=devnull)
+        out = proc.communicate()[0]
+        if proc.returncode != 0:
+            continue
+        try:
+            state = json.loads(out)
+        except ValueError:
+            continue
+        if ready(state):
+            latency[role] = time.time() - start
+            del pending[role]
+    if pending:
+        time.sleep(request['interval'])
+json.dump(latency, sys.stdout)
+"""
+
+
+def wait_ready(remote, cluster, daemons, timeout=300, interval=0.2):
+    """
+    Wait until the daemons of one node report that they are ready.
+
+    :param daemons: (role, type, id) of each daemon to wait for
+    :returns: dict mapping each role to the seconds it took to become
+              ready, or None for the daemons which were not ready
+              within timeout (or if the prober failed)
+    """
+    request = {
+        'timeout': timeout,
+        'interval': interval,
+        'daemons': [
+            {'role': role, 'type': type_,
+             'asok': ASOK.format(cluster=cluster, type=type_, id=id_)}
+            for role, type_, id_ in daemons],
+    }
+    stdout = StringIO()
+    proc = remote.run(
+        args=['sudo', 'python', '-c', PROBER, json.dumps(request)],
+        stdout=stdout,
+        stderr=StringIO(),
+        check_status=False,
+    )
+    if proc.exitstatus != 0:
+        log.warning('probing daemons on %s failed: %s', remote.shortname,
+                    proc.stderr.getvalue().strip())
+        return dict((role, None) for role, _, _ in daemons)
+    latency = json.loads(stdout.getvalue())
+    for role, seconds in sorted(latency.iteritems()):
+        if seconds is None:
+            log.warning('%s was not ready after %ds', role, timeout)
+        else:
+            log.info('%s ready after %.1fs', role, seconds)
+    return latency
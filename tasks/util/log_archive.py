@@ -0,0 +1,147 @@
+"""
+Concurrent archival of daemon logs.
+
+Each node compresses its logs with as many cores as it has (pigz, or
+one gzip per core), then streams them as a tar over its existing
+connection straight into the job archive.  All nodes are archived at
+once, optionally under a shared bandwidth cap so that a large job does
+not saturate the teuthology host's link.
+"""
+import logging
+import os
+import tarfile
+import time
+
+import gevent
+
+from teuthology.orchestra import run
+from teuthology.parallel import parallel
+
+log = logging.getLogger(__name__)
+
+# compress every *.log under the directory given as $1, with pigz when
+# the node has it and otherwise with one gzip per core
+COMPRESS = """
+if command -v pigz >/dev/null 2>&1; then
+    find "$1" -name '*.log' -print0 | xargs -0 --no-run-if-empty -- pigz --
+else
+    find "$1" -name '*.log' -print0 |
+        xargs -0 --no-run-if-empty -P "$(nproc)" -n 1 -- gzip --
+fi
+"""
+
+
+class BandwidthLimiter(object):
+    """
+    Token bucket shared by the streams of all nodes.
+
+    :param bytes_per_sec: the cap; None or 0 for no cap
+    """
+
+    def __init__(self, bytes_per_sec):
+        self.rate = float(bytes_per_sec or 0)
+        self.next_free = time.time()
+
+    def consume(self, nbytes):
+        """
+        Account for nbytes just received, sleeping for as long as the
+        cap requires.
+        """
+        if not self.rate:
+            return
+        now = time.time()
+        self.next_free = max(self.next_free, now) + nbytes / self.rate
+        delay = self.next_free - now
+        if delay > 0:
+            gevent.sleep(delay)
+
+
+class MeteredReader(object):
+    """
+    File-like wrapper which counts, and rate limits, what is read.
+    """
+
+    def __init__(self, f, limiter):
+        self.f = f
+        self.limiter = limiter
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.bytes += len(data)
+        self.limiter.consume(len(data))
+        return data
+
+
+def extract(tar, localdir):
+    """
+    Extract the regular files of a streamed tar under localdir,
+    skipping any entry whose path would leave it.
+    """
+    root = os.path.abspath(localdir)
+    for ti in tar:
+        if not ti.isfile():
+            continue
+        target = os.path.abspath(os.path.join(root, ti.name))
+        if not target.startswith(root + os.sep):
+            log.warning('skipping %s from log archive', ti.name)
+            continue
+        if not os.path.isdir(os.path.dirname(target)):
+            os.makedirs(os.path.dirname(target))
+        tar.makefile(ti, target)
+
+
+def archive_remote(remote, remotedir, localdir, limiter, compress=True):
+    """
+    Compress the logs of one node and stream them into localdir.
+
+    :returns: dict with the 'bytes' transferred and the 'seconds' spent
+              compressing ('compress_seconds') and in all
+    """
+    start = time.time()
+    if compress:
+        remote.run(args=['sudo', 'bash', '-c', COMPRESS, '-', remotedir])
+    compressed = time.time()
+    os.makedirs(localdir)
+    proc = remote.run(
+        args=['sudo', 'tar', 'cf', '-', '-C', remotedir, '--', '.'],
+        stdout=run.PIPE,
+        wait=False,
+    )
+    reader = MeteredReader(proc.stdout, limiter)
+    extract(tarfile.open(mode='r|', fileobj=reader), localdir)
+    proc.wait()
+    stats = {
+        'bytes': reader.bytes,
+        'compress_seconds': compressed - start,
+        'seconds': time.time() - start,
+    }
+    log.info('archived {bytes} bytes of logs from {remote} in '
+             '{seconds:.1f}s ({compress_seconds:.1f}s compressing)'.format(
+                 remote=remote.shortname, **stats))
+    return stats
+
+
+def archive_logs(remotes, remotedir, localdir, bandwidth=None,
+                 compress=True):
+    """
+    Archive remotedir of every remote into localdir/<shortname>/log, all
+    at once.
+
+    :param bandwidth: cap on the combined transfer rate, in bytes/sec
+    :returns: dict mapping the shortname of each remote to the stats of
+              archive_remote()
+    """
+    limiter = BandwidthLimiter(bandwidth)
+    stats = {}
+
+    def archive(remote):
+        stats[remote.shortname] = archive_remote(
+            remote, remotedir,
+            os.path.join(localdir, remote.shortname, 'log'),
+            limiter, compress=compress)
+
+    with parallel() as p:
+        for remote in remotes:
+            p.spawn(archive, remote)
+    return stats
@@ -0,0 +1,241 @@
+"""
+Size triggered rotation of daemon logs.
+
+A watcher on each node stats the logs of each daemon type every
+POLL_INTERVAL seconds and runs logrotate, with the stanza of that
+daemon type alone, once one of its logs grows past the limit.  It reports
+the number of rotations and the peak growth rate of the logs of each
+daemon type as they change.
+"""
+import errno
+import json
+import logging
+import re
+import socket
+
+import gevent
+import gevent.event
+
+from teuthology import exceptions
+from teuthology.orchestra import run
+
+log = logging.getLogger(__name__)
+
+POLL_INTERVAL = 1.0
+# longest time between two reports of a watcher whose stats changed
+REPORT_INTERVAL = 10.0
+# time between two attempts to restart a watcher which went away
+RESPAWN_INTERVAL = 30.0
+
+# the sizes logrotate takes: bytes, or kilo-, mega- or gigabytes
+SIZE_RE = re.compile(r'^(\d+)([kMG]?)$')
+SIZE_UNITS = {'': 1, 'k': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+
+WATCHER = """
+import glob
+import json
+import os
+import select
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+request = json.loads(sys.argv[1])
+interval = request['interval']
+confdir = tempfile.mkdtemp(prefix='ceph-log-rotate.')
+daemons = {}
+for daemon, spec in request['daemons'].items():
+    conf = os.path.join(confdir, daemon + '.conf')
+    with open(conf, 'w') as f:
+        f.write(spec['stanza'])
+    daemons[daemon] = {
+        'pattern': os.path.join(request['log_dir'],
+                                '*{0}*.log'.format(daemon)),
+        'limit': spec['limit'],
+        'conf': conf,
+        'sizes': {},
+        'rotations': 0,
+        'peak_bytes_per_sec': 0.0,
+    }
+
+
+def stat(daemon):
+    sizes = {}
+    for path in glob.glob(daemon['pattern']):
+        try:
+            sizes[path] = os.stat(path).st_size
+        except OSError:
+            pass
+    return sizes
+
+
+def report():
+    json.dump(dict((name, {'rotations': daemon['rotations'],
+                           'peak_bytes_per_sec': daemon['peak_bytes_per_sec']})
+                   for name, daemon in daemons.items()), sys.stdout)
+    sys.stdout.write('\\n')
+    sys.stdout.flush()
+
+
+for daemon in daemons.values():
+    daemon['sizes'] = stat(daemon)
+last = reported = time.time()
+try:
+    while True:
+        readable, _, _ = select.select([sys.stdin], [], [], interval)
+        if readable and not os.read(sys.stdin.fileno(), 4096):
+            break
+        now = time.time()
+        changed = False
+        for daemon in daemons.values():
+            sizes = stat(daemon)
+            grown = 0
+            for path, size in sizes.items():
+                before = daemon['sizes'].get(path, 0)
+                # a log smaller than before was rotated from outside
+                grown += size - before if size >= before else size
+            rate = grown / max(now - last, 1e-6)
+            if rate > daemon['peak_bytes_per_sec']:
+                daemon['peak_bytes_per_sec'] = rate
+                changed = True
+            # logrotate leaves a log alone until it is past the limit
+            if any(size > daemon['limit'] for size in sizes.values()):
+                status = subprocess.call(['logrotate', daemon['conf']],
+                                         stdout=sys.stderr)
+                rotated = stat(daemon)
+                if status == 0 and any(
+                        rotated.get(path, 0) < size
+                        for path, size in sizes.items()):
+                    daemon['rotations'] += 1
+                    # reported at once, so that a power cycle loses none
+                    reported = 0
+                sizes = rotated
+            daemon['sizes'] = sizes
+        last = now
+        if changed and now - reported >= request['report_interval'] or \\
+                not reported:
+            report()
+            reported = now
+finally:
+    shutil.rmtree(confdir, ignore_errors=True)
+report()
+"""
+
+
+def parse_size(size):
+    """
+    Parse a size in logrotate syntax.
+
+    :param size: a number of bytes, optionally followed by 'k', 'M' or 'G'
+    :returns: the number of bytes
+    :raises: ConfigError if logrotate would not take the size
+    """
+    match = SIZE_RE.match(str(size))
+    if not match:
+        raise exceptions.ConfigError(
+            "invalid log-rotate size {0!r}, expected a number of bytes "
+            "optionally followed by 'k', 'M' or 'G'".format(size))
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+class LogRotateWatcher(object):
+    """
+    The watchers of a cluster.
+
+    Each node's watcher is supervised: one which goes away (the node
+    was power cycled, the connection dropped) is started again every
+    respawn_interval seconds until it runs, and the stats it reported
+    before going away are kept.
+
+    :param daemons: dict mapping each daemon type to its size limit, in
+                    logrotate syntax (e.g. '1G')
+    :param stanzas: dict mapping each daemon type to its logrotate
+                    stanza
+    :raises: ConfigError if a size limit is not in logrotate syntax
+    """
+
+    def __init__(self, daemons, stanzas, log_dir='/var/log/ceph',
+                 interval=POLL_INTERVAL, report_interval=REPORT_INTERVAL,
+                 respawn_interval=RESPAWN_INTERVAL):
+        self.request = json.dumps({
+            'log_dir': log_dir,
+            'interval': interval,
+            'report_interval': report_interval,
+            'daemons': dict(
+                (daemon, {'limit': parse_size(size),
+                          'stanza': stanzas[daemon]})
+                for daemon, size in daemons.iteritems()),
+        })
+        self.respawn_interval = respawn_interval
+        self.stop_event = gevent.event.Event()
+        self.procs = {}
+        self.supervisors = []
+        self.stats = {}
+
+    def begin(self, remotes):
+        for remote in remotes:
+            self.supervisors.append(gevent.spawn(self._supervise, remote))
+
+    def _supervise(self, remote):
+        while not self.stop_event.is_set():
+            node_stats = None
+            try:
+                proc = remote.run(
+                    args=['sudo', 'python', '-c', WATCHER, self.request],
+                    stdin=run.PIPE,
+                    stdout=run.PIPE,
+                    check_status=False,
+                    wait=False,
+                )
+                self.procs[remote.shortname] = proc
+                for line in iter(proc.stdout.readline, ''):
+                    node_stats = json.loads(line)
+                proc.wait()
+            except (exceptions.ConnectionLostError, EOFError,
+                    ValueError) as e:
+                # nodes are allowed to be power cycled during tests,
+                # which takes their watcher down with them
+                log.debug("Lost the log rotation watcher on '{0}': "
+                          "{1!r}".format(remote.shortname, e))
+            except socket.error as e:
+                if e.errno != errno.EHOSTUNREACH:
+                    raise
+                log.debug("Lost the log rotation watcher on '{0}', host "
+                          "unreachable".format(remote.shortname))
+            finally:
+                self.procs.pop(remote.shortname, None)
+                if node_stats is not None:
+                    self._add(node_stats)
+            if self.stop_event.wait(timeout=self.respawn_interval):
+                break
+            log.info("Restarting the log rotation watcher on "
+                     "'{0}'".format(remote.shortname))
+
+    def _add(self, node_stats):
+        for daemon, counts in node_stats.iteritems():
+            total = self.stats.setdefault(
+                daemon, {'rotations': 0, 'peak_bytes_per_sec': 0.0})
+            total['rotations'] += counts['rotations']
+            total['peak_bytes_per_sec'] = max(
+                total['peak_bytes_per_sec'], counts['peak_bytes_per_sec'])
+
+    def end(self):
+        """
+        Stop the watchers.
+
+        :returns: dict mapping each daemon type to its 'rotations', over
+                  all nodes, and its 'peak_bytes_per_sec' on any one
+                  node
+        """
+        self.stop_event.set()
+        for node, proc in self.procs.items():
+            try:
+                proc.stdin.close()
+            except Exception:
+                log.debug("Could not stop the log rotation watcher on "
+                          "'{0}'".format(node), exc_info=True)
+        gevent.joinall(self.supervisors, raise_error=True)
+        self.supervisors = []
+        return self.stats
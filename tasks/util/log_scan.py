@@ -0,0 +1,81 @@
+"""
+Single pass scan of the cluster log for problems.
+
+scan_log() reads the log once on its node, tests each line against the
+whole whitelist as a single compiled alternation, and reports the first
+line of each severity which is not whitelisted.
+"""
+import json
+import logging
+from cStringIO import StringIO
+
+log = logging.getLogger(__name__)
+
+# most severe first
+SEVERITIES = ('SEC', 'ERR', 'WRN')
+
+SCANNER = """
+import json
+import re
+import sys
+import time
+
+path = sys.argv[1]
+request = json.loads(sys.stdin.read())
+severity = re.compile(r'\\[(' + '|'.join(request['severities']) + r')\\]')
+whitelist = None
+if request['whitelist']:
+    whitelist = re.compile('|'.join('(?:%s)' % pattern
+                                    for pattern in request['whitelist']))
+first = {}
+scanned = 0
+start = time.time()
+with open(path) as f:
+    for line in f:
+        scanned += len(line)
+        match = severity.search(line)
+        if match is None or match.group(1) in first:
+            continue
+        if whitelist is not None and whitelist.search(line):
+            continue
+        first[match.group(1)] = line.rstrip('\\n')
+        if len(first) == len(request['severities']):
+            # nothing more to find
+            break
+json.dump({'first': first, 'bytes': scanned,
+           'seconds': time.time() - start}, sys.stdout)
+"""
+
+
+def scan_log(remote, path, whitelist, severities=SEVERITIES):
+    """
+    Find the first line of each severity in a cluster log which is not
+    matched by any whitelist entry.
+
+    :param path: the log, on remote
+    :param whitelist: list of regexes; egrep syntax as far as Python's
+                      re module agrees with it
+    :returns: dict with 'first', mapping the severities found to their
+              first line, the 'bytes' scanned (up to the first line of
+              the last severity to be found), 'seconds' and
+              'bytes_per_sec'; or None if the helper failed (for
+              instance on a whitelist entry Python cannot compile)
+    """
+    stdout = StringIO()
+    proc = remote.run(
+        args=['sudo', 'python', '-c', SCANNER, path],
+        stdin=json.dumps({'whitelist': list(whitelist),
+                          'severities': list(severities)}),
+        stdout=stdout,
+        stderr=StringIO(),
+        check_status=False,
+    )
+    if proc.exitstatus != 0:
+        log.warning('cluster log scan of %s failed: %s', path,
+                    proc.stderr.getvalue().strip())
+        return None
+    result = json.loads(stdout.getvalue())
+    result['bytes_per_sec'] = result['bytes'] / max(result['seconds'], 1e-6)
+    log.info('scanned {bytes} bytes of {path} in {seconds:.1f}s '
+             '({bytes_per_sec:.0f} B/s)'.format(path=path, **result))
+    return result
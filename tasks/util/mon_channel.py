@@ -0,0 +1,286 @@
+"""
+Persistent ceph command channel.
+
+MonCommandChannel keeps a helper with one authenticated librados
+session running on a remote, and sends it ceph commands as JSON lines
+on its stdin, answered on its stdout.
+
+Commands the helper cannot express (``tell``, global CLI options such
+as ``-m``...) are refused so that the caller can fall back to
+executing the ``ceph`` CLI.
+"""
+import base64
+import json
+import logging
+import threading
+
+import gevent
+
+from teuthology.orchestra import run
+
+log = logging.getLogger(__name__)
+
+# ceph CLI options which the helper does not emulate; a command using
+# any of these must go through the ceph CLI
+CLI_OPTIONS = frozenset([
+    '-c', '--conf', '-k', '--keyring', '-n', '--name', '--id', '--user',
+    '-m', '--cluster', '--admin-daemon', '--admin-socket', '-i',
+    '--in-file', '-o', '--out-file', '-s', '--status', '-w', '--watch',
+    '--watch-debug', '--watch-info', '--watch-sec', '--watch-warn',
+    '--watch-error', '--setuser', '--setgroup', '--connect-timeout',
+    '--concise', '--verbose', '-v', '--version', '-h', '--help',
+    '--help-all',
+])
+
+# first words of commands which the CLI does not send to the monitors
+UNSUPPORTED_PREFIXES = frozenset(['tell', 'daemon', 'daemonperf'])
+
+# first words of commands which only read the cluster state, and so can
+# be run again if the helper was lost in the middle of one
+READ_ONLY_PREFIXES = [
+    ('status',), ('health',), ('df',), ('fsid',), ('report',),
+    ('versions',), ('mon_status',), ('quorum_status',), ('mon', 'dump'),
+    ('mon', 'stat'), ('osd', 'dump'), ('osd', 'stat'), ('osd', 'tree'),
+    ('osd', 'ls'), ('osd', 'map'), ('osd', 'find'), ('osd', 'metadata'),
+    ('osd', 'df'), ('osd', 'perf'), ('osd', 'getmap'),
+    ('osd', 'getcrushmap'), ('osd', 'getmaxosd'), ('osd', 'lspools'),
+    ('osd', 'pool', 'get'), ('osd', 'pool', 'ls'), ('osd', 'pool', 'stats'),
+    ('osd', 'crush', 'dump'), ('osd', 'crush', 'rule', 'ls'),
+    ('osd', 'crush', 'rule', 'dump'), ('osd', 'blacklist', 'ls'),
+    ('osd', 'erasure-code-profile', 'get'),
+    ('osd', 'erasure-code-profile', 'ls'), ('pg', 'dump'), ('pg', 'stat'),
+    ('pg', 'map'), ('pg', 'ls'), ('pg', 'ls-by-pool'),
+    ('pg', 'ls-by-primary'), ('pg', 'ls-by-osd'), ('pg', 'dump_stuck'),
+    ('mds', 'stat'), ('mds', 'dump'), ('fs', 'dump'), ('fs', 'ls'),
+    ('fs', 'get'), ('auth', 'get'), ('auth', 'list'), ('auth', 'ls'),
+    ('config-key', 'get'), ('config-key', 'exists'), ('config-key', 'list'),
+]
+
+HELPER = """
+import base64
+import json
+import os
+import sys
+
+cluster_name = sys.argv[1]
+stand_in = len(sys.argv) > 2 and sys.argv[2] == '--stand-in'
+
+
+def reply(**kwargs):
+    sys.stdout.write(json.dumps(kwargs) + '\\n')
+    sys.stdout.flush()
+
+
+def encode(buf):
+    if not isinstance(buf, bytes):
+        buf = buf.encode('utf-8')
+    return base64.b64encode(buf).decode('ascii')
+
+if not stand_in:
+    import rados
+    from ceph_argparse import (json_command, parse_json_funcsigs,
+                               send_command, validate_command)
+    try:
+        from ceph_argparse import find_cmd_target
+    except ImportError:
+        find_cmd_target = None
+    cluster = rados.Rados(conffile='', clustername=cluster_name)
+    cluster.connect()
+    ret, outbuf, outs = json_command(cluster,
+                                     prefix='get_command_descriptions')
+    assert ret == 0, outs
+    sigdict = parse_json_funcsigs(outbuf, 'cli')
+
+reply(ready=True, pid=os.getpid())
+for line in iter(sys.stdin.readline, ''):
+    req = json.loads(line)
+    if stand_in:
+        reply(exitstatus=0, outb=encode(json.dumps(req['args'])), outs='')
+        continue
+    valid = validate_command(sigdict, req['args'])
+    if not valid:
+        reply(fallback=True)
+        continue
+    if req.get('format'):
+        valid['format'] = req['format']
+    target = ('mon', '')
+    if find_cmd_target is not None:
+        target = find_cmd_target(req['args'])
+    ret, outbuf, outs = send_command(cluster, target=target,
+                                     cmd=[json.dumps(valid)],
+                                     timeout=req['timeout'])
+    reply(exitstatus=abs(ret), outb=encode(outbuf), outs=outs)
+"""
+
+
+def parse_ceph_args(args):
+    """
+    Split ceph CLI arguments into the command words and output format.
+
+    :param args: arguments as they would be given to the ceph CLI
+    :returns: a (words, format) tuple, or None if the command needs
+              the ceph CLI itself
+    """
+    args = list(args)
+    if args and args[0] == '--':
+        args = args[1:]
+    words = []
+    fmt = None
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('--format='):
+            fmt = arg.split('=', 1)[1]
+        elif arg in ('--format', '-f') and i + 1 < len(args):
+            fmt = args[i + 1]
+            i += 1
+        elif arg == '--' or arg.split('=', 1)[0] in CLI_OPTIONS:
+            return None
+        else:
+            words.append(arg)
+        i += 1
+    if not words or words[0] in UNSUPPORTED_PREFIXES:
+        return None
+    if len(words) > 1 and words[1] == 'tell':
+        return None
+    return words, fmt
+
+
+def read_only(words):
+    """
+    Return whether the command words (as returned by parse_ceph_args())
+    only read the cluster state.
+    """
+    return any(tuple(words[:len(prefix)]) == prefix
+               for prefix in READ_ONLY_PREFIXES)
+
+
+class MonCommandChannel(object):
+    """
+    Client side of the resident ceph command helper.
+
+    :param remote: the Remote to run the helper on
+    :param cluster: name of the ceph cluster
+    :param timeout: seconds after which a command is given up on, like
+                    the ``timeout 120`` prefix of the exec path
+    :param stand_in: if true, the helper answers every command itself
+                     without contacting a cluster (for benchmarking)
+    """
+
+    # seconds given to the helper to exit once its stdin is closed
+    close_timeout = 10
+
+    def __init__(self, remote, cluster='ceph', timeout=120, stand_in=False):
+        self.remote = remote
+        self.cluster = cluster
+        self.timeout = timeout
+        self.stand_in = stand_in
+        self.lock = threading.Lock()
+        self.proc = None
+        self.pid = None
+        self.broken = False
+        self.commands = 0
+        self.fallbacks = 0
+
+    def _start(self):
+        args = ['sudo', 'python', '-c', HELPER, self.cluster]
+        if self.stand_in:
+            args.append('--stand-in')
+        self.proc = self.remote.run(
+            args=args,
+            stdin=run.PIPE,
+            stdout=run.PIPE,
+            logger=log.getChild(self.remote.shortname),
+            wait=False,
+        )
+        ready = self._read_reply()
+        if ready is None or not ready.get('ready'):
+            log.warning('ceph command helper failed to start on %s, '
+                        'using the ceph CLI', self.remote.shortname)
+            self.close()
+            self.broken = True
+            return
+        self.pid = ready.get('pid')
+
+    def _read_reply(self):
+        line = None
+        with gevent.Timeout(self.timeout + 30, False):
+            line = self.proc.stdout.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def command(self, args):
+        """
+        Run one ceph CLI command through the helper.
+
+        :param args: arguments as they would be given to the ceph CLI
+        :returns: an (exitstatus, stdout) tuple matching what the ceph
+                  CLI would have produced, or None if the caller must
+                  run the ceph CLI instead: for commands the helper
+                  cannot express, and for read-only commands when the
+                  helper is lost in the middle of them.  A command which
+                  could have changed the cluster is not run again, and
+                  gets the exit status of a timeout (124).
+        """
+        parsed = parse_ceph_args(args)
+        if parsed is None or self.broken:
+            self.fallbacks += 1
+            return None
+        words, fmt = parsed
+        request = json.dumps({'args': words,
+                              'format': fmt,
+                              'timeout': self.timeout})
+        with self.lock:
+            if self.proc is None:
+                self._start()
+                if self.broken:
+                    self.fallbacks += 1
+                    return None
+            self.proc.stdin.write(request + '\n')
+            self.proc.stdin.flush()
+            reply = self._read_reply()
+            if reply is None:
+                # the helper died or hung; restart it on the next command
+                log.warning('lost ceph command helper on %s',
+                            self.remote.shortname)
+                self.close()
+                if read_only(words):
+                    self.fallbacks += 1
+                    return None
+                return (124, '')
+            self.commands += 1
+        if reply.get('fallback'):
+            self.fallbacks += 1
+            return None
+        out = base64.b64decode(reply['outb'])
+        if fmt and fmt.startswith('json'):
+            # callers drop the first line of json CLI output
+            out = '\n' + out
+        if reply['exitstatus'] and reply.get('outs'):
+            log.info('%s: %s', ' '.join(words), reply['outs'])
+        return (reply['exitstatus'], out)
+
+    def close(self):
+        """
+        Stop the helper, if it is running.
+        """
+        proc, self.proc = self.proc, None
+        pid, self.pid = self.pid, None
+        if proc is None:
+            return
+        exited = False
+        try:
+            proc.stdin.close()
+            with gevent.Timeout(self.close_timeout, False):
+                proc.wait()
+                exited = True
+        except Exception:
+            exited = True
+            log.debug('ceph command helper exited uncleanly', exc_info=True)
+        if not exited and pid is not None:
+            # stuck in a command, so not reading its stdin
+            log.warning('ceph command helper on %s did not exit, killing it',
+                        self.remote.shortname)
+            self.remote.run(args=['sudo', 'kill', '-KILL', str(pid)],
+                            check_status=False)
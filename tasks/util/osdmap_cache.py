@@ -0,0 +1,60 @@
+"""
+Memoization of lookups which only depend on the osdmap.
+
+Where an object maps to, which osds act for a pg and how a pool is set
+up can only change with a new osdmap, so the answers can be kept until
+the epoch moves on instead of asking the monitors every time.
+"""
+
+
+class OSDMapCache(object):
+    """
+    Values keyed by lookup, all dropped whenever the osdmap epoch
+    changes.
+
+    Callers pass the current epoch to validate() before a round of
+    lookups; the hit and miss counts are the lookups served from the
+    cache and the ones which needed a monitor command.
+    """
+
+    def __init__(self):
+        self.epoch = None
+        self.entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def validate(self, epoch):
+        """
+        Drop every entry if epoch differs from the one they were
+        looked up in.
+        """
+        if epoch != self.epoch:
+            if self.entries:
+                self.invalidations += 1
+            self.entries = {}
+            self.epoch = epoch
+
+    def lookup(self, key):
+        """
+        :returns: the cached value for key, or None (counted as a miss)
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+
+    def store(self, key, value):
+        self.entries[key] = value
+        return value
+
+    def counters(self):
+        return {
+            'epoch': self.epoch,
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'invalidations': self.invalidations,
+        }
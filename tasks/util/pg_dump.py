@@ -0,0 +1,458 @@
+"""
+Low memory parsing of ``ceph pg dump --format=json``.
+
+json.loads() of a pg dump builds a dict tree for every pg, including
+dozens of counters nobody looks at, and needs the whole text in memory
+first.  parse_pg_dump() instead reads the dump incrementally from a
+file-like object, decodes the entries of ``pg_stats`` one at a time and
+keeps only the fields the tasks use, in PGStat objects.
+
+PGStateIndex answers pg state counts and histograms from the state
+bitmasks of a set of pgs.
+"""
+from array import array
+import json
+import os
+import re
+import sys
+import time
+
+PG_STATS = re.compile(r'"pg_stats"\s*:\s*\[')
+VERSION = re.compile(r'"version"\s*:\s*(\d+)')
+SEPARATOR = re.compile(r'[\s,]*')
+
+# counters of stat_sum kept by PGStat
+STAT_SUM_FIELDS = ('num_bytes', 'num_objects', 'num_objects_degraded',
+                   'num_objects_misplaced', 'num_objects_unfound')
+
+# pg state token -> bit, assigned as tokens are first seen
+STATE_BITS = {}
+_states = {}
+_state_masks = {}
+_mask_tokens = {}
+
+
+def state_mask(state):
+    """
+    Return the bitmask of the '+' separated tokens of a pg state.
+    """
+    mask = _state_masks.get(state)
+    if mask is None:
+        mask = 0
+        for token in state.split('+'):
+            bit = STATE_BITS.get(token)
+            if bit is None:
+                bit = STATE_BITS[token] = 1 << len(STATE_BITS)
+            mask |= bit
+        _state_masks[state] = mask
+    return mask
+
+
+def state_bits(*tokens):
+    """
+    Return the bitmask of the given pg state tokens.
+    """
+    return state_mask('+'.join(tokens))
+
+
+def mask_tokens(mask):
+    """
+    Return the state tokens whose bits are set in mask.
+    """
+    tokens = _mask_tokens.get(mask)
+    if tokens is None:
+        tokens = _mask_tokens[mask] = tuple(
+            token for token, bit in STATE_BITS.items() if mask & bit)
+    return tokens
+
+
+def substring_bits(*words):
+    """
+    Return the bitmask of all state tokens seen so far which contain
+    one of words, e.g. wait_backfill and backfilling for 'backfill'.
+    """
+    mask = 0
+    for token, bit in STATE_BITS.items():
+        if any(word in token for word in words):
+            mask |= bit
+    return mask
+
+
+class PGStat(object):
+    """
+    The fields of one ``pg_stats`` entry that the tasks use.
+
+    Supports the item access of the dict it replaces, for those fields:
+    pg['pgid'], pg['state'], pg['acting'], pg['stat_sum']['num_bytes']...
+    State strings are shared between all PGStats in the same state.
+    """
+    __slots__ = ('pgid', 'state', 'state_mask', 'up', 'acting',
+                 'up_primary', 'acting_primary', 'last_scrub_stamp',
+                 'last_deep_scrub_stamp', 'stat_sum_values')
+
+    def __init__(self, pg):
+        state = pg['state']
+        self.pgid = pg['pgid']
+        self.state = _states.setdefault(state, state)
+        self.state_mask = state_mask(state)
+        self.up = tuple(pg.get('up', ()))
+        self.acting = tuple(pg.get('acting', ()))
+        self.up_primary = pg.get('up_primary')
+        self.acting_primary = pg.get('acting_primary')
+        self.last_scrub_stamp = pg.get('last_scrub_stamp')
+        self.last_deep_scrub_stamp = pg.get('last_deep_scrub_stamp')
+        stat_sum = pg.get('stat_sum', {})
+        self.stat_sum_values = tuple(stat_sum.get(field, 0)
+                                     for field in STAT_SUM_FIELDS)
+
+    @property
+    def stat_sum(self):
+        return dict(zip(STAT_SUM_FIELDS, self.stat_sum_values))
+
+    def __getitem__(self, key):
+        if key not in self.__slots__ and key != 'stat_sum':
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __repr__(self):
+        return '<PGStat {pgid} {state}>'.format(pgid=self.pgid,
+                                                state=self.state)
+
+
+class PGStateIndex(object):
+    """
+    Columnar index of the states of a set of pgs.
+
+    Each pg is reduced to its state bitmask and pool id, kept in array
+    columns, and the pgs are grouped by bitmask.  A cluster has only a
+    handful of distinct pg states at any time, so counts and histograms
+    only look at those groups instead of at every pg.
+
+    :param pg_stats: PGStats, or the pg stat dicts of ``ceph pg dump``
+    """
+
+    def __init__(self, pg_stats):
+        self.pg_stats = pg_stats
+        if pg_stats and isinstance(pg_stats[0], PGStat):
+            self.masks = array('L', [pg.state_mask for pg in pg_stats])
+        else:
+            self.masks = array('L', [state_mask(pg['state'])
+                                     for pg in pg_stats])
+        self.groups = {}
+        for mask in self.masks:
+            self.groups[mask] = self.groups.get(mask, 0) + 1
+        self._pools = None
+        self._pool_groups = None
+        self._osd_groups = None
+        self._osd_loads = None
+
+    @property
+    def pools(self):
+        """
+        The pool id of each pg, in the order of pg_stats.
+        """
+        if self._pools is None:
+            self._pools = array('l', [int(pg['pgid'].split('.', 1)[0])
+                                      for pg in self.pg_stats])
+        return self._pools
+
+    def __len__(self):
+        return len(self.masks)
+
+    @staticmethod
+    def _count(groups, all_of, any_of, none_of):
+        num = 0
+        for mask, n in groups.iteritems():
+            if (mask & all_of == all_of and
+                    (not any_of or mask & any_of) and
+                    not mask & none_of):
+                num += n
+        return num
+
+    @staticmethod
+    def _histogram(groups):
+        ret = {}
+        for mask, n in groups.iteritems():
+            for token in mask_tokens(mask):
+                ret[token] = ret.get(token, 0) + n
+        return ret
+
+    def count(self, all_of=0, any_of=0, none_of=0):
+        """
+        Count the pgs whose state has all of the bits of all_of, at least
+        one of the bits of any_of (if any) and none of the bits of
+        none_of.  Build the masks with state_bits() and substring_bits().
+        """
+        return self._count(self.groups, all_of, any_of, none_of)
+
+    def histogram(self):
+        """
+        Return the number of pgs with each state token.
+        """
+        return self._histogram(self.groups)
+
+    def pool_groups(self):
+        """
+        Return {pool id: {state mask: number of pgs}}.
+        """
+        if self._pool_groups is None:
+            self._pool_groups = {}
+            for pool, mask in zip(self.pools, self.masks):
+                groups = self._pool_groups.setdefault(pool, {})
+                groups[mask] = groups.get(mask, 0) + 1
+        return self._pool_groups
+
+    def osd_groups(self):
+        """
+        Return {osd id: {state mask: number of pgs}}, counting each pg
+        for every osd of its acting set.
+        """
+        if self._osd_groups is None:
+            self._osd_groups = {}
+            for pg, mask in zip(self.pg_stats, self.masks):
+                for osd in pg['acting']:
+                    groups = self._osd_groups.setdefault(osd, {})
+                    groups[mask] = groups.get(mask, 0) + 1
+        return self._osd_groups
+
+    def osd_loads(self):
+        """
+        Return {osd id: load} where load is a dict of the number of
+        'pgs' with the osd in their acting set, the number of them it is
+        the acting primary of ('primaries'), their 'bytes' and the
+        number of them which are 'degraded'.
+        """
+        if self._osd_loads is None:
+            degraded = state_bits('degraded')
+            loads = {}
+            for pg, mask in zip(self.pg_stats, self.masks):
+                num_bytes = pg['stat_sum'].get('num_bytes', 0)
+                for osd in pg.get('acting', ()):
+                    load = loads.get(osd)
+                    if load is None:
+                        load = loads[osd] = dict(pgs=0, primaries=0,
+                                                 bytes=0, degraded=0)
+                    load['pgs'] += 1
+                    load['bytes'] += num_bytes
+                    if mask & degraded:
+                        load['degraded'] += 1
+                primary = pg.get('acting_primary')
+                if primary in loads:
+                    loads[primary]['primaries'] += 1
+            self._osd_loads = loads
+        return self._osd_loads
+
+    def pool_histograms(self):
+        """
+        Return {pool id: histogram of the states of its pgs}.
+        """
+        return dict((pool, self._histogram(groups))
+                    for pool, groups in self.pool_groups().iteritems())
+
+    def osd_histograms(self):
+        """
+        Return {osd id: histogram of the states of its acting pgs}.
+        """
+        return dict((osd, self._histogram(groups))
+                    for osd, groups in self.osd_groups().iteritems())
+
+    def pool_count(self, pool, all_of=0, any_of=0, none_of=0):
+        """
+        Like count(), for the pgs of one pool.
+        """
+        return self._count(self.pool_groups().get(pool, {}),
+                           all_of, any_of, none_of)
+
+    def osd_count(self, osd, all_of=0, any_of=0, none_of=0):
+        """
+        Like count(), for the pgs whose acting set includes osd.
+        """
+        return self._count(self.osd_groups().get(osd, {}),
+                           all_of, any_of, none_of)
+
+
+def iter_pg_stats(f, header=None, chunk_size=65536):
+    """
+    Yield the entries of the ``pg_stats`` array of a pg dump as dicts,
+    reading f chunk by chunk.  f is read to the end.
+
+    :param f: file-like object with the pg dump
+    :param header: if given, a dict which gets the pgmap 'version'
+    """
+    decoder = json.JSONDecoder()
+    if header is None:
+        header = {}
+    state = {'buf': '', 'eof': False}
+
+    def read():
+        chunk = f.read(chunk_size)
+        if chunk:
+            state['buf'] += chunk
+        else:
+            state['eof'] = True
+
+    # find the start of pg_stats, picking up the version on the way
+    while True:
+        buf = state['buf']
+        match = PG_STATS.search(buf)
+        version = VERSION.search(buf, 0, match.start() if match else len(buf))
+        if version and 'version' not in header:
+            header['version'] = int(version.group(1))
+        if match:
+            break
+        if state['eof']:
+            raise ValueError('no pg_stats in pg dump')
+        # a key may be split across two chunks
+        state['buf'] = buf[-64:]
+        read()
+
+    pos = match.end()
+    while True:
+        buf = state['buf']
+        pos = SEPARATOR.match(buf, pos).end()
+        if pos < len(buf) and buf[pos] == ']':
+            break
+        try:
+            if pos == len(buf):
+                raise ValueError('need more data')
+            pg, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            if state['eof']:
+                raise ValueError('truncated pg_stats in pg dump')
+            state['buf'] = buf[pos:]
+            pos = 0
+            read()
+            continue
+        yield pg
+        pos = end
+        if pos > chunk_size:
+            state['buf'] = buf[pos:]
+            pos = 0
+    # skip the rest of the dump
+    state['buf'] = ''
+    if not state['eof']:
+        while f.read(chunk_size):
+            pass
+
+
+def parse_pg_dump(f):
+    """
+    Parse a pg dump into compact form.
+
+    :param f: file-like object with the output of ``pg dump --format=json``
+    :returns: a (pgmap version, [PGStat, ...]) tuple; the version is None
+              if the dump has none
+    """
+    header = {}
+    pg_stats = [PGStat(pg) for pg in iter_pg_stats(f, header)]
+    return header.get('version'), pg_stats
+
+
+def synthetic_pg_dump(num_pgs, num_osds=12):
+    """
+    Return the json text of a pg dump with num_pgs pgs, shaped like the
+    output of a jewel cluster.
+    """
+    stat_sum = dict((name, 0) for name in [
+        'num_bytes', 'num_objects', 'num_object_clones',
+        'num_object_copies', 'num_objects_missing_on_primary',
+        'num_objects_missing', 'num_objects_degraded',
+        'num_objects_misplaced', 'num_objects_unfound',
+        'num_objects_dirty', 'num_whiteouts', 'num_read', 'num_read_kb',
+        'num_write', 'num_write_kb', 'num_scrub_errors',
+        'num_shallow_scrub_errors', 'num_deep_scrub_errors',
+        'num_objects_recovered', 'num_bytes_recovered',
+        'num_keys_recovered', 'num_objects_omap', 'num_objects_hit_set_archive',
+        'num_bytes_hit_set_archive', 'num_flush', 'num_flush_kb',
+        'num_evict', 'num_evict_kb', 'num_promote', 'num_flush_mode_high',
+        'num_flush_mode_low', 'num_evict_mode_some', 'num_evict_mode_full',
+        'num_objects_pinned'])
+    stamp = '2017-01-01 00:00:00.000000'
+    pgs = []
+    for i in range(num_pgs):
+        acting = [(i + j) % num_osds for j in range(3)]
+        pgs.append({
+            'pgid': '{pool}.{ps:x}'.format(pool=1 + i % 4, ps=i // 4),
+            'version': "12'34", 'reported_seq': '56', 'reported_epoch': '78',
+            'state': 'active+clean', 'last_fresh': stamp,
+            'last_change': stamp, 'last_active': stamp,
+            'last_peered': stamp, 'last_clean': stamp,
+            'last_became_active': stamp, 'last_became_peered': stamp,
+            'last_unstale': stamp, 'last_undegraded': stamp,
+            'last_fullsized': stamp, 'mapping_epoch': 10,
+            'log_start': "0'0", 'ondisk_log_start': "0'0",
+            'created': 1, 'last_epoch_clean': 10, 'parent': '0.0',
+            'parent_split_bits': 0, 'last_scrub': "0'0",
+            'last_scrub_stamp': stamp, 'last_deep_scrub': "0'0",
+            'last_deep_scrub_stamp': stamp, 'last_clean_scrub_stamp': stamp,
+            'log_size': 0, 'ondisk_log_size': 0, 'stats_invalid': False,
+            'dirty_stats_invalid': False, 'omap_stats_invalid': False,
+            'hitset_stats_invalid': False,
+            'hitset_bytes_stats_invalid': False, 'pin_stats_invalid': False,
+            'stat_sum': dict(stat_sum),
+            'up': acting, 'acting': acting, 'blocked_by': [],
+            'up_primary': acting[0], 'acting_primary': acting[0],
+        })
+    return json.dumps({'version': 1234, 'stamp': stamp,
+                       'last_osdmap_epoch': 10, 'last_pg_scan': 1,
+                       'full_ratio': 0.95, 'near_full_ratio': 0.85,
+                       'pg_stats_sum': {'stat_sum': stat_sum},
+                       'pg_stats': pgs, 'pool_stats': [], 'osd_stats': []})
+
+
+def _measure(parse, text):
+    """
+    Run parse(text) in a child process; return its run time and the
+    growth of the child's peak rss in kB.
+    """
+    import resource
+    rfd, wfd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(rfd)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start = time.time()
+        parse(text)
+        elapsed = time.time() - start
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(wfd, json.dumps([elapsed, after - before]).encode())
+        os._exit(0)
+    os.close(wfd)
+    out = os.read(rfd, 4096)
+    os.close(rfd)
+    os.waitpid(pid, 0)
+    return json.loads(out)
+
+
+def benchmark(sizes=(1000, 10000, 100000)):
+    """
+    Compare json.loads() with parse_pg_dump() on synthetic pg dumps.
+    """
+    from cStringIO import StringIO
+
+    def full(text):
+        j = json.loads('\n'.join(text.split('\n')[1:]))
+        return j['pg_stats']
+
+    def compact(text):
+        return parse_pg_dump(StringIO(text))
+
+    for size in sizes:
+        text = 'dumped all in format json\n' + synthetic_pg_dump(size)
+        for name, parse in [('json.loads', full), ('parse_pg_dump', compact)]:
+            elapsed, rss = _measure(parse, text)
+            sys.stdout.write(
+                '{size:>7} pgs {mb:7.1f} MB  {name:<14} {elapsed:7.3f}s '
+                '{rss:>9} kB peak rss growth\n'.format(
+                    size=size, mb=len(text) / 1e6, name=name,
+                    elapsed=elapsed, rss=rss))
+
+
+if __name__ == '__main__':
+    benchmark([int(size) for size in sys.argv[1:]] or (1000, 10000, 100000))
@@ -0,0 +1,195 @@
+"""
+Streaming pg moves between down osds.
+
+Moving a pg with ceph-objectstore-tool used to mean exporting it to a
+file, copying the file to the target host and importing it from there,
+each step finishing before the next started.  PGMover instead pipes
+the export straight into the import (through the controller when the
+osds are on different hosts, optionally compressed on the wire), then
+removes the pg from the source osd, and runs several moves at once
+where they do not share an osd.
+"""
+import logging
+import time
+from cStringIO import StringIO
+
+import gevent.lock
+
+from teuthology.orchestra import run
+from teuthology.parallel import parallel
+
+log = logging.getLogger(__name__)
+
+# (compress, decompress) filters for the stream between hosts
+COMPRESSORS = {
+    None: (None, None),
+    'gzip': ('gzip -1', 'gunzip'),
+    'lz4': ('lz4 -c', 'lz4 -dc'),
+    'zstd': ('zstd -1 -c', 'zstd -dc'),
+}
+
+# import exit statuses which are not failures of the move
+IMPORT_POOL_GONE = 10
+IMPORT_INCOMPATIBLE = 11
+
+
+class PGMover(object):
+    """
+    Move pgs between osds which are down, with ceph-objectstore-tool.
+
+    ceph-objectstore-tool locks the store it opens, so moves sharing an
+    osd wait for one another; moves between distinct osds overlap.
+
+    :param tool_cmd: function of an osd id returning the
+                     ceph-objectstore-tool command line (without --op)
+                     for that osd, as a shell string
+    :param find_remote: function of an osd id returning its remote
+    :param compression: None or a key of COMPRESSORS, for streams
+                        between hosts
+    :param chunk_size: bytes read from the export per write to the import
+    """
+
+    def __init__(self, tool_cmd, find_remote, compression=None,
+                 chunk_size=1 << 20):
+        assert compression in COMPRESSORS, \
+            'unknown compression {0}'.format(compression)
+        self.tool_cmd = tool_cmd
+        self.find_remote = find_remote
+        self.compression = compression
+        self.chunk_size = chunk_size
+        self.locks = {}
+
+    def _lock(self, osd):
+        return self.locks.setdefault(osd, gevent.lock.Semaphore())
+
+    def _stream_local(self, remote, pgid, src, dst):
+        # tee the export into wc so that the byte count comes back on
+        # stdout (saved as fd 3, since tee's stdout is the import), while
+        # the import and, last, the exit statuses of the export and the
+        # import go to stderr
+        cmd = ("exec 3>&1; {src} --op export --pgid {pgid} --file - | "
+               "tee >(wc -c >&3) | {dst} --op import --file - >&2; "
+               "status=(${{PIPESTATUS[@]}}); "
+               "echo ${{status[0]}} ${{status[2]}} >&2".format(
+                   src=self.tool_cmd(src), dst=self.tool_cmd(dst),
+                   pgid=pgid))
+        proc = remote.run(args=['bash', '-c', cmd], check_status=False,
+                          stdout=StringIO(), stderr=StringIO())
+        try:
+            nbytes = int(proc.stdout.getvalue().split()[-1])
+        except (IndexError, ValueError):
+            nbytes = 0
+        try:
+            export_status, import_status = map(
+                int, proc.stderr.getvalue().splitlines()[-1].split())
+        except (IndexError, ValueError):
+            export_status = import_status = proc.exitstatus or 1
+        return export_status, import_status, nbytes
+
+    def _stream_remote(self, src_remote, dst_remote, pgid, src, dst):
+        compress, decompress = COMPRESSORS[self.compression]
+        export_cmd = "{src} --op export --pgid {pgid} --file -".format(
+            src=self.tool_cmd(src), pgid=pgid)
+        import_cmd = "{dst} --op import --file -".format(
+            dst=self.tool_cmd(dst))
+        if compress:
+            export_cmd = "set -o pipefail; {0} | {1}".format(export_cmd,
+                                                             compress)
+            import_cmd = "set -o pipefail; {0} | {1}".format(decompress,
+                                                             import_cmd)
+        exp = src_remote.run(args=['bash', '-c', export_cmd],
+                             check_status=False, wait=False,
+                             stdout=run.PIPE, stderr=StringIO())
+        imp = dst_remote.run(args=['bash', '-c', import_cmd],
+                             check_status=False, wait=False,
+                             stdin=run.PIPE, stderr=StringIO())
+        nbytes = 0
+        importing = True
+        try:
+            while True:
+                buf = exp.stdout.read(self.chunk_size)
+                if not buf:
+                    break
+                if not importing:
+                    # keep draining the export, which would otherwise
+                    # block for good once its channel window fills up
+                    continue
+                try:
+                    imp.stdin.write(buf)
+                except (IOError, OSError):
+                    # the import went away; its exit status tells why
+                    log.debug('pg %s import stream closed early', pgid,
+                              exc_info=True)
+                    importing = False
+                    continue
+                nbytes += len(buf)
+        finally:
+            try:
+                imp.stdin.close()
+            except (IOError, OSError):
+                pass
+        exp.wait()
+        imp.wait()
+        return exp.exitstatus, imp.exitstatus, nbytes
+
+    def move(self, pgid, src, dst):
+        """
+        Move pgid from osd src to osd dst and remove it from src.
+
+        :returns: a dict with the 'pgid', 'src' and 'dst' osds, the
+                  export and import exit statuses, the 'bytes' streamed
+                  (compressed, between hosts), 'seconds' and
+                  'bytes_per_sec'
+        """
+        first, second = sorted([src, dst])
+        with self._lock(first):
+            with self._lock(second):
+                src_remote = self.find_remote(src)
+                dst_remote = self.find_remote(dst)
+                start = time.time()
+                if src_remote == dst_remote:
+                    export_status, import_status, nbytes = \
+                        self._stream_local(src_remote, pgid, src, dst)
+                else:
+                    export_status, import_status, nbytes = \
+                        self._stream_remote(src_remote, dst_remote, pgid,
+                                            src, dst)
+                seconds = max(time.time() - start, 1e-6)
+                if export_status == 0:
+                    cmd = "{src} --op remove --pgid {pgid}".format(
+                        src=self.tool_cmd(src), pgid=pgid)
+                    src_remote.run(args=cmd)
+        result = {
+            'pgid': pgid,
+            'src': src,
+            'dst': dst,
+            'export_status': export_status,
+            'import_status': import_status,
+            'bytes': nbytes,
+            'seconds': seconds,
+            'bytes_per_sec': nbytes / seconds,
+            'ok': export_status == 0 and import_status in (
+                0, IMPORT_POOL_GONE, IMPORT_INCOMPATIBLE),
+        }
+        log.info('moved pg {pgid} from osd.{src} to osd.{dst}: {bytes} '
+                 'bytes in {seconds:.1f}s ({bytes_per_sec:.0f} B/s), '
+                 'export status {export_status}, import status '
+                 '{import_status}'.format(**result))
+        return result
+
+    def move_all(self, moves):
+        """
+        Run several moves at once.
+
+        :param moves: list of (pgid, src, dst) tuples
+        :returns: the result of move() for each, in the order of moves
+        """
+        results = [None] * len(moves)
+
+        def move(i, pgid, src, dst):
+            results[i] = self.move(pgid, src, dst)
+
+        with parallel() as p:
+            for i, (pgid, src, dst) in enumerate(moves):
+                p.spawn(move, i, pgid, src, dst)
+        return results
@@ -0,0 +1,243 @@
+"""
+Prebaked cluster images for the ceph task.
+
+Keyrings, the initial osdmap, the mon stores and the freshly made osd
+data directories only depend on the ceph build, the roles of the
+cluster and its configuration, so for a given combination of those
+they are the same in every job.  The first job to build a cluster
+saves them, before any daemon has started, as one tarball per role
+under a cache directory on the teuthology host; later jobs unpack the
+tarballs onto their nodes in parallel instead of running the tools
+again.  Only the monmap, which holds the addresses of the monitors,
+is regenerated (with the cached fsid) and injected into the mon
+stores.
+"""
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+from teuthology import misc as teuthology
+from teuthology.orchestra import run
+from teuthology.parallel import parallel
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = '~/.cache/teuthology/prebaked'
+
+# daemon types whose data directory is part of the image
+DATA_DIR_TYPES = ('mon', 'mgr', 'mds', 'osd')
+
+
+def unsupported_reason(ctx, config, conf):
+    """
+    :returns: why the cluster of this ceph task cannot be prebaked, or
+              None if it can
+    """
+    if not sha1(ctx, config):
+        return 'the sha1 of the ceph build is unknown'
+    for option in ('block_journal', 'tmpfs_journal'):
+        if config.get(option):
+            return '{0} is set'.format(option)
+    if objectstore(conf) == 'bluestore':
+        # the block file of a bluestore osd is sparse but huge, and
+        # would be written out in full on every restore
+        return 'the osds use bluestore'
+    return None
+
+
+def objectstore(conf):
+    return conf.get('osd', {}).get('osd objectstore', 'filestore')
+
+
+def sha1(ctx, config):
+    return config.get('sha1') or ctx.config.get('sha1')
+
+
+def cache_key(ctx, config, conf):
+    """
+    Return the name of the image for the cluster of this ceph task:
+    a hash of the ceph sha1, the roles of each host, the objectstore,
+    the osd filesystem and the configuration (without the monitor
+    addresses, which are per job).
+    """
+    cluster_name = config['cluster']
+    shape = sorted(
+        sorted(role for role in roles
+               if teuthology.split_role(role)[0] == cluster_name)
+        for roles in ctx.cluster.remotes.itervalues())
+    conf = dict(
+        (section, dict((key, value) for key, value in values.iteritems()
+                       if key != 'mon addr'))
+        for section, values in conf.iteritems())
+    description = {
+        'sha1': sha1(ctx, config),
+        'cluster': cluster_name,
+        'shape': shape,
+        'objectstore': objectstore(conf),
+        'fs': config.get('fs'),
+        'mkfs_options': config.get('mkfs_options'),
+        'conf': conf,
+    }
+    digest = hashlib.sha1(json.dumps(description, sort_keys=True))
+    return '{cluster}-{digest}'.format(cluster=cluster_name,
+                                       digest=digest.hexdigest())
+
+
+class PrebakedCluster(object):
+    """
+    The image of one cluster shape in the cache directory.
+
+    :param ctx: the job context
+    :param cluster_name: name of the cluster
+    :param cache_dir: directory holding the images, on this host
+    :param key: the cache_key() of the cluster
+    """
+
+    def __init__(self, ctx, cluster_name, cache_dir, key):
+        self.ctx = ctx
+        self.cluster_name = cluster_name
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.key = key
+        self.path = os.path.join(self.cache_dir, key)
+        self.manifest = None
+        manifest_path = os.path.join(self.path, 'manifest.json')
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+
+    @property
+    def hit(self):
+        return self.manifest is not None
+
+    @property
+    def fsid(self):
+        return self.manifest['fsid']
+
+    def roles(self):
+        """
+        Yield (remote, role, type, path) for everything in the image:
+        the data directory of each daemon and the keyring of each
+        client.
+        """
+        for remote, roles_for_host in self.ctx.cluster.remotes.iteritems():
+            for type_ in DATA_DIR_TYPES + ('client',):
+                for role in teuthology.cluster_roles_of_type(
+                        roles_for_host, type_, self.cluster_name):
+                    _, _, id_ = teuthology.split_role(role)
+                    if type_ == 'client':
+                        path = '/etc/ceph/{cluster}.client.{id}.keyring'
+                    else:
+                        path = '/var/lib/ceph/{type}/{cluster}-{id}'
+                    yield remote, role, type_, path.format(
+                        type=type_, cluster=self.cluster_name, id=id_)
+
+    def bake(self, fsid, keyring_remote, keyring_path):
+        """
+        Save the image of a cluster which has just been created and
+        whose daemons have not started yet.  The image is written to a
+        temporary directory and renamed into place once complete, so an
+        interrupted bake leaves nothing behind that a later job could
+        pick up.
+        """
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp = tempfile.mkdtemp(prefix=self.key + '.', dir=self.cache_dir)
+        try:
+            roles = {}
+
+            def pull(remote, role, type_, path):
+                local = os.path.join(tmp, role)
+                if type_ == 'client':
+                    data = teuthology.get_file(remote=remote, path=path,
+                                               sudo=True)
+                    with open(local, 'w') as f:
+                        f.write(data)
+                else:
+                    teuthology.pull_directory_tarball(remote, path,
+                                                      local + '.tgz')
+                roles[role] = {'type': type_, 'path': path}
+
+            with parallel() as p:
+                for remote, role, type_, path in self.roles():
+                    p.spawn(pull, remote, role, type_, path)
+            with open(os.path.join(tmp, 'keyring'), 'w') as f:
+                f.write(teuthology.get_file(remote=keyring_remote,
+                                            path=keyring_path, sudo=True))
+            with open(os.path.join(tmp, 'manifest.json'), 'w') as f:
+                json.dump({'fsid': fsid, 'roles': roles}, f)
+        except Exception:
+            shutil.rmtree(tmp, ignore_errors=True)
+            raise
+        try:
+            os.rename(tmp, self.path)
+        except OSError:
+            log.info('prebaked cluster image %s was saved by another job',
+                     self.key)
+            shutil.rmtree(tmp, ignore_errors=True)
+        else:
+            log.info('saved prebaked cluster image %s', self.path)
+
+    def restore(self, staging_dir, keyring_path, monmap_path, conf,
+                mon0_remote):
+        """
+        Unpack the image onto the nodes of the cluster, in parallel.
+        The osd data directories must already exist (and be mounted,
+        for osds on their own devices).
+
+        :param staging_dir: directory on each node to unpack from
+        :param monmap_path: where to build the new monmap on the nodes
+        :param conf: the cluster configuration, with the monitor
+                     addresses of this job
+        """
+        with open(os.path.join(self.path, 'keyring')) as f:
+            keyring = f.read()
+        with parallel() as p:
+            for remote in self.ctx.cluster.remotes.iterkeys():
+                p.spawn(teuthology.sudo_write_file, remote=remote,
+                        path=keyring_path, data=keyring, perms='0644')
+
+        self.write_monmap(mon0_remote, monmap_path, conf)
+        monmap = teuthology.get_file(remote=mon0_remote, path=monmap_path)
+
+        def push(remote, role, type_, path):
+            local = os.path.join(self.path, role)
+            if type_ == 'client':
+                with open(local) as f:
+                    teuthology.sudo_write_file(remote=remote, path=path,
+                                               data=f.read(), perms='0644')
+                return
+            staged = '{dir}/{role}.tgz'.format(dir=staging_dir, role=role)
+            remote.put_file(local + '.tgz', staged)
+            remote.run(args=['sudo', 'mkdir', '-p', path])
+            remote.run(args=['sudo', 'tar', '-C', path, '-xzpf', staged,
+                             run.Raw('&&'), 'rm', '-f', staged])
+            if type_ == 'mon':
+                _, _, id_ = teuthology.split_role(role)
+                teuthology.write_file(remote=remote, path=monmap_path,
+                                      data=monmap)
+                remote.run(args=['sudo', 'ceph-mon',
+                                 '--cluster', self.cluster_name,
+                                 '-i', id_,
+                                 '--inject-monmap', monmap_path])
+
+        with parallel() as p:
+            for remote, role, type_, path in self.roles():
+                p.spawn(push, remote, role, type_, path)
+        log.info('restored prebaked cluster image %s', self.path)
+
+    def write_monmap(self, remote, path, conf):
+        """
+        Create a monmap with the cached fsid and the monitor addresses
+        of conf.
+        """
+        args = ['monmaptool', '--create', '--clobber',
+                '--fsid', self.fsid]
+        for section in sorted(conf):
+            if section.startswith('mon.') and 'mon addr' in conf[section]:
+                args.extend(['--add', section[len('mon.'):],
+                             conf[section]['mon addr']])
+        args.append(path)
+        remote.run(args=args)
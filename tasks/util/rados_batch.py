@@ -0,0 +1,237 @@
+"""
+Batched rados object operations.
+
+Each ``rados put/get/rm/stat`` through the CLI is a process launch, a
+conf and keyring load and a fresh cluster connection.  run_ops()
+instead streams a list of object operations to one helper on a remote,
+which runs them over a single librados connection with several
+operations in flight and reports the result of each as it completes.
+"""
+import json
+import logging
+
+import gevent
+
+from teuthology.orchestra import run
+
+log = logging.getLogger(__name__)
+
+OPS = ('put', 'get', 'rm', 'stat')
+
+HELPER = """
+import json
+import sys
+import threading
+import time
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+cluster_name = sys.argv[1]
+max_in_flight = int(sys.argv[2])
+stand_in = len(sys.argv) > 3 and sys.argv[3] == '--stand-in'
+out_lock = threading.Lock()
+local = threading.local()
+
+
+def reply(**kwargs):
+    line = json.dumps(kwargs) + '\\n'
+    with out_lock:
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+if stand_in:
+    store = {}
+
+    class ObjectNotFound(IOError):
+        pass
+
+    class IoCtx(object):
+        def __init__(self, pool, namespace):
+            self.prefix = (pool, namespace)
+
+        def _get(self, name):
+            try:
+                return store[self.prefix + (name,)]
+            except KeyError:
+                raise ObjectNotFound('no such object ' + name)
+
+        def write_full(self, name, data):
+            store[self.prefix + (name,)] = data
+
+        def read(self, name, length, offset):
+            return self._get(name)[offset:offset + length]
+
+        def stat(self, name):
+            return len(self._get(name)), time.gmtime(0)
+
+        def remove_object(self, name):
+            self._get(name)
+            del store[self.prefix + (name,)]
+
+    def open_ioctx(pool, namespace):
+        return IoCtx(pool, namespace)
+else:
+    import rados
+    from rados import ObjectNotFound
+    cluster = rados.Rados(conffile='', clustername=cluster_name)
+    cluster.connect()
+
+    def open_ioctx(pool, namespace):
+        ioctx = cluster.open_ioctx(pool)
+        if namespace:
+            ioctx.set_namespace(namespace)
+        return ioctx
+
+
+def get_ioctx(pool, namespace):
+    # an ioctx carries its namespace, so each thread keeps its own
+    if not hasattr(local, 'ioctxs'):
+        local.ioctxs = {}
+    key = (pool, namespace)
+    if key not in local.ioctxs:
+        local.ioctxs[key] = open_ioctx(pool, namespace)
+    return local.ioctxs[key]
+
+
+def run_op(req):
+    ioctx = get_ioctx(req['pool'], req.get('namespace'))
+    name = req['obj']
+    if req['op'] == 'put':
+        with open(req['fname'], 'rb') as f:
+            ioctx.write_full(name, f.read())
+        return {}
+    if req['op'] == 'rm':
+        ioctx.remove_object(name)
+        return {}
+    size, mtime = ioctx.stat(name)
+    if req['op'] == 'stat':
+        return {'size': size, 'mtime': time.mktime(mtime)}
+    data = ioctx.read(name, size, 0) if size else b''
+    fname = req.get('fname', '/dev/null')
+    if fname != '/dev/null':
+        with open(fname, 'wb') as f:
+            f.write(data)
+    return {'size': size}
+
+
+def worker(requests):
+    for req in iter(requests.get, None):
+        try:
+            result = run_op(req)
+            reply(index=req['index'], exitstatus=0, **result)
+        except Exception as e:
+            reply(index=req['index'], exitstatus=1, error=str(e),
+                  not_found=isinstance(e, ObjectNotFound))
+
+reply(ready=True)
+requests = queue.Queue(max_in_flight)
+workers = [threading.Thread(target=worker, args=(requests,))
+           for _ in range(max_in_flight)]
+for t in workers:
+    t.start()
+for line in iter(sys.stdin.readline, ''):
+    requests.put(json.loads(line))
+for t in workers:
+    requests.put(None)
+for t in workers:
+    t.join()
+"""
+
+
+def rados_args(op):
+    """
+    Return the rados CLI arguments which perform op.
+
+    :param op: an operation dict as accepted by run_ops()
+    """
+    args = ['-p', op['pool']]
+    if op.get('namespace') is not None:
+        args += ['-N', op['namespace']]
+    args += [op['op'], op['obj']]
+    if op['op'] == 'put':
+        args.append(op['fname'])
+    elif op['op'] == 'get':
+        args.append(op.get('fname', '/dev/null'))
+    return args
+
+
+def run_ops(remote, ops, cluster='ceph', max_in_flight=16, timeout=120,
+            stand_in=False):
+    """
+    Run rados object operations through one helper process on remote.
+
+    :param ops: list of dicts with 'op' (one of OPS), 'pool', 'obj' and
+                optionally 'namespace' and 'fname' (the file to put, or
+                to get into; defaults to /dev/null for get)
+    :param max_in_flight: number of operations the helper runs at once
+    :param timeout: seconds to wait for any one result
+    :param stand_in: if true, the helper keeps objects in memory
+                     instead of contacting a cluster (for testing)
+    :returns: a list with one result dict per op, in the order of ops,
+              holding the rados CLI style 'exitstatus' (124 if the
+              helper went away before answering), whether a failed op
+              found the object missing ('not_found') and, for get and
+              stat, the object 'size'; or None if the helper could not be
+              started, in which case the ops were not run
+    """
+    for op in ops:
+        assert op['op'] in OPS, 'unknown rados op {0}'.format(op['op'])
+    args = ['python', '-c', HELPER, cluster, str(max_in_flight)]
+    if stand_in:
+        args.append('--stand-in')
+    proc = remote.run(
+        args=args,
+        stdin=run.PIPE,
+        stdout=run.PIPE,
+        logger=log.getChild(remote.shortname),
+        wait=False,
+    )
+
+    def read_reply():
+        line = None
+        with gevent.Timeout(timeout, False):
+            line = proc.stdout.readline()
+        if not line:
+            return None
+        return json.loads(line)
+
+    def send():
+        for index, op in enumerate(ops):
+            req = dict(op, index=index)
+            proc.stdin.write(json.dumps(req) + '\n')
+        proc.stdin.flush()
+        proc.stdin.close()
+
+    results = [None] * len(ops)
+    writer = None
+    try:
+        ready = read_reply()
+        if ready is None or not ready.get('ready'):
+            log.warning('rados batch helper failed to start on %s',
+                        remote.shortname)
+            return None
+        # send while reading, so that neither side blocks on a full pipe
+        writer = gevent.spawn(send)
+        for _ in ops:
+            reply = read_reply()
+            if reply is None:
+                log.warning('lost rados batch helper on %s',
+                            remote.shortname)
+                break
+            index = reply.pop('index')
+            if reply.get('error'):
+                log.info('rados %s: %s', ' '.join(rados_args(ops[index])),
+                         reply['error'])
+            results[index] = reply
+    finally:
+        if writer is not None:
+            writer.kill()
+        try:
+            proc.stdin.close()
+            with gevent.Timeout(10, False):
+                proc.wait()
+        except Exception:
+            log.debug('rados batch helper exited uncleanly', exc_info=True)
+    return [result or dict(exitstatus=124) for result in results]
@@ -0,0 +1,140 @@
+"""
+Recovery progress time series.
+
+RecoverySeries keeps the recovery rates and the degraded/misplaced
+object counts seen by the polls of a CephManager wait loop in a fixed
+size ring buffer, so that they can be archived for comparison between
+builds and used to estimate how long the remaining recovery should take.
+"""
+from array import array
+import json
+
+FIELDS = ('time', 'objects_per_sec', 'bytes_per_sec',
+          'degraded', 'misplaced')
+
+# where each field comes from in the pgmap summary (ceph pg stat)
+PGMAP_KEYS = {
+    'objects_per_sec': 'recovering_objects_per_sec',
+    'bytes_per_sec': 'recovering_bytes_per_sec',
+    'degraded': 'degraded_objects',
+    'misplaced': 'misplaced_objects',
+}
+
+
+class RecoverySeries(object):
+    """
+    Fixed capacity ring buffer of recovery samples, one array('d')
+    column per field.  Once full, the oldest samples are overwritten.
+
+    :param capacity: number of samples kept
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.columns = dict((field, array('d', [0.0] * capacity))
+                            for field in FIELDS)
+        self.head = 0
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def append(self, when, objects_per_sec, bytes_per_sec,
+               degraded, misplaced):
+        values = (when, objects_per_sec, bytes_per_sec, degraded, misplaced)
+        for field, value in zip(FIELDS, values):
+            self.columns[field][self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def sample(self, pgmap, when):
+        """
+        Record one sample from a pgmap summary.
+
+        :param pgmap: the output of ``ceph pg stat`` (or the pgmap
+                      section of ``ceph status``)
+        :param when: timestamp of the sample
+        """
+        self.append(when, *[pgmap.get(PGMAP_KEYS[field], 0)
+                            for field in FIELDS[1:]])
+
+    def _indices(self, last=None):
+        count = self.size if last is None else min(last, self.size)
+        first = self.head - count
+        return [(first + i) % self.capacity for i in range(count)]
+
+    def column(self, field, last=None):
+        """
+        Return the values of one field, oldest first.
+
+        :param last: only return this many of the most recent values
+        """
+        values = self.columns[field]
+        return [values[i] for i in self._indices(last)]
+
+    def rows(self):
+        """
+        Return the samples as tuples ordered like FIELDS, oldest first.
+        """
+        return zip(*[self.column(field) for field in FIELDS])
+
+    def eta(self, window=10):
+        """
+        Estimate the number of seconds left until the degraded and
+        misplaced objects of the last sample are recovered, using the
+        mean of the last window nonzero object recovery rates.  Rates of
+        zero are left out so that the estimate survives a stall.
+
+        :returns: the estimate, or None if no recovery was seen
+        """
+        rates = [r for r in self.column('objects_per_sec') if r > 0]
+        rates = rates[-window:]
+        if not rates:
+            return None
+        remaining = self.column('degraded', 1)[0] + \
+            self.column('misplaced', 1)[0]
+        return remaining / (sum(rates) / len(rates))
+
+    def stall_timeout(self, timeout, factor=4, floor=120):
+        """
+        Return how long a wait may go without progress before giving up.
+
+        While recovery has a known ETA, a stall longer than factor times
+        that ETA (but at least floor seconds) fails the wait instead of
+        running out the full timeout.
+
+        :param timeout: the timeout given to the wait, or None
+        """
+        eta = self.eta()
+        if timeout is None or eta is None:
+            return timeout
+        return min(timeout, max(floor, factor * eta))
+
+    def summary(self):
+        """
+        Return a dict of aggregate figures for the series.
+        """
+        times = self.column('time')
+        ops = self.column('objects_per_sec')
+        bps = self.column('bytes_per_sec')
+        moving = [r for r in ops if r > 0]
+        return {
+            'samples': self.size,
+            'duration': times[-1] - times[0] if times else 0,
+            'peak_objects_per_sec': max(ops) if ops else 0,
+            'peak_bytes_per_sec': max(bps) if bps else 0,
+            'mean_objects_per_sec':
+                sum(moving) / len(moving) if moving else 0,
+            'peak_degraded': max(self.column('degraded') or [0]),
+            'peak_misplaced': max(self.column('misplaced') or [0]),
+        }
+
+    def write_csv(self, f):
+        f.write(','.join(FIELDS) + '\n')
+        for row in self.rows():
+            f.write(','.join('%.3f' % value for value in row) + '\n')
+
+    def write_json(self, f):
+        j = dict((field, self.column(field)) for field in FIELDS)
+        j['summary'] = self.summary()
+        json.dump(j, f)
@@ -0,0 +1,117 @@
+"""
+Tracking of a round of deep scrubs over every pg.
+
+A pg has been scrubbed once its last_deep_scrub_stamp differs from the
+one it had when the round started, so rather than parsing the stamps of
+every pg on each poll and comparing them with the local clock,
+ScrubTracker keeps the set of pgs not scrubbed yet and only looks at
+those.  Scrubs are handed out pg by pg, a few at a time for each
+primary osd, so that every osd has its next scrubs queued while the
+pg stats are polled, without queueing the whole cluster behind
+osd_max_scrubs.  A scrub which has not finished after retry_after
+seconds is requested again, in case the osd dropped it (e.g. on an
+interval change).
+"""
+from collections import deque
+
+
+class ScrubTracker(object):
+    """
+    :param pg_stats: the pg stats (dicts or PGStats) at the start of the
+                     round
+    :param max_in_flight: number of scrubs handed to each primary osd at
+                          once
+    :param retry_after: seconds after which a scrub which has not
+                        finished is requested again
+    """
+
+    def __init__(self, pg_stats, max_in_flight=4, retry_after=60):
+        self.max_in_flight = max_in_flight
+        self.retry_after = retry_after
+        self.baseline = {}
+        self.primary = {}
+        self.bytes = {}
+        self.queued = {}
+        for pg in pg_stats:
+            pgid = pg['pgid']
+            self.baseline[pgid] = pg['last_deep_scrub_stamp']
+            primary = pg.get('acting_primary')
+            if primary is None:
+                primary = pg['acting'][0] if pg['acting'] else None
+            self.primary[pgid] = primary
+            self.bytes[pgid] = pg['stat_sum']['num_bytes']
+            self.queued.setdefault(primary, deque()).append(pgid)
+        self.unscrubbed = set(self.baseline)
+        self.in_flight = {}
+        self.busy = dict((osd, 0) for osd in self.queued)
+        self.durations = {}
+        self.retried = 0
+
+    @property
+    def done(self):
+        return not self.unscrubbed
+
+    def dispatch(self, now):
+        """
+        Hand out as many scrubs as the per osd limit allows, and those
+        in flight for retry_after seconds again.
+
+        :returns: the pgids to scrub now
+        """
+        pgids = []
+        for pgid, started in self.in_flight.iteritems():
+            if now - started >= self.retry_after:
+                self.in_flight[pgid] = now
+                self.retried += 1
+                pgids.append(pgid)
+        for osd, queue in self.queued.iteritems():
+            while queue and self.busy[osd] < self.max_in_flight:
+                pgid = queue.popleft()
+                if pgid not in self.unscrubbed:
+                    # scrubbed on the osd's own schedule meanwhile
+                    continue
+                self.in_flight[pgid] = now
+                self.busy[osd] += 1
+                pgids.append(pgid)
+        return pgids
+
+    def update(self, pg_stats, now):
+        """
+        Mark the pgs whose scrub stamp moved as scrubbed.
+
+        :returns: the number of pgs newly scrubbed
+        """
+        finished = 0
+        for pg in pg_stats:
+            pgid = pg['pgid']
+            if pgid not in self.unscrubbed or \
+                    pg['last_deep_scrub_stamp'] == self.baseline[pgid]:
+                continue
+            self.unscrubbed.discard(pgid)
+            finished += 1
+            started = self.in_flight.pop(pgid, None)
+            if started is not None:
+                self.durations[pgid] = now - started
+                self.busy[self.primary[pgid]] -= 1
+        return finished
+
+    def report(self, seconds):
+        """
+        :returns: dict with the per pg scrub 'durations', the number of
+                  'pgs' scrubbed and 'unscrubbed', the number of scrubs
+                  'retried', and the throughput of the round in pgs and
+                  bytes per second
+        """
+        scrubbed = [pgid for pgid in self.baseline
+                    if pgid not in self.unscrubbed]
+        seconds = max(seconds, 1e-6)
+        return {
+            'pgs': len(scrubbed),
+            'unscrubbed': sorted(self.unscrubbed),
+            'retried': self.retried,
+            'seconds': seconds,
+            'pgs_per_sec': len(scrubbed) / seconds,
+            'bytes_per_sec': sum(self.bytes[pgid]
+                                 for pgid in scrubbed) / seconds,
+            'durations': self.durations,
+        }
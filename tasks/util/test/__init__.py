@@ -0,0 +1,86 @@
+import sys
+
+from gevent import subprocess
+
+from teuthology.exceptions import CommandFailedError
+from teuthology.orchestra import run
+
+
+class LocalProcess(object):
+    """
+    Stands in for the process returned by remote.run().
+
+    Output asked for with run.PIPE is left to the caller, like on a
+    remote channel: a caller which stops reading it blocks the process.
+    Other output is written to the file-like objects given to run()
+    once the process exits.
+    """
+
+    def __init__(self, proc, stdin, stdout, stderr):
+        self.proc = proc
+        self.input = stdin if isinstance(stdin, str) else None
+        self.stdin = proc.stdin
+        self.stdout = proc.stdout if stdout is run.PIPE else stdout
+        self.stderr = proc.stderr if stderr is run.PIPE else stderr
+        self.exitstatus = None
+
+    def kill(self):
+        self.proc.kill()
+
+    def wait(self):
+        if self.stdout is self.proc.stdout:
+            if self.input is not None:
+                self.proc.stdin.write(self.input)
+                self.proc.stdin.close()
+            err = None
+            if self.proc.stderr and self.stderr is not self.proc.stderr:
+                err = self.proc.stderr.read()
+            self.proc.wait()
+            out = None
+        else:
+            out, err = self.proc.communicate(self.input)
+        if out and self.stdout is not None:
+            self.stdout.write(out)
+        if err and self.stderr is not None:
+            self.stderr.write(err)
+        self.exitstatus = self.proc.returncode
+        return self.exitstatus
+
+
+class LocalRemote(object):
+    """
+    Runs commands as local subprocesses instead of on a remote, without
+    sudo, and with the python running the tests for python.
+
+    :param shortname: the name of the remote
+    :param env: environment to run the commands with
+    """
+
+    def __init__(self, shortname='local', env=None):
+        self.shortname = shortname
+        self.env = env
+        self.procs = []
+
+    def run(self, args, stdin=None, stdout=None, stderr=None, wait=True,
+            check_status=True, logger=None):
+        if isinstance(args, str):
+            args = ['bash', '-c', args]
+        if args[0] == 'sudo':
+            args = args[1:]
+        if args[0] == 'python':
+            args = [sys.executable] + args[1:]
+        proc = LocalProcess(
+            subprocess.Popen(
+                args,
+                env=self.env,
+                stdin=subprocess.PIPE if stdin is not None else None,
+                stdout=subprocess.PIPE if stdout is not None else None,
+                stderr=subprocess.PIPE if stderr is not None else None),
+            stdin, stdout, stderr)
+        self.procs.append(proc)
+        if wait:
+            proc.wait()
+            if check_status and proc.exitstatus != 0:
+                raise CommandFailedError(args, proc.exitstatus,
+                                         self.shortname)
+        return proc
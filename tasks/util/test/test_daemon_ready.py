@@ -0,0 +1,53 @@
+import json
+import os
+import shutil
+import stat
+import tempfile
+
+from mock import patch
+
+from .. import daemon_ready
+from . import LocalRemote
+
+# answers admin socket commands with the contents of the socket "file"
+CEPH = """#!/bin/sh
+cat "$2"
+"""
+
+
+class TestWaitReady(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        ceph = os.path.join(self.tmp, 'ceph')
+        with open(ceph, 'w') as f:
+            f.write(CEPH)
+        os.chmod(ceph, stat.S_IRWXU)
+        self.env = dict(os.environ,
+                        PATH=self.tmp + os.pathsep + os.environ['PATH'])
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_ready(self):
+        states = {
+            'osd.0': {'state': 'active'},
+            'mon.a': {'state': 'probing'},
+            'mgr.x': {'version': '12.0.0'},
+        }
+        for name, state in states.iteritems():
+            with open(os.path.join(self.tmp, 'ceph-' + name + '.asok'),
+                      'w') as f:
+                json.dump(state, f)
+        asok = os.path.join(self.tmp, '{cluster}-{type}.{id}.asok')
+        with patch.object(daemon_ready, 'ASOK', asok):
+            latency = daemon_ready.wait_ready(
+                LocalRemote(env=self.env), 'ceph',
+                [('osd.0', 'osd', '0'), ('osd.1', 'osd', '1'),
+                 ('mon.a', 'mon', 'a'), ('mgr.x', 'mgr', 'x')],
+                timeout=0.5, interval=0.05)
+        assert latency['osd.0'] < 0.5
+        assert latency['mgr.x'] < 0.5
+        # no admin socket yet, and not in quorum
+        assert latency['osd.1'] is None
+        assert latency['mon.a'] is None
@@ -0,0 +1,45 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+from mock import patch
+
+from .. import log_archive
+from . import LocalRemote
+
+
+class TestArchiveLogs(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.logdir = os.path.join(self.tmp, 'log')
+        os.makedirs(os.path.join(self.logdir, 'valgrind'))
+        for name in ('ceph-osd.0.log', 'valgrind/osd.0.log'):
+            with open(os.path.join(self.logdir, name), 'w') as f:
+                f.write('debug line\n' * 1000)
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_archive(self):
+        archive = os.path.join(self.tmp, 'archive')
+        stats = log_archive.archive_logs(
+            [LocalRemote('a')], self.logdir, archive)
+        assert stats['a']['bytes'] > 0
+        got = os.path.join(archive, 'a', 'log')
+        assert sorted(os.listdir(got)) == ['ceph-osd.0.log.gz', 'valgrind']
+        with gzip.open(os.path.join(got, 'valgrind', 'osd.0.log.gz')) as f:
+            assert f.read() == 'debug line\n' * 1000
+
+    def test_bandwidth(self):
+        limiter = log_archive.BandwidthLimiter(1000)
+        with patch.object(log_archive.gevent, 'sleep') as sleep:
+            limiter.consume(500)
+            limiter.consume(500)
+        delays = [call[0][0] for call in sleep.call_args_list]
+        assert 0.4 < delays[0] <= 0.5
+        assert 0.9 < delays[1] <= 1.0
+        with patch.object(log_archive.gevent, 'sleep') as sleep:
+            log_archive.BandwidthLimiter(None).consume(500)
+        assert not sleep.called
@@ -0,0 +1,127 @@
+import os
+import shutil
+import stat
+import tempfile
+
+import gevent
+import pytest
+
+from teuthology.exceptions import ConfigError
+
+from .. import log_rotate
+from . import LocalRemote
+
+# rotates the files named on the first line of the stanza it is given
+LOGROTATE = """#!/bin/sh
+for f in $(head -1 "$1" | cut -d' ' -f1); do
+    mv "$f" "$f.1"
+done
+"""
+
+
+class TestLogRotateWatcher(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+        self.log_dir = os.path.join(self.tmp, 'log')
+        os.mkdir(self.log_dir)
+        logrotate = os.path.join(self.tmp, 'logrotate')
+        with open(logrotate, 'w') as f:
+            f.write(LOGROTATE)
+        os.chmod(logrotate, stat.S_IRWXU)
+        self.env = dict(os.environ,
+                        PATH=self.tmp + os.pathsep + os.environ['PATH'])
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def stanzas(self):
+        return dict(
+            (daemon, '{dir}/*{daemon}*.log {{\n}}\n'.format(
+                dir=self.log_dir, daemon=daemon))
+            for daemon in ('ceph-osd', 'ceph-mon'))
+
+    def test_rotate_past_limit(self):
+        stanzas = self.stanzas()
+        osd_log = os.path.join(self.log_dir, 'ceph-osd.0.log')
+        mon_log = os.path.join(self.log_dir, 'ceph-mon.a.log')
+        for path in (osd_log, mon_log):
+            open(path, 'w').close()
+        watcher = log_rotate.LogRotateWatcher(
+            {'ceph-osd': '1k', 'ceph-mon': '1M'}, stanzas,
+            log_dir=self.log_dir, interval=0.05)
+        watcher.begin([LocalRemote(env=self.env)])
+        gevent.sleep(0.2)
+        with open(osd_log, 'w') as f:
+            f.write('x' * 2048)
+        with open(mon_log, 'w') as f:
+            f.write('x' * 2048)
+        gevent.sleep(0.5)
+        stats = watcher.end()
+        assert stats['ceph-osd']['rotations'] == 1
+        assert stats['ceph-osd']['peak_bytes_per_sec'] > 2048
+        assert stats['ceph-mon']['rotations'] == 0
+        assert os.path.exists(osd_log + '.1')
+        assert not os.path.exists(mon_log + '.1')
+
+    def write_logrotate(self, script):
+        logrotate = os.path.join(self.tmp, 'logrotate')
+        with open(logrotate, 'w') as f:
+            f.write(script)
+
+    def rotations(self, size):
+        osd_log = os.path.join(self.log_dir, 'ceph-osd.0.log')
+        open(osd_log, 'w').close()
+        watcher = log_rotate.LogRotateWatcher(
+            {'ceph-osd': '1k', 'ceph-mon': '1M'}, self.stanzas(),
+            log_dir=self.log_dir, interval=0.05)
+        watcher.begin([LocalRemote(env=self.env)])
+        gevent.sleep(0.2)
+        with open(osd_log, 'w') as f:
+            f.write('x' * size)
+        gevent.sleep(0.5)
+        return watcher.end()['ceph-osd']['rotations']
+
+    def test_at_limit(self):
+        assert self.rotations(1024) == 0
+        assert not os.path.exists(
+            os.path.join(self.log_dir, 'ceph-osd.0.log.1'))
+
+    def test_logrotate_failed(self):
+        self.write_logrotate('#!/bin/sh\nexit 1\n')
+        assert self.rotations(2048) == 0
+
+    def test_logrotate_kept_logs(self):
+        self.write_logrotate('#!/bin/sh\nexit 0\n')
+        assert self.rotations(2048) == 0
+
+    def test_invalid_size(self):
+        for size in ('1g', '1.5M', 'big', ''):
+            with pytest.raises(ConfigError):
+                log_rotate.LogRotateWatcher(
+                    {'ceph-osd': size}, {'ceph-osd': ''})
+
+    def test_parse_size(self):
+        assert log_rotate.parse_size(100) == 100
+        assert log_rotate.parse_size('1k') == 1024
+        assert log_rotate.parse_size('2M') == 2 << 20
+        assert log_rotate.parse_size('1G') == 1 << 30
+
+    def test_respawn(self):
+        osd_log = os.path.join(self.log_dir, 'ceph-osd.0.log')
+        watcher = log_rotate.LogRotateWatcher(
+            {'ceph-osd': '1k', 'ceph-mon': '1M'}, self.stanzas(),
+            log_dir=self.log_dir, interval=0.05, respawn_interval=0.1)
+        remote = LocalRemote(env=self.env)
+        watcher.begin([remote])
+        for _ in range(2):
+            gevent.sleep(0.3)
+            with open(osd_log, 'w') as f:
+                f.write('x' * 2048)
+            gevent.sleep(0.3)
+            if len(remote.procs) == 1:
+                # the node goes down with its watcher
+                remote.procs[0].kill()
+        stats = watcher.end()
+        assert len(remote.procs) == 2
+        assert stats['ceph-osd']['rotations'] == 2
@@ -0,0 +1,34 @@
+import tempfile
+
+from .. import log_scan
+from . import LocalRemote
+
+
+LOG = """\
+2017-01-01 mon.0 [INF] osdmap e1
+2017-01-01 mon.0 [WRN] slow request 30 seconds old
+2017-01-01 mon.0 [ERR] scrub 1.0 shard 2 missing
+2017-01-01 mon.0 [WRN] clock skew detected
+2017-01-01 mon.0 [ERR] full ratio reached
+"""
+
+
+class TestScanLog(object):
+
+    def scan(self, whitelist):
+        f = tempfile.NamedTemporaryFile()
+        f.write(LOG)
+        f.flush()
+        return log_scan.scan_log(LocalRemote(), f.name, whitelist)
+
+    def test_first_per_severity(self):
+        result = self.scan(['slow request', 'scrub .* missing'])
+        assert result['first'] == {
+            'WRN': '2017-01-01 mon.0 [WRN] clock skew detected',
+            'ERR': '2017-01-01 mon.0 [ERR] full ratio reached',
+        }
+        assert result['bytes'] == len(LOG)
+        assert self.scan(['.*'])['first'] == {}
+
+    def test_bad_whitelist(self):
+        assert self.scan(['(unbalanced']) is None
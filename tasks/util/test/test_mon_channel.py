@@ -0,0 +1,96 @@
+import json
+
+import gevent
+from mock import Mock
+
+from .. import mon_channel
+from . import LocalRemote
+
+
+class TestParseCephArgs(object):
+
+    def test_format(self):
+        words, fmt = mon_channel.parse_ceph_args(
+            ['pg', 'dump', '--format=json'])
+        assert words == ['pg', 'dump']
+        assert fmt == 'json'
+        words, fmt = mon_channel.parse_ceph_args(
+            ['--format', 'json-pretty', 'status'])
+        assert words == ['status']
+        assert fmt == 'json-pretty'
+
+    def test_leading_separator(self):
+        words, fmt = mon_channel.parse_ceph_args(
+            ['--', 'pg', '1.0', 'list_missing', '{}'])
+        assert words == ['pg', '1.0', 'list_missing', '{}']
+        assert fmt is None
+
+    def test_read_only(self):
+        assert mon_channel.read_only(['osd', 'pool', 'get', 'rbd', 'size'])
+        assert mon_channel.read_only(['pg', 'dump'])
+        assert not mon_channel.read_only(['osd', 'pool', 'set', 'rbd',
+                                          'size', '2'])
+        assert not mon_channel.read_only(['osd', 'out', '3'])
+
+    def test_needs_cli(self):
+        assert mon_channel.parse_ceph_args(
+            ['--', 'tell', 'osd.0', 'injectargs', '--debug-osd 20']) is None
+        assert mon_channel.parse_ceph_args(
+            ['--', 'mon', 'tell', '*', 'injectargs']) is None
+        assert mon_channel.parse_ceph_args(
+            ['-m', '1.2.3.4', 'mon_status']) is None
+        assert mon_channel.parse_ceph_args([]) is None
+
+
+class TestMonCommandChannel(object):
+
+    def test_stand_in(self):
+        channel = mon_channel.MonCommandChannel(LocalRemote(),
+                                                stand_in=True)
+        try:
+            for _ in range(3):
+                exitstatus, out = channel.command(
+                    ['osd', 'dump', '--format=json'])
+                assert exitstatus == 0
+                assert json.loads(out.split('\n', 1)[1]) == ['osd', 'dump']
+            assert channel.command(['tell', 'osd.0', 'version']) is None
+            assert channel.commands == 3
+            assert channel.fallbacks == 1
+        finally:
+            channel.close()
+
+    def test_helper_failure_falls_back(self):
+        remote = Mock(shortname='remote')
+        remote.run.return_value.stdout.readline.return_value = ''
+        channel = mon_channel.MonCommandChannel(remote)
+        assert channel.command(['osd', 'stat']) is None
+        assert channel.broken
+        assert channel.command(['osd', 'stat']) is None
+        assert remote.run.call_count == 1
+
+    def test_lost_helper(self):
+        remote = Mock(shortname='remote')
+        proc = remote.run.return_value
+        replies = ['{"ready": true, "pid": 1234}\n', '']
+        proc.stdout.readline.side_effect = lambda: replies.pop(0)
+        channel = mon_channel.MonCommandChannel(remote)
+        channel.close_timeout = 0.01
+        # a read-only command goes to the ceph CLI instead
+        assert channel.command(['osd', 'dump', '--format=json']) is None
+        replies[:] = ['{"ready": true, "pid": 1235}\n', '']
+        # one which may have happened is not run again
+        assert channel.command(['osd', 'out', '3']) == (124, '')
+        assert channel.fallbacks == 1
+
+    def test_close_kills_stuck_helper(self):
+        remote = Mock(shortname='remote')
+        proc = remote.run.return_value
+        proc.stdout.readline.return_value = '{"ready": true, "pid": 1234}\n'
+        proc.wait.side_effect = lambda: gevent.sleep(10)
+        channel = mon_channel.MonCommandChannel(remote)
+        channel.close_timeout = 0.01
+        channel._start()
+        channel.close()
+        proc.stdin.close.assert_called_once_with()
+        remote.run.assert_called_with(args=['sudo', 'kill', '-KILL', '1234'],
+                                      check_status=False)
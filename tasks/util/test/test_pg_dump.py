@@ -0,0 +1,99 @@
+import json
+from cStringIO import StringIO
+
+from .. import pg_dump
+
+
+def make_dump(pg_stats, version=7):
+    return 'dumped all in format json\n' + json.dumps(
+        {'version': version, 'stamp': '2017-01-01',
+         'pg_stats': pg_stats, 'osd_stats': [{'osd': 0}]})
+
+
+class TestParsePGDump(object):
+
+    def test_small_chunks(self):
+        text = pg_dump.synthetic_pg_dump(50)
+        expected = json.loads(text)['pg_stats']
+        f = StringIO(text)
+        pgs = list(pg_dump.iter_pg_stats(f, chunk_size=7))
+        assert pgs == expected
+        assert f.read() == ''
+
+    def test_compact(self):
+        version, pgs = pg_dump.parse_pg_dump(StringIO(make_dump([
+            {'pgid': '1.0', 'state': 'active+clean', 'acting': [0, 1],
+             'stat_sum': {'num_bytes': 10, 'num_objects_unfound': 1}},
+            {'pgid': '1.1', 'state': 'active+clean', 'acting': [1, 2]},
+        ])))
+        assert version == 7
+        assert [pg['pgid'] for pg in pgs] == ['1.0', '1.1']
+        assert pgs[0]['acting'] == (0, 1)
+        assert pgs[0]['stat_sum']['num_bytes'] == 10
+        assert pgs[0]['stat_sum']['num_objects_unfound'] == 1
+        assert pgs[1]['stat_sum']['num_objects_unfound'] == 0
+        assert pgs[0].state is pgs[1].state
+        assert pgs[0].get('log_size') is None
+
+    def test_state_mask(self):
+        mask = pg_dump.state_mask('active+clean')
+        assert mask == pg_dump.state_bits('clean', 'active')
+        assert mask & pg_dump.state_bits('active')
+        assert not mask & pg_dump.state_bits('down')
+
+    def test_empty(self):
+        version, pgs = pg_dump.parse_pg_dump(StringIO(make_dump([])))
+        assert (version, pgs) == (7, [])
+
+    def test_truncated(self):
+        text = make_dump([{'pgid': '1.0', 'state': 'active'}] * 3)
+        try:
+            pg_dump.parse_pg_dump(StringIO(text[:-60]))
+        except ValueError:
+            pass
+        else:
+            assert False, 'truncated dump was accepted'
+
+
+class TestPGStateIndex(object):
+
+    def setup(self):
+        self.index = pg_dump.PGStateIndex([
+            {'pgid': '1.0', 'state': 'active+clean', 'acting': [0, 1]},
+            {'pgid': '1.1', 'state': 'active+recovering+degraded',
+             'acting': [1, 2]},
+            {'pgid': '2.0', 'state': 'active+clean', 'acting': [2, 0]},
+            {'pgid': '2.1', 'state': 'down+peering', 'acting': [1]},
+        ])
+
+    def test_count(self):
+        bits = pg_dump.state_bits
+        assert len(self.index) == 4
+        assert self.index.count(all_of=bits('active', 'clean')) == 2
+        assert self.index.count(any_of=bits('down', 'clean')) == 3
+        assert self.index.count(
+            all_of=bits('active'),
+            none_of=pg_dump.substring_bits('recover', 'backfill')) == 2
+
+    def test_histograms(self):
+        assert self.index.histogram() == {
+            'active': 3, 'clean': 2, 'recovering': 1, 'degraded': 1,
+            'down': 1, 'peering': 1}
+        assert self.index.pool_histograms()[2] == {
+            'active': 1, 'clean': 1, 'down': 1, 'peering': 1}
+        assert self.index.osd_histograms()[0] == {'active': 2, 'clean': 2}
+        assert self.index.osd_count(
+            1, all_of=pg_dump.state_bits('degraded')) == 1
+        assert self.index.pool_count(
+            3, all_of=pg_dump.state_bits('active')) == 0
+
+    def test_osd_loads(self):
+        version, pgs = pg_dump.parse_pg_dump(StringIO(make_dump([
+            {'pgid': '1.0', 'state': 'active+clean', 'acting': [0, 1],
+             'acting_primary': 0, 'stat_sum': {'num_bytes': 10}},
+            {'pgid': '1.1', 'state': 'active+degraded', 'acting': [1],
+             'acting_primary': 1, 'stat_sum': {'num_bytes': 5}},
+        ])))
+        loads = pg_dump.PGStateIndex(pgs).osd_loads()
+        assert loads[0] == dict(pgs=1, primaries=1, bytes=10, degraded=0)
+        assert loads[1] == dict(pgs=2, primaries=1, bytes=15, degraded=1)
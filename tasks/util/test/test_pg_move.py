@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+
+import gevent
+
+from .. import pg_move
+from . import LocalRemote
+
+# stands in for ceph-objectstore-tool: each osd is a directory holding
+# one file per pg
+TOOL = """
+dir=$1; shift
+case "$2" in
+    export) cat $dir/$4 ;;
+    import) [ -e $dir/incompatible ] && exit 11; cat > $dir/imported ;;
+    remove) rm $dir/$4 ;;
+esac
+"""
+
+
+class TestPGMover(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+        self.tool = os.path.join(self.dir, 'tool.sh')
+        with open(self.tool, 'w') as f:
+            f.write(TOOL)
+        for osd in range(4):
+            os.mkdir(self.osd_dir(osd))
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def osd_dir(self, osd):
+        return os.path.join(self.dir, 'osd{0}'.format(osd))
+
+    def make_mover(self, remotes, compression=None):
+        return pg_move.PGMover(
+            lambda osd: 'bash {0} {1}'.format(self.tool, self.osd_dir(osd)),
+            lambda osd: remotes[osd],
+            compression=compression, chunk_size=4096)
+
+    def test_moves(self):
+        a, b = LocalRemote('a'), LocalRemote('b')
+        data = os.urandom(1000) * 100
+        for osd in (0, 2):
+            with open(os.path.join(self.osd_dir(osd), '1.0'), 'w') as f:
+                f.write(data)
+        mover = self.make_mover({0: a, 1: a, 2: a, 3: b},
+                                compression='gzip')
+        results = mover.move_all([('1.0', 0, 1), ('1.0', 2, 3)])
+        assert [r['ok'] for r in results] == [True, True]
+        assert results[0]['bytes'] == len(data)
+        # compressed on the wire between hosts
+        assert 0 < results[1]['bytes'] < len(data)
+        assert all(r['bytes_per_sec'] > 0 for r in results)
+        for src, dst in ((0, 1), (2, 3)):
+            assert not os.listdir(self.osd_dir(src))
+            with open(os.path.join(self.osd_dir(dst), 'imported')) as f:
+                assert f.read() == data
+
+    def test_failed_export(self):
+        a, b = LocalRemote('a'), LocalRemote('b')
+        mover = self.make_mover({0: a, 1: a, 2: a, 3: b})
+        results = mover.move_all([('1.0', 0, 1), ('1.0', 2, 3)])
+        assert [r['ok'] for r in results] == [False, False]
+        assert [r['export_status'] for r in results] == [1, 1]
+
+    def test_import_exits_early(self):
+        a, b = LocalRemote('a'), LocalRemote('b')
+        # more than fits in a pipe, so the export blocks unless drained
+        data = os.urandom(1 << 20)
+        with open(os.path.join(self.osd_dir(0), '1.0'), 'w') as f:
+            f.write(data)
+        open(os.path.join(self.osd_dir(1), 'incompatible'), 'w').close()
+        mover = self.make_mover({0: a, 1: b})
+        with gevent.Timeout(30):
+            result = mover.move('1.0', 0, 1)
+        assert result['export_status'] == 0
+        assert result['import_status'] == pg_move.IMPORT_INCOMPATIBLE
+        assert result['bytes'] < len(data)
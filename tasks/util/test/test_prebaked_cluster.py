@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+
+from mock import Mock, patch
+
+from .. import prebaked_cluster
+
+
+def cluster_roles_of_type(roles, type_, cluster):
+    return [role for role in roles if role.split('.')[0] == type_]
+
+
+def make_ctx(remotes):
+    ctx = Mock()
+    ctx.config = {'sha1': 'abc'}
+    ctx.cluster.remotes = remotes
+    return ctx
+
+
+class TestPrebakedCluster(object):
+
+    def setup(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_cache_key(self):
+        ctx = make_ctx({Mock(): ['mon.a', 'osd.0'], Mock(): ['osd.1']})
+        config = {'cluster': 'ceph', 'fs': 'xfs'}
+        key = prebaked_cluster.cache_key(
+            ctx, config, {'mon.a': {'mon addr': '10.0.0.1:6789'}})
+        # the monitor addresses change from job to job
+        assert key == prebaked_cluster.cache_key(
+            ctx, config, {'mon.a': {'mon addr': '10.0.0.2:6789'}})
+        assert key != prebaked_cluster.cache_key(
+            ctx, dict(config, fs='btrfs'), {})
+        ctx.config = {}
+        assert prebaked_cluster.unsupported_reason(ctx, config, {})
+        assert prebaked_cluster.unsupported_reason(
+            ctx, dict(config, sha1='abc', tmpfs_journal=True), {})
+        assert prebaked_cluster.unsupported_reason(
+            ctx, dict(config, sha1='abc'),
+            {'osd': {'osd objectstore': 'bluestore'}})
+        assert not prebaked_cluster.unsupported_reason(
+            ctx, dict(config, sha1='abc'), {})
+
+    @patch.object(prebaked_cluster.teuthology, 'cluster_roles_of_type',
+                  cluster_roles_of_type, create=True)
+    def test_bake(self):
+        remote = Mock()
+        ctx = make_ctx({remote: ['mon.a', 'osd.0', 'client.0']})
+
+        def pull_directory_tarball(remote, path, local):
+            with open(local, 'w') as f:
+                f.write(path)
+
+        def get_file(remote, path, sudo=False):
+            return 'contents of ' + path
+
+        with patch.object(prebaked_cluster.teuthology,
+                          'pull_directory_tarball',
+                          pull_directory_tarball, create=True), \
+                patch.object(prebaked_cluster.teuthology, 'get_file',
+                             get_file, create=True):
+            image = prebaked_cluster.PrebakedCluster(ctx, 'ceph',
+                                                     self.cache_dir, 'key')
+            assert not image.hit
+            image.bake('some-fsid', remote, '/etc/ceph/ceph.keyring')
+            # a second bake of the same image leaves the first alone
+            image.bake('other-fsid', remote, '/etc/ceph/ceph.keyring')
+
+        assert os.listdir(self.cache_dir) == ['key']
+        image = prebaked_cluster.PrebakedCluster(ctx, 'ceph',
+                                                 self.cache_dir, 'key')
+        assert image.hit
+        assert image.fsid == 'some-fsid'
+        assert sorted(os.listdir(image.path)) == [
+            'client.0', 'keyring', 'manifest.json', 'mon.a.tgz',
+            'osd.0.tgz']
+        assert image.manifest['roles']['osd.0'] == {
+            'type': 'osd', 'path': '/var/lib/ceph/osd/ceph-0'}
+
+    @patch.object(prebaked_cluster.teuthology, 'cluster_roles_of_type',
+                  cluster_roles_of_type, create=True)
+    def test_restore(self):
+        path = os.path.join(self.cache_dir, 'key')
+        os.mkdir(path)
+        for name in ('keyring', 'client.0', 'mon.a.tgz', 'osd.0.tgz'):
+            with open(os.path.join(path, name), 'w') as f:
+                f.write(name)
+        with open(os.path.join(path, 'manifest.json'), 'w') as f:
+            f.write('{"fsid": "some-fsid", "roles": {}}')
+        remote = Mock()
+        ctx = make_ctx({remote: ['mon.a', 'osd.0', 'client.0']})
+        written = {}
+
+        def sudo_write_file(remote, path, data, perms=None):
+            written[path] = data
+
+        with patch.object(prebaked_cluster.teuthology, 'sudo_write_file',
+                          sudo_write_file, create=True), \
+                patch.object(prebaked_cluster.teuthology, 'write_file',
+                             create=True) as write_file, \
+                patch.object(prebaked_cluster.teuthology, 'get_file',
+                             return_value='new monmap', create=True):
+            image = prebaked_cluster.PrebakedCluster(ctx, 'ceph',
+                                                     self.cache_dir, 'key')
+            image.restore('/tmp/staging', '/etc/ceph/ceph.keyring',
+                          '/tmp/monmap',
+                          {'mon.a': {'mon addr': '10.0.0.2:6789'}}, remote)
+
+        assert written == {'/etc/ceph/ceph.keyring': 'keyring',
+                           '/etc/ceph/ceph.client.0.keyring': 'client.0'}
+        commands = [c[1]['args'] for c in remote.run.call_args_list]
+        # the new monmap keeps the cached fsid and gets this job's address
+        assert commands[0] == ['monmaptool', '--create', '--clobber',
+                               '--fsid', 'some-fsid',
+                               '--add', 'a', '10.0.0.2:6789', '/tmp/monmap']
+        write_file.assert_called_once_with(remote=remote, path='/tmp/monmap',
+                                           data='new monmap')
+        assert sorted(c[0] for c in remote.put_file.call_args_list) == [
+            (os.path.join(path, 'mon.a.tgz'), '/tmp/staging/mon.a.tgz'),
+            (os.path.join(path, 'osd.0.tgz'), '/tmp/staging/osd.0.tgz'),
+        ]
+        assert ['sudo', 'tar', '-C', '/var/lib/ceph/osd/ceph-0', '-xzpf',
+                '/tmp/staging/osd.0.tgz'] in [c[:6] for c in commands]
+        assert ['sudo', 'ceph-mon', '--cluster', 'ceph', '-i', 'a',
+                '--inject-monmap', '/tmp/monmap'] in commands
+        # the monmap is injected after the mon store is unpacked
+        assert commands.index(['sudo', 'ceph-mon', '--cluster', 'ceph',
+                               '-i', 'a', '--inject-monmap',
+                               '/tmp/monmap']) > \
+            [c[:6] for c in commands].index(
+                ['sudo', 'tar', '-C', '/var/lib/ceph/mon/ceph-a', '-xzpf',
+                 '/tmp/staging/mon.a.tgz'])
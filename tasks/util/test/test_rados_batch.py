@@ -0,0 +1,50 @@
+import tempfile
+
+from mock import Mock
+
+from .. import rados_batch
+from . import LocalRemote
+
+
+def op(op, obj, **kwargs):
+    return dict(kwargs, op=op, pool='data', obj=obj)
+
+
+class TestRadosBatch(object):
+
+    def test_rados_args(self):
+        assert rados_batch.rados_args(op('get', 'foo')) == \
+            ['-p', 'data', 'get', 'foo', '/dev/null']
+        assert rados_batch.rados_args(
+            op('put', 'foo', namespace='ns', fname='/etc/hosts')) == \
+            ['-p', 'data', '-N', 'ns', 'put', 'foo', '/etc/hosts']
+
+    def test_stand_in(self):
+        src = tempfile.NamedTemporaryFile()
+        src.write('contents')
+        src.flush()
+        names = ['obj%d' % i for i in range(20)]
+
+        def run_ops(ops):
+            results = rados_batch.run_ops(LocalRemote(), ops,
+                                          max_in_flight=4, stand_in=True)
+            return [r['exitstatus'] for r in results]
+
+        # ops within a batch run concurrently, so they must not depend
+        # on one another; each batch starts with an empty stand-in pool
+        assert run_ops(
+            [op('put', name, fname=src.name) for name in names] +
+            [op('put', 'other', namespace='ns', fname=src.name),
+             op('put', 'missing', fname='/nonexistent')]) == \
+            [0] * 21 + [1]
+        results = rados_batch.run_ops(
+            LocalRemote(),
+            [op('put', 'foo', fname=src.name), op('rm', 'bar')],
+            stand_in=True)
+        assert [r['exitstatus'] for r in results] == [0, 1]
+        assert results[1]['not_found']
+
+    def test_helper_failure(self):
+        remote = Mock(shortname='remote')
+        remote.run.return_value.stdout.readline.return_value = ''
+        assert rados_batch.run_ops(remote, [op('rm', 'foo')]) is None
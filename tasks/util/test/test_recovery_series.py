@@ -0,0 +1,64 @@
+from cStringIO import StringIO
+import json
+
+from ..recovery_series import RecoverySeries
+
+
+class TestRecoverySeries(object):
+
+    def test_ring_buffer_wraps(self):
+        series = RecoverySeries(capacity=3)
+        for i in range(5):
+            series.append(i, i * 10, i * 100, 50 - i, 0)
+        assert len(series) == 3
+        assert series.column('time') == [2, 3, 4]
+        assert series.column('degraded', last=1) == [46]
+        assert [row[0] for row in series.rows()] == [2, 3, 4]
+
+    def test_sample_from_pgmap(self):
+        series = RecoverySeries()
+        series.sample({'recovering_objects_per_sec': 5,
+                       'degraded_objects': 40}, 1.0)
+        assert series.rows() == [(1.0, 5, 0, 40, 0)]
+
+    def test_eta(self):
+        series = RecoverySeries()
+        assert series.eta() is None
+        series.append(0, 0, 0, 100, 0)
+        assert series.eta() is None
+        series.append(3, 10, 4096, 70, 30)
+        assert series.eta() == 10
+        # a stall keeps the last known rate
+        series.append(6, 0, 0, 70, 30)
+        assert series.eta() == 10
+        series.append(9, 0, 0, 0, 0)
+        assert series.eta() == 0
+        # pgs peering or creating, with no objects to recover
+        series = RecoverySeries()
+        series.sample({}, 0)
+        assert series.eta() is None
+        assert series.stall_timeout(900) == 900
+
+    def test_stall_timeout(self):
+        series = RecoverySeries()
+        assert series.stall_timeout(None) is None
+        assert series.stall_timeout(360) == 360
+        series.append(0, 10, 0, 100, 0)
+        assert series.stall_timeout(360, factor=4, floor=30) == 40
+        assert series.stall_timeout(360, factor=4, floor=120) == 120
+        assert series.stall_timeout(20, factor=4, floor=120) == 20
+
+    def test_dump(self):
+        series = RecoverySeries()
+        series.append(0, 10, 100, 20, 0)
+        series.append(3, 20, 200, 0, 0)
+        f = StringIO()
+        series.write_csv(f)
+        lines = f.getvalue().splitlines()
+        assert lines[0] == 'time,objects_per_sec,bytes_per_sec,degraded,misplaced'
+        assert len(lines) == 3
+        f = StringIO()
+        series.write_json(f)
+        j = json.loads(f.getvalue())
+        assert j['summary']['peak_objects_per_sec'] == 20
+        assert j['summary']['duration'] == 3
@@ -0,0 +1,50 @@
+from .. import pg_dump
+from ..scrub_tracker import ScrubTracker
+
+
+def pg(pgid, primary, stamp, num_bytes=100):
+    return pg_dump.PGStat({
+        'pgid': pgid, 'state': 'active+clean', 'acting': [primary, 9],
+        'acting_primary': primary, 'last_deep_scrub_stamp': stamp,
+        'stat_sum': {'num_bytes': num_bytes}})
+
+
+class TestScrubTracker(object):
+
+    def test_round(self):
+        old = '2017-01-01 00:00:00.000000'
+        new = '2017-01-01 00:10:00.000000'
+        tracker = ScrubTracker([pg('1.0', 0, old), pg('1.1', 0, old),
+                                pg('1.2', 1, old), pg('1.3', 1, old)],
+                               max_in_flight=1)
+        assert sorted(tracker.dispatch(0)) == ['1.0', '1.2']
+        # nothing more until a scrub on each osd finishes
+        assert tracker.dispatch(1) == []
+        # 1.3 was scrubbed on osd.1's own schedule
+        assert tracker.update([pg('1.0', 0, new), pg('1.1', 0, old),
+                               pg('1.2', 1, old), pg('1.3', 1, new)],
+                              10) == 2
+        assert tracker.dispatch(10) == ['1.1']
+        assert tracker.update([pg('1.1', 0, new), pg('1.2', 1, new)],
+                              15) == 2
+        assert tracker.done
+        report = tracker.report(20)
+        assert report['durations'] == {'1.0': 10, '1.1': 5, '1.2': 15}
+        assert report['pgs'] == 4
+        assert report['bytes_per_sec'] == 20
+
+    def test_retry(self):
+        old = '2017-01-01 00:00:00.000000'
+        new = '2017-01-01 00:10:00.000000'
+        tracker = ScrubTracker([pg('1.0', 0, old), pg('1.1', 0, old)],
+                               max_in_flight=1, retry_after=60)
+        assert tracker.dispatch(0) == ['1.0']
+        assert tracker.dispatch(30) == []
+        # the osd dropped the scrub of 1.0
+        assert tracker.dispatch(60) == ['1.0']
+        assert tracker.update([pg('1.0', 0, new), pg('1.1', 0, old)],
+                              70) == 1
+        assert tracker.dispatch(70) == ['1.1']
+        report = tracker.report(80)
+        assert report['retried'] == 1
+        assert report['durations'] == {'1.0': 10}
@@ -0,0 +1,34 @@
+from ..thrash_pacing import ThrashPacer
+
+
+def pgmap(degraded, total=1000, rate=0):
+    return {'degraded_objects': degraded, 'degraded_total': total,
+            'recovering_objects_per_sec': rate}
+
+
+class TestThrashPacer(object):
+
+    def test_speeds_up_when_healthy(self):
+        pacer = ThrashPacer(8, 60, target=0.1, min_delay=1)
+        assert pacer.update(pgmap(0)) == 4
+        assert pacer.update(pgmap(0)) == 2
+        assert pacer.update(pgmap(0)) == 1
+        assert pacer.update(pgmap(0)) == 1
+        assert pacer.clean_chance == 1.0 / 60
+
+    def test_backs_off_when_behind(self):
+        pacer = ThrashPacer(5, 600, target=0.1, max_delay=15)
+        assert round(pacer.update(pgmap(100, rate=50)), 6) == 5
+        assert round(pacer.update(pgmap(150, rate=50)), 6) == 7.5
+        assert round(pacer.clean_chance, 6) == round(7.5 / 600 * 1.5, 6)
+        assert round(pacer.update(pgmap(500, rate=50)), 6) == 15
+        assert pacer.clean_chance < 1
+        # far over target with recovery stalled: wait for it
+        pacer.update(pgmap(500))
+        assert pacer.clean_chance == 1
+        assert pacer.summary()['peak_degraded_fraction'] == 0.5
+
+    def test_misplaced(self):
+        assert ThrashPacer.degraded_fraction(
+            {'misplaced_objects': 30, 'misplaced_total': 100}) == 0.3
+        assert ThrashPacer.degraded_fraction({}) == 0
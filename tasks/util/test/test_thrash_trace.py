@@ -0,0 +1,32 @@
+import os
+import shutil
+import tempfile
+
+from .. import thrash_trace
+
+
+class TestThrashTrace(object):
+
+    def setup(self):
+        self.dir = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        path = os.path.join(self.dir, 'thrash', 'ceph.trace.jsonl')
+        trace = thrash_trace.ThrashTrace(path, 1234)
+        trace.record(1, trace.start + 2.5, 'kill_osd', (), 3, 1.5, 10, 12)
+        # readable before the trace is closed
+        header, records = thrash_trace.load(path)
+        assert header['seed'] == 1234
+        assert records[0]['time'] == 2.5
+        trace.record(2, trace.start + 9, 'inject_pause',
+                     ('filestore_inject_stall', 3, 0, False), 1, 0.1,
+                     12, 12, pool='rbd')
+        trace.close()
+        header, records = thrash_trace.load(path)
+        assert [r['action'] for r in records] == ['kill_osd', 'inject_pause']
+        assert records[1]['args'] == ['filestore_inject_stall', 3, 0, False]
+        assert records[0]['epoch_after'] == 12
+        assert [r['pool'] for r in records] == [None, 'rbd']
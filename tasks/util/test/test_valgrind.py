@@ -0,0 +1,72 @@
+import gzip
+import os
+import shutil
+import tempfile
+
+from .. import valgrind
+from . import LocalRemote
+
+
+ERROR = """
+<error>
+  <unique>0x{unique}</unique>
+  <kind>{kind}</kind>
+  <xwhat><text>{what}</text></xwhat>
+  <stack>
+    <frame><ip>0x1</ip><obj>/usr/lib/libc.so</obj><fn>malloc</fn></frame>
+    <frame><ip>0x2</ip><fn>{fn}</fn><file>OSD.cc</file><line>42</line></frame>
+    <frame><ip>0x3</ip><fn>main</fn><file>ceph_osd.cc</file><line>7</line></frame>
+  </stack>
+</error>
+"""
+
+
+def make_log(*errors):
+    return '<?xml version="1.0"?>\n<valgrindoutput>\n' + ''.join(
+        ERROR.format(unique=i, kind=kind, what='leak', fn=fn)
+        for i, (kind, fn) in enumerate(errors))
+
+
+class TestCollect(object):
+
+    def setup(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def teardown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_fold(self):
+        leak = ('Leak_DefinitelyLost', 'OSD::init')
+        with open(os.path.join(self.tmp, 'osd.0.log'), 'w') as f:
+            f.write(make_log(leak, leak, ('InvalidRead', 'OSD::tick')) +
+                    '</valgrindoutput>\n')
+        # a daemon which died before valgrind finished its log
+        f = gzip.open(os.path.join(self.tmp, 'osd.1.log.gz'), 'wb')
+        f.write(make_log(leak) + '<error><kind>Inv')
+        f.close()
+        errors, failed = valgrind.collect([LocalRemote('node1')],
+                                          directory=self.tmp, frames=2)
+        assert failed == []
+        assert [(e['kind'], e['count'], e['daemons']) for e in errors] == [
+            ('Leak_DefinitelyLost', 3, ['osd.0@node1', 'osd.1@node1']),
+            ('InvalidRead', 1, ['osd.0@node1']),
+        ]
+        assert errors[0]['frames'] == ['malloc (/usr/lib/libc.so)',
+                                       'OSD::init (OSD.cc:42)']
+        valgrind.write_summary(errors, os.path.join(self.tmp, 'summary'))
+        with open(os.path.join(self.tmp, 'summary', 'summary.txt')) as f:
+            assert f.readline().split() == [
+                '3', 'Leak_DefinitelyLost', 'osd.0@node1,', 'osd.1@node1']
+
+    def test_garbled(self):
+        # invalid xml midway through hides no error that comes after it
+        with open(os.path.join(self.tmp, 'osd.0.log'), 'w') as f:
+            f.write(make_log(('InvalidRead', 'OSD::tick')) +
+                    '<error><<garbled>>' +
+                    ERROR.format(unique=9, kind='InvalidWrite', what='',
+                                 fn='OSD::init') +
+                    '</valgrindoutput>\n')
+        errors, failed = valgrind.collect([LocalRemote('node1')],
+                                          directory=self.tmp)
+        assert sorted((e['kind'], e['count']) for e in errors) == [
+            ('InvalidRead', 1), ('InvalidWrite', 1)]
@@ -0,0 +1,90 @@
+"""
+Adaptive pacing of thrasher actions.
+
+With a fixed op_delay the thrasher either piles failures onto a cluster
+which cannot keep up, or leaves a fast cluster idle between actions.
+ThrashPacer instead looks at the pgmap each cycle and steers the delay
+between actions, and the chance of stopping to wait for recovery, to
+keep the fraction of degraded and misplaced objects near a target.
+"""
+
+
+class ThrashPacer(object):
+    """
+    Multiplicative controller for the thrasher's op delay.
+
+    Each update scales the delay by the ratio of the observed degraded
+    (plus misplaced) fraction to the target, clamped to [0.5, 2], so it
+    halves at most per cycle while the cluster copes and doubles at most
+    while it falls behind.  The chance of a clean wait is the fixed
+    mode's delay / clean_interval, scaled up by the same ratio when over
+    target, and certain when well over target with recovery stalled.
+
+    :param delay: initial delay between actions (op_delay)
+    :param clean_interval: as for the fixed pacing
+    :param target: degraded fraction to aim for
+    :param min_delay: shortest delay between actions
+    :param max_delay: longest delay between actions
+    """
+
+    def __init__(self, delay, clean_interval, target=0.1, min_delay=1,
+                 max_delay=60):
+        self.delay = float(delay)
+        self.clean_interval = float(clean_interval)
+        self.target = float(target)
+        self.min_delay = float(min_delay)
+        self.max_delay = float(max_delay)
+        self.clean_chance = self.delay / self.clean_interval
+        self.fraction = 0.0
+        self.recovering = False
+        self.updates = 0
+        self.peak_fraction = 0.0
+
+    @staticmethod
+    def degraded_fraction(pgmap):
+        """
+        Return the fraction of object copies which are degraded or
+        misplaced, from a ``ceph pg stat`` summary.
+        """
+        total = max(pgmap.get('degraded_total', 0),
+                    pgmap.get('misplaced_total', 0))
+        if not total:
+            return 0.0
+        bad = pgmap.get('degraded_objects', 0) + \
+            pgmap.get('misplaced_objects', 0)
+        return min(1.0, float(bad) / total)
+
+    def update(self, pgmap):
+        """
+        Take one pgmap sample and work out the next delay and clean
+        chance.
+
+        :param pgmap: the output of ``ceph pg stat --format=json``
+        """
+        self.updates += 1
+        self.fraction = self.degraded_fraction(pgmap)
+        self.peak_fraction = max(self.peak_fraction, self.fraction)
+        self.recovering = any(
+            pgmap.get(key, 0) > 0 for key in [
+                'recovering_objects_per_sec',
+                'recovering_bytes_per_sec',
+                'recovering_keys_per_sec'])
+        ratio = self.fraction / self.target
+        self.delay = min(self.max_delay,
+                         max(self.min_delay,
+                             self.delay * min(2.0, max(0.5, ratio))))
+        if ratio > 2 and not self.recovering:
+            self.clean_chance = 1.0
+        else:
+            self.clean_chance = min(
+                1.0, self.delay / self.clean_interval * max(1.0, ratio))
+        return self.delay
+
+    def summary(self):
+        return {
+            'updates': self.updates,
+            'delay': self.delay,
+            'clean_chance': self.clean_chance,
+            'degraded_fraction': self.fraction,
+            'peak_degraded_fraction': self.peak_fraction,
+        }
@@ -0,0 +1,70 @@
+"""
+Thrasher action traces.
+
+A trace is a JSON lines file: a header line with the seed of the
+thrasher's random number generator, then one line per action with its
+start time (seconds since the header), name, arguments, target osd,
+target pool, duration and the osdmap epochs before and after it.  Lines are written
+as the actions complete, so a trace survives a job that dies midway.
+"""
+import json
+import os
+import time
+
+
+class ThrashTrace(object):
+    """
+    Append-only writer of a thrasher trace.
+
+    :param path: file to write; its directory is created if needed
+    :param seed: seed of the thrasher's random number generator
+    :param extra: more fields for the header line
+    """
+
+    def __init__(self, path, seed, **extra):
+        dirname = os.path.dirname(path)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        self.path = path
+        self.start = time.time()
+        self.f = open(path, 'w')
+        self._write(dict(extra, seed=seed, start=self.start))
+
+    def _write(self, record):
+        self.f.write(json.dumps(record) + '\n')
+        self.f.flush()
+
+    def record(self, seq, started, action, args, osd, duration,
+               epoch_before, epoch_after, pool=None):
+        """
+        Append one action to the trace.
+
+        :param started: time.time() at which the action started
+        """
+        self._write({
+            'seq': seq,
+            'time': started - self.start,
+            'action': action,
+            'args': list(args),
+            'osd': osd,
+            'pool': pool,
+            'duration': duration,
+            'epoch_before': epoch_before,
+            'epoch_after': epoch_after,
+        })
+
+    def close(self):
+        self.f.close()
+
+
+def load(path):
+    """
+    Read a trace written by ThrashTrace.
+
+    :returns: a (header, [action record, ...]) tuple
+    """
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    if not lines:
+        raise ValueError('empty thrasher trace {0}'.format(path))
+    return lines[0], lines[1:]
@@ -0,0 +1,222 @@
+"""
+Collection of valgrind results.
+
+collect() parses the valgrind XML logs (gzipped or not) of all nodes at
+once, one file per core, keeping the kind, the description and the top
+frames of the stack of every error.  Errors are folded together by kind
+and top frames across daemons and nodes, so that a leak seen in every
+osd shows up once, with the daemons it was seen in.
+"""
+import json
+import logging
+import os
+from cStringIO import StringIO
+
+from teuthology.parallel import parallel
+
+log = logging.getLogger(__name__)
+
+VALGRIND_DIR = '/var/log/ceph/valgrind'
+
+# number of stack frames which identify an error
+DEFAULT_FRAMES = 5
+
+PARSER = """
+import glob
+import gzip
+import json
+import multiprocessing
+import os
+import re
+import sys
+try:
+    import xml.etree.cElementTree as ElementTree
+except ImportError:
+    import xml.etree.ElementTree as ElementTree
+
+directory, depth = sys.argv[1], int(sys.argv[2])
+KIND = re.compile(r'<kind>(\\w+)</kind>')
+
+
+def frame(elem):
+    where = elem.findtext('obj') or ''
+    if elem.findtext('file'):
+        where = '{0}:{1}'.format(elem.findtext('file'),
+                                 elem.findtext('line') or '?')
+    return '{0} ({1})'.format(elem.findtext('fn') or elem.findtext('ip'),
+                              where)
+
+
+def parse(path):
+    errors = {}
+    truncated = False
+    opener = gzip.open if path.endswith('.gz') else open
+    try:
+        with opener(path, 'rb') as f:
+            root = None
+            for event, elem in ElementTree.iterparse(f, ('start', 'end')):
+                if root is None:
+                    root = elem
+                if event != 'end' or elem.tag != 'error':
+                    continue
+                kind = elem.findtext('kind')
+                what = elem.findtext('what') or \\
+                    elem.findtext('xwhat/text') or ''
+                stack = elem.find('stack')
+                frames = [] if stack is None else \\
+                    [frame(fr) for fr in stack.findall('frame')[:depth]]
+                key = json.dumps([kind, frames])
+                if key in errors:
+                    errors[key]['count'] += 1
+                else:
+                    errors[key] = {'kind': kind, 'what': what,
+                                   'frames': frames, 'count': 1}
+                root.clear()
+    except (ElementTree.ParseError, EOFError, IOError):
+        # the daemon died before valgrind closed its log, or the log is
+        # garbled; what follows the bad spot still counts
+        truncated = True
+        parsed = {}
+        for error in errors.values():
+            parsed[error['kind']] = parsed.get(error['kind'], 0) + \
+                error['count']
+        for kind, count in grep_kinds(path).items():
+            if count > parsed.get(kind, 0):
+                errors[json.dumps([kind, None])] = {
+                    'kind': kind, 'what': 'in the unparsable part of the log',
+                    'frames': [], 'count': count - parsed.get(kind, 0)}
+    return {'file': os.path.basename(path), 'truncated': truncated,
+            'errors': list(errors.values())}
+
+
+def grep_kinds(path):
+    kinds = {}
+    opener = gzip.open if path.endswith('.gz') else open
+    try:
+        with opener(path, 'rb') as f:
+            for line in f:
+                for kind in KIND.findall(line.decode('utf-8', 'replace')):
+                    kinds[kind] = kinds.get(kind, 0) + 1
+    except (EOFError, IOError):
+        pass
+    return kinds
+
+
+paths = sorted(glob.glob(os.path.join(directory, '*')))
+if len(paths) > 1:
+    pool = multiprocessing.Pool(min(len(paths), multiprocessing.cpu_count()))
+    results = pool.map(parse, paths)
+    pool.close()
+else:
+    results = [parse(path) for path in paths]
+json.dump(results, sys.stdout)
+"""
+
+
+def daemon_name(filename):
+    """
+    osd.0.log.gz -> osd.0
+    """
+    for suffix in ('.gz', '.log'):
+        if filename.endswith(suffix):
+            filename = filename[:-len(suffix)]
+    return filename
+
+
+def parse_remote(remote, directory=VALGRIND_DIR, frames=DEFAULT_FRAMES):
+    """
+    Parse the valgrind logs of one node.
+
+    :returns: a list with, for each log, a dict with its 'file', whether
+              it was 'truncated' and its 'errors' (each with 'kind',
+              'what', 'frames' and 'count'); or None if the parser
+              failed
+    """
+    stdout = StringIO()
+    proc = remote.run(
+        args=['sudo', 'python', '-c', PARSER, directory, str(frames)],
+        stdout=stdout,
+        stderr=StringIO(),
+        check_status=False,
+    )
+    if proc.exitstatus != 0:
+        log.warning('parsing valgrind logs on %s failed: %s',
+                    remote.shortname, proc.stderr.getvalue().strip())
+        return None
+    return json.loads(stdout.getvalue())
+
+
+def collect(remotes, directory=VALGRIND_DIR, frames=DEFAULT_FRAMES):
+    """
+    Parse the valgrind logs of all nodes at once and fold their errors
+    together by kind and top frames.
+
+    :returns: (errors, failed): the errors, most frequent first, each a
+              dict with 'kind', 'what', 'frames', 'count' and the
+              'daemons' ('<daemon>@<node>') it was seen in; and the
+              remotes whose logs could not be parsed
+    """
+    results = {}
+
+    def parse(remote):
+        results[remote] = parse_remote(remote, directory, frames)
+
+    with parallel() as p:
+        for remote in remotes:
+            p.spawn(parse, remote)
+
+    errors = {}
+    failed = []
+    for remote, logs in results.iteritems():
+        if logs is None:
+            failed.append(remote)
+            continue
+        for result in logs:
+            daemon = '{daemon}@{node}'.format(
+                daemon=daemon_name(result['file']), node=remote.shortname)
+            if result['truncated']:
+                log.warning('valgrind log of %s is truncated or garbled',
+                            daemon)
+            for error in result['errors']:
+                key = (error['kind'], tuple(error['frames']))
+                merged = errors.get(key)
+                if merged is None:
+                    merged = errors[key] = dict(error, count=0, daemons=[])
+                merged['count'] += error['count']
+                if daemon not in merged['daemons']:
+                    merged['daemons'].append(daemon)
+    errors = sorted(errors.itervalues(),
+                    key=lambda error: (-error['count'], error['kind']))
+    for error in errors:
+        error['daemons'].sort()
+    return errors, failed
+
+
+def format_table(errors):
+    """
+    Return a compact text table of folded errors: count, kind and
+    daemons, then the description and the top frames.
+    """
+    lines = []
+    for error in errors:
+        lines.append('{count:>6}  {kind}  {daemons}'.format(
+            count=error['count'], kind=error['kind'],
+            daemons=', '.join(error['daemons'])))
+        if error['what']:
+            lines.append('        ' + error['what'])
+        for frame in error['frames']:
+            lines.append('          at ' + frame)
+    return '\n'.join(lines) + '\n'
+
+
+def write_summary(errors, directory):
+    """
+    Write the folded errors to summary.json and summary.txt in
+    directory.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(os.path.join(directory, 'summary.json'), 'w') as f:
+        json.dump(errors, f, indent=1)
+    with open(os.path.join(directory, 'summary.txt'), 'w') as f:
+        f.write(format_table(errors))
@@ -106,6 +106,7 @@ if os.path.exists("./CMakeCache.txt") and os.path.exists("./bin"):
 try:
     from teuthology.exceptions import CommandFailedError
     from tasks.ceph_manager import CephManager
+    from tasks.util.osdmap_cache import OSDMapCache
     from tasks.cephfs.fuse_mount import FuseMount
     from tasks.cephfs.filesystem import Filesystem, MDSCluster, CephCluster
     from mgr.mgr_test_case import MgrCluster
@@ -501,6 +502,14 @@ class LocalCephManager(CephManager):
         # certain teuthology tests want to run tasks in parallel
         self.lock = threading.RLock()
 
+        self.pg_snapshot = None
+        self.pg_snapshot_hits = 0
+        self.pg_snapshot_misses = 0
+        # raw_cluster_cmd is overridden, so no streamed pg dumps
+        self.compact_pg_dump = False
+        self.osdmap_cache = OSDMapCache()
+        self.map_watcher = None
+
     def find_remote(self, daemon_type, daemon_id):
         """
         daemon_type like 'mds', 'osd'
@@ -527,9 +536,11 @@ class LocalCephManager(CephManager):
         proc = self.controller.run([os.path.join(BIN_PREFIX, "ceph")] + list(args), check_status=False)
         return proc.exitstatus
 
-    def admin_socket(self, daemon_type, daemon_id, command, check_status=True):
+    def admin_socket(self, daemon_type, daemon_id, command, check_status=True,
+                     timeout=0, stdout=None):
         return self.controller.run(
-            args=[os.path.join(BIN_PREFIX, "ceph"), "daemon", "{0}.{1}".format(daemon_type, daemon_id)] + command, check_status=check_status
+            args=[os.path.join(BIN_PREFIX, "ceph"), "daemon", "{0}.{1}".format(daemon_type, daemon_id)] + command, check_status=check_status,
+            stdout=stdout
         )
 
     # FIXME: copypasta